@@ -0,0 +1,112 @@
+"""
+BITBOARD
+
+Stores one bit per square of the extended 12x8 board (both banks and the main board) in a single integer,
+so whole-board questions ("which squares changed?", "which squares are missing a piece?") are one AND/XOR
+instead of a loop over 96 dict entries.
+
+BIT LAYOUT
+Bit index = column * 8 + (rank - 1), with columns numbered left to right the same way as the Arduino's
+reedSwitchValues[column][row]. Each column is one byte, so w1 is bit 0 and h8 is bit 95.
+
+    - Bank1Bank2   Main Board
+    - _________ _________________
+    8 |_|_|_|_| |_|_|_|_|_|_|_|_|
+    ...
+    1 |_|_|_|_| |_|_|_|_|_|_|_|_|
+       w x y z   a b c d e f g h
+column 0 1 2 3   4 5 6 7 8 9 1011
+
+Bitboards are plain ints. The Bitboard class only holds helpers for building and reading them.
+"""
+
+# Constants
+RANKS = "12345678"
+ALL_FILES = "wxyzabcdefgh" # In column order
+NUM_SQUARES = len(ALL_FILES) * len(RANKS)
+EMPTY = 0
+FULL = (1 << NUM_SQUARES) - 1
+
+# Lookup tables
+INDEX_SQUARES = [file + rank for file in ALL_FILES for rank in RANKS] # Bit index -> 'f2'
+SQUARE_INDICES = {square: index for (index, square) in enumerate(INDEX_SQUARES)} # 'f2' -> bit index
+SQUARE_BITS = {square: 1 << index for (index, square) in enumerate(INDEX_SQUARES)} # 'f2' -> bitboard with only that square
+
+class Bitboard:
+    @staticmethod
+    def squareIndex(square):
+        # 'f2' -> bit index
+        return SQUARE_INDICES[square]
+
+    @staticmethod
+    def squareAt(index):
+        # Bit index -> 'f2'
+        return INDEX_SQUARES[index]
+
+    @staticmethod
+    def fileRankIndex(fileRank):
+        # (file, rank) coordinates (see PhysicalBoard) -> bit index
+        (file, rank) = fileRank
+        column = file + 5 if file < 0 else file + 4
+        return column * 8 + rank - 1
+
+    @staticmethod
+    def indexFileRank(index):
+        # Bit index -> (file, rank) coordinates (see PhysicalBoard)
+        (column, row) = divmod(index, 8)
+        file = column - 5 if column < 4 else column - 4
+        return (file, row + 1)
+
+    @staticmethod
+    def bit(square):
+        # 'f2' -> bitboard with only that square
+        return SQUARE_BITS[square]
+
+    @staticmethod
+    def fromSquares(squares):
+        bitboard = EMPTY
+        for square in squares:
+            bitboard |= SQUARE_BITS[square]
+        return bitboard
+
+    @staticmethod
+    def fromDict(squareValues):
+        # {'f2': True, 'f3': False, ...} -> bitboard of the squares that are True
+        return Bitboard.fromSquares(square for (square, value) in squareValues.items() if value)
+
+    @staticmethod
+    def toDict(bitboard):
+        # Bitboard -> {'w1': False, ..., 'h8': True} for all 96 squares
+        return {square: (bitboard >> index) & 1 == 1 for (index, square) in enumerate(INDEX_SQUARES)}
+
+    @staticmethod
+    def isSet(bitboard, square):
+        return bitboard & SQUARE_BITS[square] != 0
+
+    @staticmethod
+    def set(bitboard, square, value=True):
+        return (bitboard | SQUARE_BITS[square]) if value else (bitboard & ~SQUARE_BITS[square])
+
+    @staticmethod
+    def popcount(bitboard):
+        return bin(bitboard).count('1')
+
+    @staticmethod
+    def indices(bitboard):
+        # Yields the bit index of every set square, lowest first. Takes time proportional to the number of set squares.
+        while (bitboard):
+            lowestBit = bitboard & -bitboard
+            yield lowestBit.bit_length() - 1
+            bitboard ^= lowestBit
+
+    @staticmethod
+    def squares(bitboard):
+        # Yields every set square ('f2'), lowest bit first
+        for index in Bitboard.indices(bitboard):
+            yield INDEX_SQUARES[index]
+
+    @staticmethod
+    def diff(old, new):
+        # Returns (added, removed): bitboards of squares that turned on, and squares that turned off
+        changed = old ^ new
+        return (changed & new, changed & old)
@@ -0,0 +1,237 @@
+"""
+CALIBRATION
+
+Fits the mapping from board coordinates (file, rank) to machine coordinates (x, y) from measured samples,
+and saves/loads it from a calibration file.
+
+
+MODEL
+The bank and the main board are separate pieces, so each gets its own projective transform (homography):
+    x = (h0*file + h1*rank + h2) / (h6*file + h7*rank + h8)
+    y = (h3*file + h4*rank + h5) / (h6*file + h7*rank + h8)
+This handles offset, scale, rotation, skew, and the board not being perfectly square to the gantry.
+
+Each homography is fitted by linear least squares from any number of samples (at least 4 per region, not all in a line).
+With exactly 3 samples, an affine transform is fitted instead (h6 = h7 = 0).
+Regions without enough samples have no model, and PhysicalBoard falls back to its hardcoded corner values for them.
+
+Points left of the main board (file < 0) belong to the bank, everything else belongs to the main board.
+
+
+CALIBRATION FILE (JSON)
+{
+    "samples": [
+        {"square": "a1", "x": 224, "y": 876},
+        {"file": 0.5, "rank": 1.5, "x": 337, "y": 990},    <- Corners/edges can be given as numeric file/rank
+        ...
+    ],
+    "models": {
+        "bank": [h0, h1, h2, h3, h4, h5, h6, h7, h8],
+        "board": [h0, h1, h2, h3, h4, h5, h6, h7, h8]
+    }
+}
+
+Measure samples (for example, with ChessInterface.goTo), add them to the file, then refit with:
+    python Calibration.py [calibration file]
+"""
+
+# Imports
+import json
+import os
+import sys
+
+# Configuration
+CALIBRATION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibration.json')
+REGIONS = ('bank', 'board')
+
+class Calibration:
+    def __init__(self, samples=None, models=None):
+        self.samples = [] if samples is None else samples # List of ((file, rank), (x, y))
+        self.models = {} if models is None else models # Region name -> 3x3 homography
+
+    @staticmethod
+    def getRegion(fileRank):
+        return 'bank' if fileRank[0] < 0 else 'board'
+
+    def addSample(self, fileRank, xy):
+        self.samples.append((tuple(fileRank), tuple(xy)))
+
+    def fit(self):
+        # Fit a model for every region that has enough samples. Returns True if at least one region was fitted.
+        self.models = {}
+        for region in REGIONS:
+            points = [sample for sample in self.samples if Calibration.getRegion(sample[0]) == region]
+            if (len(points) >= 4):
+                model = Calibration.fitHomography(points)
+            elif (len(points) == 3):
+                model = Calibration.fitAffine(points)
+            else:
+                model = None
+
+            if (model is not None):
+                self.models[region] = model
+            elif (len(points) > 0):
+                print("Not enough calibration samples for the " + region + " (" + str(len(points)) + "), need at least 3 that aren't in a line.")
+        return len(self.models) > 0
+
+    def getXYFromFileRank(self, fileRank):
+        # Machine coordinates for a (file, rank) point, or None if its region has no model.
+        model = self.models.get(Calibration.getRegion(fileRank))
+        if (model is None):
+            return None
+        return Calibration.applyHomography(model, fileRank)
+
+    def getResiduals(self):
+        # Distance (in machine units) between each sample and where the fitted model puts it.
+        residuals = []
+        for (fileRank, (x, y)) in self.samples:
+            fitted = self.getXYFromFileRank(fileRank)
+            if (fitted is not None):
+                residuals.append((fileRank, ((fitted[0] - x) ** 2 + (fitted[1] - y) ** 2) ** 0.5))
+        return residuals
+
+    @staticmethod
+    def applyHomography(model, fileRank):
+        (file, rank) = fileRank
+        w = model[2][0] * file + model[2][1] * rank + model[2][2]
+        x = (model[0][0] * file + model[0][1] * rank + model[0][2]) / w
+        y = (model[1][0] * file + model[1][1] * rank + model[1][2]) / w
+        return (x, y)
+
+    @staticmethod
+    def __getNormalization(points):
+        # 3x3 transform that moves points to be centered on (0, 0) with an average distance of ~1.
+        # Keeps the least squares problem well conditioned, since files/ranks are ~1-10 and machine coordinates are ~1000s.
+        count = len(points)
+        centerX = sum(point[0] for point in points) / count
+        centerY = sum(point[1] for point in points) / count
+        averageDistance = sum(((point[0] - centerX) ** 2 + (point[1] - centerY) ** 2) ** 0.5 for point in points) / count
+        scale = 1 / averageDistance if averageDistance > 0 else 1
+        return [[scale, 0, -scale * centerX], [0, scale, -scale * centerY], [0, 0, 1]]
+
+    @staticmethod
+    def __fitNormalized(samples, affine):
+        # Returns the 3x3 transform from samples, solving in normalized coordinates. None if the samples are degenerate.
+        sources = [sample[0] for sample in samples]
+        targets = [sample[1] for sample in samples]
+        sourceNormalization = Calibration.__getNormalization(sources)
+        targetNormalization = Calibration.__getNormalization(targets)
+
+        # Build A * h = b, two rows per sample
+        rows = []
+        values = []
+        for (source, target) in zip(sources, targets):
+            (u, v) = Calibration.applyHomography(sourceNormalization, source)
+            (x, y) = Calibration.applyHomography(targetNormalization, target)
+            if (affine):
+                rows.append([u, v, 1, 0, 0, 0])
+                rows.append([0, 0, 0, u, v, 1])
+            else:
+                rows.append([u, v, 1, 0, 0, 0, -u * x, -v * x])
+                rows.append([0, 0, 0, u, v, 1, -u * y, -v * y])
+            values.append(x)
+            values.append(y)
+
+        # Least squares: (A^T A) h = A^T b
+        size = len(rows[0])
+        normalMatrix = [[sum(row[i] * row[j] for row in rows) for j in range(size)] for i in range(size)]
+        normalVector = [sum(row[i] * value for (row, value) in zip(rows, values)) for i in range(size)]
+        solution = Calibration.solveLinearSystem(normalMatrix, normalVector)
+        if (solution is None):
+            return None
+        if (affine):
+            solution += [0, 0]
+        normalizedModel = [solution[0:3], solution[3:6], [solution[6], solution[7], 1]]
+
+        # Undo the normalization: model = targetNormalization^-1 * normalizedModel * sourceNormalization
+        targetScale = targetNormalization[0][0]
+        targetDenormalization = [[1 / targetScale, 0, -targetNormalization[0][2] / targetScale], [0, 1 / targetScale, -targetNormalization[1][2] / targetScale], [0, 0, 1]]
+        model = Calibration.__multiply(targetDenormalization, Calibration.__multiply(normalizedModel, sourceNormalization))
+        scale = model[2][2]
+        return [[value / scale for value in row] for row in model]
+
+    @staticmethod
+    def fitHomography(samples):
+        # samples: List of ((file, rank), (x, y)), at least 4
+        return Calibration.__fitNormalized(samples, affine=False)
+
+    @staticmethod
+    def fitAffine(samples):
+        # samples: List of ((file, rank), (x, y)), at least 3
+        return Calibration.__fitNormalized(samples, affine=True)
+
+    @staticmethod
+    def __multiply(a, b):
+        return [[sum(a[i][k] * b[k][j] for k in range(3)) for j in range(3)] for i in range(3)]
+
+    @staticmethod
+    def solveLinearSystem(matrix, vector):
+        # Gaussian elimination with partial pivoting. Returns None if the system is singular.
+        size = len(vector)
+        augmented = [list(matrix[i]) + [vector[i]] for i in range(size)]
+        for column in range(size):
+            pivot = max(range(column, size), key=lambda row: abs(augmented[row][column]))
+            if (abs(augmented[pivot][column]) < 1e-12):
+                return None
+            augmented[column], augmented[pivot] = augmented[pivot], augmented[column]
+            for row in range(column + 1, size):
+                factor = augmented[row][column] / augmented[column][column]
+                for i in range(column, size + 1):
+                    augmented[row][i] -= factor * augmented[column][i]
+
+        solution = [0] * size
+        for row in reversed(range(size)):
+            total = augmented[row][size] - sum(augmented[row][i] * solution[i] for i in range(row + 1, size))
+            solution[row] = total / augmented[row][row]
+        return solution
+
+    def save(self, path=CALIBRATION_PATH):
+        data = {
+            'samples': [{'file': fileRank[0], 'rank': fileRank[1], 'x': xy[0], 'y': xy[1]} for (fileRank, xy) in self.samples],
+            'models': {region: [value for row in model for value in row] for (region, model) in self.models.items()}
+        }
+        with open(path, 'w') as file:
+            json.dump(data, file, indent=4)
+
+    @staticmethod
+    def load(path=CALIBRATION_PATH, refit=False):
+        # Loads a calibration file. Returns None if there isn't one (or it can't be read).
+        # refit: Fit the models from the samples instead of using the saved models.
+        if (not os.path.exists(path)):
+            return None
+        try:
+            with open(path, 'r') as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            print("Could not read calibration file '" + path + "': " + str(e))
+            return None
+
+        calibration = Calibration()
+        for sample in data.get('samples', []):
+            if ('square' in sample):
+                from PhysicalBoard import PhysicalBoard # Imported here, since PhysicalBoard loads calibration on import
+                fileRank = PhysicalBoard.getFileRankCoords(sample['square'])
+            else:
+                fileRank = (sample['file'], sample['rank'])
+            calibration.addSample(fileRank, (sample['x'], sample['y']))
+
+        models = data.get('models', {})
+        if (refit or len(models) == 0):
+            calibration.fit()
+        else:
+            for (region, values) in models.items():
+                calibration.models[region] = [values[0:3], values[3:6], values[6:9]]
+        return calibration
+
+if __name__ == '__main__':
+    # Refit the models in a calibration file from its samples, and print how well they fit.
+    path = sys.argv[1] if len(sys.argv) > 1 else CALIBRATION_PATH
+    calibration = Calibration.load(path, refit=True)
+    if (calibration is None):
+        print("No calibration file at '" + path + "'.")
+        sys.exit(1)
+
+    for (fileRank, residual) in calibration.getResiduals():
+        print(str(fileRank) + ": " + str(round(residual, 1)))
+    calibration.save(path)
+    print("Saved calibration for " + ", ".join(calibration.models.keys()) + " to '" + path + "'.")
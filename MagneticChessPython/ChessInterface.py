@@ -53,12 +53,17 @@ import chess                    # (pip install python-chess) Documentation: http
 import chess.engine             # (pip install python-chess) Documentation: https://python-chess.readthedocs.io/en/latest/
 import random
 import time
-from PhysicalBoard import PhysicalBoard
+import collections
+import concurrent.futures
+from PhysicalBoard import PhysicalBoard, HOME_COMMAND
+from Bitboard import Bitboard
+from MoveScheduler import MoveScheduler
+from MoveInference import MoveInference
 from Audio import Audio
 
 # Configuration
 MOVE_VALIDITY_THRESHOLD = 1 # Time to wait (in seconds) after a human move to consider it finished.
-COMPUTER_MOVE_DELAY = 1 # (in seconds) Wait this long after the last move is finished before making a computer move.
+REED_SWITCH_HISTORY_SIZE = 256 # Reed switch changes kept for working out one human move. A move makes at most about 8.
 
 # Constants
 RANKS = "12345678"
@@ -114,6 +119,9 @@ BANK_FILL_ORDER = {
     'n': ['y2', 'y1']
 }
 
+# For each piece, bitboards (see Bitboard.py) of its bank squares with 0, 1, 2, ... of them filled
+BANK_FILL_BITBOARDS = {symbol: [Bitboard.fromSquares(squares[:count]) for count in range(len(squares) + 1)] for (symbol, squares) in BANK_FILL_ORDER.items()}
+
 NUM_PIECES = {
     'P': 8, 'Q': 2, 'R': 2, 'B': 2, 'N': 2, 'K': 1,
     'p': 8, 'q': 2, 'r': 2, 'b': 2, 'n': 2, 'k': 1
@@ -121,22 +129,6 @@ NUM_PIECES = {
 AILEVEL_TO_ELO = {
     1: 200, 2: 400, 3: 600, 4: 800, 5: 1000, 6: 1200, 7: 1400, 8: 1600, 9: 1800, 10: None
 }
-# Physical moves for each castling move
-WHITE_KINGSIDE_CASTLE_PHYSICAL = {'e1': False, 'f1': True, 'g1': True, 'h1': False}
-WHITE_QUEENSIDE_CASTLE_PHYSICAL = {'e1': False, 'd1': True, 'c1': True, 'a1': False}
-BLACK_KINGSIDE_CASTLE_PHYSICAL = {'e8': False, 'f8': True, 'g8': True, 'h8': False}
-BLACK_QUEENSIDE_CASTLE_PHYSICAL = {'e8': False, 'd8': True, 'c8': True, 'a8': False}
-
-# All possible en passant moves, of the form (pawn_start, pawn_end, captured_pawn)
-ALL_EN_PASSANT_PHYSICAL = []
-for file in range(len(FILES_STANDARD)):
-    if (file != 0):
-        ALL_EN_PASSANT_PHYSICAL.append((FILES_STANDARD[file-1] + '5', FILES_STANDARD[file] + '6', FILES_STANDARD[file] + '5'))
-        ALL_EN_PASSANT_PHYSICAL.append((FILES_STANDARD[file-1] + '4', FILES_STANDARD[file] + '3', FILES_STANDARD[file] + '4'))
-    if (file != len(FILES_STANDARD)-1):
-        ALL_EN_PASSANT_PHYSICAL.append((FILES_STANDARD[file+1] + '5', FILES_STANDARD[file] + '6', FILES_STANDARD[file] + '5'))
-        ALL_EN_PASSANT_PHYSICAL.append((FILES_STANDARD[file+1] + '4', FILES_STANDARD[file] + '3', FILES_STANDARD[file] + '4'))
-
 class ChessInterface:
     def __init__(self, enableSound=True, audioObject=None):
         self.state = SETUP_BOARD_AND_PLAYERS
@@ -147,8 +139,15 @@ class ChessInterface:
         self.physicalBoard = PhysicalBoard()
         self.stackLengthAfterMove = [] # Since moves can take multiple steps, we keep track of the final length of the stack after the move is complete 
         self.physicalMoveStack = []
-        self.reedSwitchStateChanges = []
-        self.lastReedSwitchUpdate = time.time()
+        self.physicalMoveFuture = PhysicalBoard.completedFuture() # Resolved once the Arduino finishes the last move sent by move()
+        self.reedSwitchStateChanges = collections.deque(maxlen=REED_SWITCH_HISTORY_SIZE) # (square, state) for each debounced reed switch change in the move in progress
+        self.reedSwitchCursor = self.physicalBoard.getReedSwitchEventCursor() # Where updatePhysicalMoveInProgress reads reed switch events from next
+        self.reedSwitchesIgnoredBefore = time.time() # Reed switch changes from before this were made by the robot, or are part of a move already made
+        self.lastReedSwitchUpdate = time.time() # When the last reed switch in the move in progress changed
+        self.lastReedSwitchCheck = None # (lastReedSwitchUpdate, check delays passed) when getMoveFromReedSwitches was last tried, so it's only tried again when its answer can change
+        self.moveInference = MoveInference(ChessInterface.getOccupancyBitboard, MOVE_VALIDITY_THRESHOLD, engine=self.stockfish) # Works out the move in progress from the reed switch changes
+        self.moveInference.setPosition(self.board)
+        self.physicalBoard.setExpectedOccupancy(ChessInterface.getOccupancyBitboard(self.board)) # Assume the pieces start where the virtual board has them
         self.lastMoveTime = time.time()
         self.movesSinceLastHome = 0
         self.gameEnded = False
@@ -259,26 +258,33 @@ class ChessInterface:
                 yield PhysicalBoard.getSquareFromFileRank(fileRank)
             distance += 1
 
+    def __getBankFillCount(self, color, type):
+        # Number of pieces of the given type in the bank (every piece that isn't on the board), or None if there are too many on the board
+        symbol = chess.Piece(type, color).symbol()
+        filled = NUM_PIECES[symbol] - len(self.board.pieces(type, color))
+        if (filled < 0 or filled > len(BANK_FILL_ORDER[symbol])):
+            return None
+        return filled
+
     def __getEmptyBankSquare(self, color, type):
-        # Loop through the bank fill order to find the first empty square of the given type
+        # First empty square of the given type in the bank fill order
         symbol = chess.Piece(type, color).symbol()
-        position = ChessInterface.getBoardPositionDict(self.board)
-        for square in BANK_FILL_ORDER[symbol]:
-            if (position[square] == None):
-                return square
-        return None
+        filled = self.__getBankFillCount(color, type)
+        if (filled is None or filled == len(BANK_FILL_ORDER[symbol])):
+            return None
+        return BANK_FILL_ORDER[symbol][filled]
     
     def __getFilledBankSquare(self, color, type):
-        # Loop backwards through the bank fill order to find the most recently filled square of the given type
+        # Most recently filled square of the given type in the bank fill order
         symbol = chess.Piece(type, color).symbol()
-        position = ChessInterface.getBoardPositionDict(self.board)
-        for square in reversed(BANK_FILL_ORDER[symbol]):
-            if (position[square] != None):
-                return square
-        return None
-
-    def __movePhysical(self, extendedMove, sendCommand=True, useStack=True):
-        # Move the piece on the physical board
+        filled = self.__getBankFillCount(color, type)
+        if (filled is None or filled == 0):
+            return None
+        return BANK_FILL_ORDER[symbol][filled - 1]
+
+    def __movePhysical(self, extendedMove, sendCommand=True, useStack=True, occupiedSquares=None):
+        # Move the piece on the physical board. Returns a Future resolved once the Arduino finishes (see PhysicalBoard.movePiece).
+        # occupiedSquares: Set of squares with pieces before this move. If given, the piece is routed around them and the set is updated.
         if (useStack):
             self.physicalMoveStack.append(extendedMove) # Push the move to the move stack
 
@@ -288,9 +294,15 @@ class ChessInterface:
         direct = extendedMove[1]
 
         print("MOVING PIECE: " + start + " -> " + end + " (direct: " + str(direct) + ")")
+        future = PhysicalBoard.completedFuture()
         if (sendCommand):
-            self.physicalBoard.movePiece(start, end, direct=direct)
+            future = self.physicalBoard.movePiece(start, end, direct=direct, occupiedSquares=occupiedSquares)
             self.movesSinceLastHome += 1
+
+        if (occupiedSquares is not None):
+            occupiedSquares.discard(start)
+            occupiedSquares.add(end)
+        return future
     
     def __undoPhysical(self, sendCommand=True, useStack=True):
         # Undo the move on the physical board
@@ -303,6 +315,7 @@ class ChessInterface:
     def undoLastMove(self, sendCommands=True):
         # Undo the last move on the virtual board
         self.board.pop()
+        self.moveInference.setPosition(self.board)
         
         # Undo the last move on the physical board
         self.stackLengthAfterMove.pop() # Remove last item without looking at it (unneeded)
@@ -313,6 +326,8 @@ class ChessInterface:
             self.__undoPhysical(sendCommand=sendCommands)
 
     def move(self, move, checkLegal=True, sendCommands=True):
+        # Returns False if the move can't be made. Otherwise returns a Future, resolved once the physical board has made it
+        # (see PhysicalBoard.combineFutures). Cancelling it stops the physical move, but the virtual board still has it.
         if (checkLegal and move not in self.board.legal_moves):
             print("Illegal move: " + move.uci() + ".")
             return False
@@ -393,18 +408,25 @@ class ChessInterface:
             if self.enableSound:
                 self.audio.playSound("move")
         
+        # Squares with pieces before the move, for routing pieces around each other
+        occupiedSquares = ChessInterface.getOccupiedSquares(ChessInterface.getBoardPositionDict(self.board))
+
         # Move the piece on the virtual board
         self.board.push(move)
+        self.moveInference.setPosition(self.board)
 
         if (self.enableSound):
             if (self.board.is_check()):
                 self.audio.playSound("check")
 
-        # Move the piece on the physical board
+        # Move the piece on the physical board, in whichever order gets it done fastest
+        physicalMoves = MoveScheduler.orderMoves(physicalMoves, self.physicalBoard.finalDestinationFileRank)
+        futures = []
         for physicalMove in physicalMoves:
-            self.__movePhysical(physicalMove, sendCommand=sendCommands)
+            futures.append(self.__movePhysical(physicalMove, sendCommand=sendCommands, occupiedSquares=occupiedSquares))
         self.stackLengthAfterMove.append(len(self.physicalMoveStack))
-        return True
+        self.physicalMoveFuture = PhysicalBoard.combineFutures(futures)
+        return self.physicalMoveFuture
     
     def checkDirectPath(self, start, end):
         # Check if there is a direct, empty path between two squares. DOES NOT CHECK START AND END SQUARES.
@@ -460,170 +482,33 @@ class ChessInterface:
             return False
     
     def updatePhysicalMoveInProgress(self):
-        # Update the physical move in progress
-        modifiedReedSwitches = self.physicalBoard.getModifiedReedSwitches()
-
-        for square, state in modifiedReedSwitches:
-            self.reedSwitchStateChanges.append((square, state))
-
-    def getMoveFromReedSwitches(self, allowIllegalMoves=False):
-        # Get the move from the reed switches. Returns None if no move is detected.
+        # Adds the reed switch changes since the last call to the physical move in progress. Returns True if there were any.
+        (events, self.reedSwitchCursor, lostCount) = self.physicalBoard.readReedSwitchEvents(self.reedSwitchCursor)
+        if (lostCount > 0):
+            print("WARNING: Missed " + str(lostCount) + " reed switch change(s), the move in progress might not be recognized.")
+
+        updated = False
+        for event in events:
+            if (event.timestamp < self.reedSwitchesIgnoredBefore):
+                continue
+            self.reedSwitchStateChanges.append((event.square, event.state))
+            self.moveInference.addChange(event.square, event.state)
+            self.lastReedSwitchUpdate = event.timestamp
+            updated = True
+        return updated
+
+    def clearReedSwitchChanges(self):
+        # Forget the physical move in progress, and ignore every reed switch change up to now
+        self.reedSwitchCursor = self.physicalBoard.getReedSwitchEventCursor()
+        self.reedSwitchStateChanges.clear()
+        self.moveInference.clear()
+        self.reedSwitchesIgnoredBefore = time.time()
+        self.lastReedSwitchCheck = None
+
+    def getMoveFromReedSwitches(self):
+        # Get the move from the reed switches. Returns None if no legal move matches (yet).
         self.updatePhysicalMoveInProgress()
-        
-        originalStates = {}
-        tempCurrentState = {}
-
-        finalStateChanges = {}
-        finallyUnmodified = {} # Squares that changed, then changed back to their original state (captured piece?)
-        order = [] # Order of squares these updates happened
-        increasedTotal = 0 # +1 for each square filled, -1 for each square emptied, should be 0 after a complete move
-
-        # Populate the lists above
-        for (square, state) in self.reedSwitchStateChanges:
-            tempCurrentState[square] = state
-            increasedTotal += 1 if state else -1
-            if (square not in originalStates): # Get original state of square if we haven't seen it yet
-                originalStates[square] = not state
-            
-            if (square not in order): # Get correct order of modified squares
-                order.append(square)
-            else:
-                order.remove(square) # Remove from the list if it's already in there
-                order.append(square)
-        
-        for square in order:
-            if (tempCurrentState[square] == originalStates[square]):
-                finallyUnmodified[square] = tempCurrentState[square]
-            else:
-                finalStateChanges[square] = tempCurrentState[square]
-        
-        # Simple check for incomplete move (doesn't catch all cases)
-        if (increasedTotal != 0): # Pieces added or removed from the board (including bank)
-            return None
-        
-        # Count bank squares filled and removed
-        bankSquaresFilled = 0
-        bankSquaresRemoved = 0
-        for (square, state) in finalStateChanges.items():
-            if (square[0] in FILES_BANKS):
-                if (state == True):
-                    bankSquaresFilled += 1
-                else:
-                    bankSquaresRemoved += 1
-        allMovesInStandardBoard = bankSquaresFilled == 0 and bankSquaresRemoved == 0
-
-        physicalMoves = []
-
-        # ALL MOVES FULLY WITHIN STANDARD BOARD:
-        if (allMovesInStandardBoard):
-            # CASTLE: For a castle, in any order, the king must make a specific move, and either rook must make a specific move.
-            if (len(finalStateChanges) == 4):
-                if (finalStateChanges == WHITE_KINGSIDE_CASTLE_PHYSICAL):
-                    physicalMoves.append(('e1g1', True))
-                    physicalMoves.append(('h1f1', False))
-                elif (finalStateChanges == WHITE_QUEENSIDE_CASTLE_PHYSICAL):
-                    physicalMoves.append(('e1c1', True))
-                    physicalMoves.append(('a1d1', False))
-                elif (finalStateChanges == BLACK_KINGSIDE_CASTLE_PHYSICAL):
-                    physicalMoves.append(('e8g8', True))
-                    physicalMoves.append(('h8f8', False))
-                elif (finalStateChanges == BLACK_QUEENSIDE_CASTLE_PHYSICAL):
-                    physicalMoves.append(('e8c8', True))
-                    physicalMoves.append(('a8d8', False))
-            # NORMAL: For a normal move, the piece must move from one square to another, both on the standard board.
-            elif (len(finalStateChanges) == 2):
-                start = 'a1'
-                end = 'a1'
-                # find the start square (piece removed)
-                for square, state in finallyUnmodified.items():
-                    if (state == False):
-                        start = square
-                    if (state == True):
-                        end = square
-                
-                # Check for direct path
-                isDirectPath = self.checkDirectPath(start, end)
-                physicalMoves.append((start + end, isDirectPath))
-
-        # ALL MOVES INVOLVING BANK:
-        else:
-            # ONE BANK SQUARE FILLED:
-            if (bankSquaresFilled == 1):
-                # ONE BANK SQUARE FILLED, ONE BANK SQUARE EMPTIED
-                if (bankSquaresRemoved == 1):
-                    # PROMOTION: For a promotion, in any order, the pawn must move to the bank, and the promoted piece must move to the board.
-                    if (len(finalStateChanges) == 4):
-                        pawnStart = None
-                        promotionSquare = None
-                        filledBank = None
-                        emptiedBank = None
-
-                        for (square, state) in finallyUnmodified.items():
-                            if ((square[1] == '7' or square[1] == '2') and state == False):
-                                pawnStart = square
-                            if ((square[1] == '8' or square[1] == '1') and state == True):
-                                promotionSquare = square
-                            if (square[0] in FILES_BANKS and state == True):
-                                filledBank = square
-                            if (square[0] in FILES_BANKS and state == False):
-                                emptiedBank = square
-                        
-                        if (pawnStart != None and promotionSquare != None and filledBank != None and emptiedBank != None):
-                            physicalMoves.append((filledBank + promotionSquare, False))
-                            physicalMoves.append((pawnStart + emptiedBank, False))
-                
-                else:
-                    # EN PASSANT: For an en passant, in any order, the pawn must capture an empty square, and the opponent's pawn must move to the bank.
-                    if (len(finalStateChanges) == 4):
-                        for (pawn_start, pawn_end, captured_pawn) in ALL_EN_PASSANT_PHYSICAL:
-                            if (pawn_start in finalStateChanges and pawn_end in finalStateChanges and captured_pawn in finalStateChanges):
-                                if (finalStateChanges[pawn_start] == False and finalStateChanges[pawn_end] == True and finalStateChanges[captured_pawn] == False):
-                                    # Get the bank square from finalStateChanges
-                                    bankSquare = 'a1'
-                                    for square, state in finalStateChanges.items():
-                                        if (square[0] in FILES_BANKS):
-                                            bankSquare = square
-                                    
-                                    physicalMoves.append((pawn_start + pawn_end, True))
-                                    physicalMoves.append((captured_pawn + bankSquare, False))
-                    
-                    # CAPTURE: For a capture, the capturing piece must move to the captured piece's square, and the captured piece must move to the bank.
-                    # Alternatively, the capturing piece might dissapear and the captured piece might appear in the bank. In that case, use legal moves to find out what happened.
-                    if (len(finalStateChanges) == 2):
-                        start = 'a1'
-                        bank = 'w1'
-                        for square, state in finalStateChanges.items():
-                            if (state == False):
-                                start = square
-                            if (state == True):
-                                bank = square
-                        
-                        capturingPiece = self.board.piece_at(chess.SQUARE_NAMES.index(start)).symbol()
-                        capturedPiece = BANK_PIECE_TYPES[bank]
-
-                        # Get legal captures that begin with the start square and capture the captured piece type
-                        legalMoves = self.board.legal_moves
-                        legalCapturesFromStart = []
-                        for move in legalMoves:
-                            if (move.from_square == chess.SQUARE_NAMES.index(start) and self.board.piece_at(move.to_square).symbol() == capturedPiece):
-                                legalCapturesFromStart.append(move)
-                        
-                        mostLikelyMove = None
-                        if (len(legalCapturesFromStart) >= 1): # Multiple legal captures matching these piece types, use unmodified squares as a tiebreaker
-                            for move in legalCapturesFromStart:
-                                toSquareName = chess.square_name(move.to_square)
-                                if (toSquareName in finallyUnmodified):
-                                    if (finallyUnmodified[toSquareName] == True): # The square was briefly unfilled, so it's likely the captured piece
-                                        mostLikelyMove = move
-                                        break
-                            if (mostLikelyMove == None): # No squares were briefly unfilled, so just pick arbitrarily
-                                mostLikelyMove = legalCapturesFromStart[0]
-                        elif (len(legalCapturesFromStart) == 1):
-                            mostLikelyMove = legalCapturesFromStart[0]
-                        
-                        if (mostLikelyMove != None):
-                            physicalMoves.append((chess.square_name(mostLikelyMove.to_square) + bank, False))
-                            physicalMoves.append((start + chess.square_name(mostLikelyMove.to_square), capturingPiece != chess.KNIGHT))
+        return self.moveInference.decide(time.time() - self.lastReedSwitchUpdate)
 
     @staticmethod
     def getBoardPositionDict(board, printErrors=True):
@@ -658,6 +543,28 @@ class ChessInterface:
         
         return position
 
+    @staticmethod
+    def getOccupancyBitboard(board):
+        # Bitboard (see Bitboard.py) of every square on the extended board that should have a piece, including the bank.
+        # Same squares as getBoardPositionDict, without building the dict. Returns None if the position can't be put in the bank.
+        occupancy = 0
+        for square in chess.SquareSet(board.occupied):
+            occupancy |= 1 << Bitboard.fileRankIndex((chess.square_file(square), chess.square_rank(square) + 1))
+        for (symbol, fillBitboards) in BANK_FILL_BITBOARDS.items():
+            piece = chess.Piece.from_symbol(symbol)
+            filled = NUM_PIECES[symbol] - len(board.pieces(piece.piece_type, piece.color))
+            if (filled < 0 or filled >= len(fillBitboards)):
+                return None
+            occupancy |= fillBitboards[filled]
+        return occupancy
+
+    @staticmethod
+    def getOccupiedSquares(position):
+        # Set of squares that have a piece on them, from a position dict (see getBoardPositionDict)
+        if (position is None):
+            return None
+        return {square for (square, piece) in position.items() if piece is not None}
+
     def physicalMovesPositionToPosition(self, oldPosition, newPosition):
         """
         Algorithm:
@@ -688,8 +595,8 @@ class ChessInterface:
         unresolvedStartSquares = []
         for square, piece in position.items(): 
             if (piece != None):
-                if (square in newPositionByPiece[piece]): # Piece is in the correct square
-                    position[square] = None
+                if (square in newPositionByPiece[piece]): # Piece is in the correct square, leave it there
+                    newPositionByPiece[piece].remove(square)
                 else: # Piece is in the wrong square
                     unresolvedStartSquares.append(square)
         
@@ -744,16 +651,20 @@ class ChessInterface:
                     return None
             
                 # Move the piece to the nearest empty square to it
-                position[nearestEmptySquare] = position[nearestFilledTarget]
+                relocatedPiece = position[nearestFilledTarget]
+                position[nearestEmptySquare] = relocatedPiece
                 position[nearestFilledTarget] = None
 
                 # Update unresolved start squares, to ensure the piece we just moved out of the way gets where it needs to go
                 if (nearestFilledTarget in unresolvedStartSquares):
                     unresolvedStartSquares.remove(nearestFilledTarget)
-                    unresolvedStartSquares.append(nearestEmptySquare)
+                    if (nearestEmptySquare in newPositionByPiece[relocatedPiece]): # Landed on one of its own targets
+                        newPositionByPiece[relocatedPiece].remove(nearestEmptySquare)
+                    else:
+                        unresolvedStartSquares.append(nearestEmptySquare)
 
-                # Update nearestUnfilledTarget
-                nearestUnfilledTarget = nearestEmptySquare
+                # The target is free now
+                nearestUnfilledTarget = nearestFilledTarget
                 
                 physicalMoves.append((nearestFilledTarget + nearestEmptySquare, False)) # Physical move
             
@@ -761,8 +672,9 @@ class ChessInterface:
             position[nearestUnfilledTarget] = position[nearestUnresolvedStartSquare]
             position[nearestUnresolvedStartSquare] = None
 
-            # Update unresolved start squares
+            # Update unresolved start squares and targets
             unresolvedStartSquares.remove(nearestUnresolvedStartSquare)
+            newPositionByPiece[position[nearestUnfilledTarget]].remove(nearestUnfilledTarget)
 
             physicalMoves.append((nearestUnresolvedStartSquare + nearestUnfilledTarget, False)) # Physical move
         
@@ -772,17 +684,12 @@ class ChessInterface:
         # Get current position from virtual board
         currentPosition = ChessInterface.getBoardPositionDict(self.board)
 
-        if errorCheckUsingReedSwitches:
+        if (errorCheckUsingReedSwitches and self.physicalBoard.reedSwitchesKnown): # Without reed switches (or before they're read), there's nothing to check against
             # Ensure the physical board matches the virtual board (reed switches)
-            missingSquares = []
-            extraSquares = []
-            for square in currentPosition.keys():
-                if (currentPosition[square] == None): # No piece, reed switch should be off
-                    if (self.physicalBoard.reedSwitches[square] == True):
-                        extraSquares.append(square)
-                else: # Piece, reed switch should be on
-                    if (self.physicalBoard.reedSwitches[square] == False):
-                        missingSquares.append(square)
+            expected = ChessInterface.getOccupancyBitboard(self.board)
+            reedSwitches = self.physicalBoard.reedSwitchBoard
+            missingSquares = list(Bitboard.squares(expected & ~reedSwitches)) # Piece, reed switch should be on
+            extraSquares = list(Bitboard.squares(reedSwitches & ~expected)) # No piece, reed switch should be off
             
             if (len(missingSquares) > len(extraSquares)):
                 print("Board is missing pieces!")
@@ -796,17 +703,22 @@ class ChessInterface:
             
             # Basic error correction for one missing and one extra square
             if (len(missingSquares) == 1 and len(extraSquares) == 1):
-                # In our virtual position, move the piece from the extra square to the missing square
-                currentPosition[missingSquares[0]] = currentPosition[extraSquares[0]]
-                currentPosition[extraSquares[0]] = None
+                # In our virtual position, move the piece from the missing square to the extra square, where it actually is
+                currentPosition[extraSquares[0]] = currentPosition[missingSquares[0]]
+                currentPosition[missingSquares[0]] = None
 
         self.board.set_fen(fen) # Set the virtual board position
+        self.moveInference.setPosition(self.board)
         newPosition = ChessInterface.getBoardPositionDict(self.board)
         physicalMoves = self.physicalMovesPositionToPosition(currentPosition, newPosition) # Physical moves to set the board position
+        physicalMoves = MoveScheduler.orderMoves(physicalMoves, self.physicalBoard.finalDestinationFileRank)
         
         # Make the physical moves
+        occupiedSquares = ChessInterface.getOccupiedSquares(currentPosition)
+        if (sendCommands):
+            self.physicalBoard.setExpectedOccupancy(Bitboard.fromSquares(occupiedSquares)) # Updated as each move finishes
         for move in physicalMoves:
-            self.__movePhysical(move, sendCommand=sendCommands, useStack=False)
+            self.__movePhysical(move, sendCommand=sendCommands, useStack=False, occupiedSquares=occupiedSquares)
     
     def resetBoard(self, sendCommands=True, errorCheckUsingReedSwitches=True):
         # Reset the board to the starting position
@@ -936,27 +848,38 @@ class ChessInterface:
             """
         elif (self.state == PLAYING_GAME):
             # Play the game
-            # self.updatePhysicalMoveInProgress()
-
-            """
-            # Handle moves
-            move = self.getMoveFromReedSwitches() # TODO: Don't do this if no reed switches have changed
-            if (move != None):
-                currentTime = time.time()
-                self.lastReedSwitchUpdate = currentTime
-                # Wait to ensure validity - e.g. someone sliding a bishop doesn't trigger a move until they leave it at the end square
-                if (currentTime - self.lastReedSwitchUpdate > MOVE_VALIDITY_THRESHOLD):
-                    self.move(move, sendCommands=False)
-            """
+            if (self.physicalMoveFuture.done() and self.physicalBoard.isAllCommandsFinished()):
+                # Handle human moves
+                self.updatePhysicalMoveInProgress()
+                # Wait to ensure validity - e.g. someone sliding a bishop doesn't trigger a move until they leave it at the end square.
+                # A move the switches make certain is taken after CONFIRM_TIME, anything else after MOVE_VALIDITY_THRESHOLD (see MoveInference.py).
+                quietTime = time.time() - self.lastReedSwitchUpdate
+                reedSwitchCheck = (self.lastReedSwitchUpdate, sum(1 for delay in self.moveInference.checkDelays if quietTime >= delay))
+                if (len(self.reedSwitchStateChanges) > 0 and reedSwitchCheck[1] > 0 and self.lastReedSwitchCheck != reedSwitchCheck):
+                    self.lastReedSwitchCheck = reedSwitchCheck
+                    move = self.getMoveFromReedSwitches()
+                    if (move != None):
+                        self.move(move, sendCommands=False)
+                        self.physicalBoard.setExpectedOccupancy(ChessInterface.getOccupancyBitboard(self.board))
+                        self.clearReedSwitchChanges()
+
+                # Put back pieces that ended up somewhere else (see ConsistencyMonitor.py)
+                repairs = self.physicalBoard.takeRepairPlan(ignore=self.moveInference.delta)
+                if (repairs is not None and len(repairs) > 0):
+                    print("Physical board doesn't match the virtual board, moving pieces back: " + ", ".join(start + end for (start, end) in repairs))
+                    occupiedSquares = set(Bitboard.squares(self.physicalBoard.reedSwitchBoard))
+                    for (start, end) in repairs:
+                        self.__movePhysical((start + end, False), sendCommand=sendCommands, useStack=False, occupiedSquares=occupiedSquares)
+            else:
+                self.clearReedSwitchChanges() # The robot is moving pieces
 
             # Stockfish move
             elo = self.whiteElo if self.board.turn == chess.WHITE else self.blackElo
             move = self.getEngineMove(elo=elo)
             if (move != None and move.uci() != "0000"):
-                if ((self.physicalBoard.isAllCommandsFinished() and time.time() - self.physicalBoard.firstAvailableTime > COMPUTER_MOVE_DELAY) or sendCommands == False):
+                if ((self.physicalMoveFuture.done() and self.physicalBoard.isAllCommandsFinished()) or sendCommands == False):
                     self.printBoard()
                     print("Engine move: " + move.uci())
-                    self.physicalBoard.firstAvailableTime += COMPUTER_MOVE_DELAY # Prevent moving again before physical board realizes there was a move
                     success = self.move(move, sendCommands=sendCommands)
                     if (not success):
                         legalMoves = self.board.legal_moves
@@ -987,7 +910,7 @@ class ChessInterface:
                     if (self.enableSound):
                         self.audio.playSound("gameend")
 
-                    self.physicalBoard.enqueueCommand('HPX0000Y0000')
+                    self.physicalBoard.enqueueCommand(HOME_COMMAND)
 
                 # Wait for the arduino to finish
                 if (self.physicalBoard.isAllCommandsFinished()):
@@ -1002,13 +925,12 @@ class ChessInterface:
     
     def goTo(self, x, y, magnetUp=False, home=True):
         # Debugging function to move the physical board to a specific location
-        homeCommand = 'HPX0000Y0000'
         command = self.physicalBoard.buildCommand(x, y, magnetUp, False)
         if (home):
-            self.physicalBoard.enqueueCommand(homeCommand)
-        self.physicalBoard.enqueueCommand(command)
-        while not self.physicalBoard.isAllCommandsFinished():
-            self.physicalBoard.update()
+            self.physicalBoard.enqueueCommand(HOME_COMMAND)
+        arrived = concurrent.futures.Future()
+        self.physicalBoard.enqueueCommand(command, onComplete=lambda finished: PhysicalBoard.resolveFuture(arrived, finished))
+        self.physicalBoard.waitFor(arrived)
     
     def goToSquare(self, square, magnetUp=False, home=True):
         # Debugging function to move the physical board to a specific square
@@ -1018,10 +940,8 @@ class ChessInterface:
     
     def debugMove(self, physicalMove, sendCommands=True):
         # Debugging function to move a piece on the physical board
-        self.__movePhysical(physicalMove, sendCommand=sendCommands, useStack=False)
-
-        while not self.physicalBoard.isAllCommandsFinished():
-            self.physicalBoard.update()
+        future = self.__movePhysical(physicalMove, sendCommand=sendCommands, useStack=False)
+        self.physicalBoard.waitFor(future)
 
     def loop(self, sendCommands=True):
         # Main loop
@@ -0,0 +1,136 @@
+"""
+CONSISTENCY MONITOR
+
+Watches for the physical board drifting away from where the pieces should be: a piece that slid off the magnet,
+got knocked onto another square, or was left behind by a cancelled move.
+
+EXPECTED OCCUPANCY
+A bitboard (see Bitboard.py) of every square that should have a piece, bank included. Set in full when the position
+is known (setExpected), then kept up to date one move at a time: when a piece move finishes, its start square is
+cleared and its end square set (movePiece).
+
+MISMATCH
+mismatch = expected ^ reed switches, updated with one XOR per telemetry frame. Only squares whose bits changed are
+looked at, so a frame where nothing happened costs almost nothing.
+
+    expected  ...#.....#..     # = should have a piece
+    switches  ...#......#.
+    mismatch  .........##.  -> one piece missing, one extra: the plan is to move it back
+
+While the robot is moving, mismatches are expected (a piece is off its start square until the move finishes), so
+nothing is reported. Once it's idle, the mismatch counts as drift when none of its switches have changed for MISMATCH_TIME.
+Switches that have been still since before the move finished (the piece never arrived) count on the first idle frame.
+A flickering switch, or a piece still settling onto its square, has to stay put first.
+
+REPAIR PLAN
+Each extra piece (switch on, expected empty) is moved to a missing square (expected piece, switch off), pairing them
+up so the total distance is as small as possible. Anything that can't be paired (a piece fell off the board) is only
+reported. Each drift is only planned once, so a broken switch can't make the robot repeat the same repair forever.
+
+Not thread safe by itself. PhysicalBoard only touches it while holding its lock.
+"""
+
+# Imports
+import math
+import itertools
+from Bitboard import Bitboard
+
+# Configuration
+MISMATCH_TIME = 0.1 # (in seconds) How long a switch must stay still before a mismatch on it counts as drift
+EXACT_REPAIR_MAX_PIECES = 6 # Largest number of pieces to pair up exactly. Time grows with n!.
+
+class ConsistencyMonitor:
+    def __init__(self, mismatchTime=MISMATCH_TIME):
+        self.mismatchTime = mismatchTime
+        self.expected = None # Expected occupancy bitboard, or None if it isn't known (nothing is checked)
+        self.switches = 0 # Reed switches from the last frame
+        self.mismatch = 0 # expected ^ switches
+        self.switchChangeTimes = {} # Bit index -> when its switch last changed
+        self.drift = 0 # The mismatch, as of the last idle frame where every mismatched switch had settled
+        self.reportedDrift = 0 # drift when takeRepairPlan last returned a plan
+
+    def setExpected(self, expected):
+        # Sets the whole expected occupancy (None to stop checking), and forgets any drift
+        self.expected = expected
+        self.mismatch = (expected ^ self.switches) if expected is not None else 0
+        self.drift = 0
+        self.reportedDrift = 0
+
+    def movePiece(self, start, end):
+        # A piece move finished: start is now empty and end has the piece
+        if (self.expected is None):
+            return
+        expected = (self.expected & ~Bitboard.bit(start)) | Bitboard.bit(end)
+        self.mismatch ^= self.expected ^ expected
+        self.expected = expected
+
+    def update(self, switches, timestamp, idle):
+        # Adds a telemetry frame. idle: The robot has nothing queued or moving, so the board should match.
+        changed = switches ^ self.switches
+        self.switches = switches
+        for index in Bitboard.indices(changed):
+            self.switchChangeTimes[index] = timestamp
+        if (self.expected is None):
+            return
+        self.mismatch ^= changed
+        if (not idle):
+            return # Keep the last drift, so a repair that didn't work isn't reported again
+
+        for index in Bitboard.indices(self.mismatch):
+            if (timestamp - self.switchChangeTimes.get(index, -math.inf) < self.mismatchTime):
+                return # Still settling. Wait for every square, so the repair plan sees where all the pieces ended up.
+        self.drift = self.mismatch
+
+    def getDrift(self):
+        # Returns (missing, extra): bitboards of squares that should have a piece but don't, and the other way around
+        return (self.drift & self.expected, self.drift & self.switches) if self.expected is not None else (0, 0)
+
+    def takeRepairPlan(self, ignore=0):
+        """
+        Returns a list of (start, end) piece moves that put the board back how it should be, once for each new drift.
+        Returns None if there's no new drift.
+        ignore: Bitboard of squares to leave alone (a human move in progress). Drift on them isn't counted as taken.
+        """
+        drift = self.drift & ~ignore
+        if (drift == self.reportedDrift & ~ignore):
+            return None
+        self.reportedDrift = drift
+        if (drift == 0):
+            return None
+
+        (missing, extra) = self.getDrift()
+        missing = list(Bitboard.indices(missing & ~ignore))
+        extra = list(Bitboard.indices(extra & ~ignore))
+        pairs = ConsistencyMonitor.pairSquares(extra, missing)
+        if (len(missing) > len(pairs)):
+            print("WARNING: Can't find the pieces for " + ", ".join(Bitboard.squareAt(index) for index in missing if index not in [end for (_, end) in pairs]) + ". Please put them back.")
+        if (len(extra) > len(pairs)):
+            print("WARNING: Unexpected pieces on " + ", ".join(Bitboard.squareAt(index) for index in extra if index not in [start for (start, _) in pairs]) + ". Please remove them.")
+        return [(Bitboard.squareAt(start), Bitboard.squareAt(end)) for (start, end) in pairs]
+
+    @staticmethod
+    def pairSquares(starts, ends):
+        # Pairs up as many starts (bit indices) with ends as possible, with the smallest total distance. Returns [(start, end)].
+        if (len(starts) > len(ends)):
+            return [(start, end) for (end, start) in ConsistencyMonitor.pairSquares(ends, starts)]
+        # Every start gets an end now
+        if (len(ends) <= EXACT_REPAIR_MAX_PIECES):
+            best = min(itertools.permutations(ends, len(starts)), key=lambda order: sum(ConsistencyMonitor.distance(start, end) for (start, end) in zip(starts, order)))
+            return list(zip(starts, best))
+
+        # Too many to try every pairing, take the closest pair each time
+        (starts, ends) = (list(starts), list(ends))
+        pairs = []
+        while (len(starts) > 0):
+            (start, end) = min(((start, end) for start in starts for end in ends), key=lambda pair: ConsistencyMonitor.distance(*pair))
+            pairs.append((start, end))
+            starts.remove(start)
+            ends.remove(end)
+        return pairs
+
+    @staticmethod
+    def distance(index1, index2):
+        # Distance between two squares (in squares)
+        (file1, rank1) = Bitboard.indexFileRank(index1)
+        (file2, rank2) = Bitboard.indexFileRank(index2)
+        return math.hypot(file1 - file2, rank1 - rank2)
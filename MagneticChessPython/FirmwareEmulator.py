@@ -0,0 +1,396 @@
+"""
+FIRMWARE EMULATOR
+
+Pretends to be an Arduino running chessMotors.ino, behind a pseudo-terminal, so PhysicalBoard (and everything
+above it) can run without any hardware:
+
+    emulator = FirmwareEmulator(speed=10)
+    emulator.start()
+    board = PhysicalBoard(port=emulator.port)
+
+Or from a terminal, then pass the printed port to PhysicalBoard:
+    python FirmwareEmulator.py [speed]
+
+
+WHAT IS EMULATED
+    - Binary frames (see Protocol.py): Command frames in, telemetry and log frames out.
+    - The Arduino's 64 byte serial receive buffer. Bytes that arrive while it's full are dropped, like on the real board.
+    - The command queue (QUEUE_SIZE slots). Frames are only read out of the receive buffer while the queue has room.
+    - CoreXY stepping: both motors move in a straight line (Bresenham), with the same speed ramp and step timing as
+      the firmware (MotionProfile.nextSpeed), including its own limit on each command's exit speed.
+    - Command execution every executionInterval, or right away when the current move finishes.
+    - Homing (blocking, no telemetry while it runs), and the idle state (motors and magnet off with an empty queue).
+    - The hello frame at startup (reporting queueSize), and resets (reset()) and USB disconnects (reopen()) in the middle of a game.
+
+Reed switches aren't scanned, they report whatever reedSwitchBoard is set to: only the columns that changed since the
+last telemetry frame, with a keyframe every KEYFRAME_INTERVAL frames (see REED SWITCH COLUMNS in Protocol.py).
+reedSwitchesEnabled=False emulates firmware built with REED_SWITCHES_ENABLED 0: every switch reads as off, and the
+hello and telemetry frames say they aren't scanned.
+Arcade buttons are not emulated.
+
+
+CLOCK
+The emulator keeps its own clock (in microseconds), and advances it one motor step at a time
+(or one motorIntervalMicros while the motors are stopped).
+speed: How many emulated seconds pass for each real second. 1 is real time. None runs as fast as possible.
+"""
+
+# Imports
+import os
+import sys
+import time
+import tty
+import select
+import threading
+import math
+import collections
+from MotionProfile import MotionProfile, START_SPEED, SPEED_FRACTION_BITS
+from Protocol import Protocol, Telemetry, Hello, SYNC_BYTE, PROTOCOL_VERSION, HEADER_SIZE, CRC_SIZE, FRAME_COMMAND, COMMAND_STRUCT, KEYFRAME_INTERVAL, ALL_REED_SWITCHES
+from PhysicalBoard import SERIAL_RX_BUFFER_SIZE, FIRMWARE_MOTOR_INTERVAL_MICROS, FIRMWARE_EXECUTION_INTERVAL_MS, FIRMWARE_HOME_STEP_MICROS, FIRMWARE_MAX_X, FIRMWARE_MAX_Y
+
+# Firmware configuration, copied from chessMotors.ino
+QUEUE_SIZE = 32
+TELEMETRY_INTERVAL_MICROS = 4000 # telemetryInterval
+EXECUTION_INTERVAL_MICROS = FIRMWARE_EXECUTION_INTERVAL_MS * 1000
+MAX_RX_PAYLOAD_SIZE = 16 # MAX_RX_PAYLOAD_LEN
+MAX_X = FIRMWARE_MAX_X
+MAX_Y = FIRMWARE_MAX_Y
+
+# Emulator configuration
+MAX_TICKS_PER_BATCH = 2000 # Motor steps to emulate before checking the pty again when running faster than real time
+IDLE_SLEEP = 0.0005 # (in seconds) How long to sleep when the emulated clock has caught up to real time
+
+class FirmwareEmulator:
+    def __init__(self, speed=1.0, queueSize=QUEUE_SIZE, reedSwitchesEnabled=True):
+        self.speed = speed
+        self.queueSize = queueSize
+        self.reedSwitchesEnabled = reedSwitchesEnabled
+
+        # Pseudo-terminal. PhysicalBoard opens the slave end (self.port), we read and write the master end.
+        self.masterFd = None
+        self.slaveFd = None
+        self.port = None
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock() # Held by the emulator thread while it runs, so reset() and reopen() happen between ticks
+        self.now = 0 # Emulated time, in microseconds since startup
+        self.motorTimer = 0 # When the next motor step (or check) happens
+        self.outgoing = bytearray() # Frames waiting to be written to the pty
+        self.reedSwitchBoard = 0 # Bitboard (see Bitboard.py) of reed switches that are on. Set it from outside to pretend pieces moved.
+
+        # Statistics, for benchmarks
+        self.commandsExecuted = 0
+        self.droppedBytes = 0 # Bytes that arrived while the receive buffer was full
+        self.idleMicros = 0 # Emulated time with the queue empty and the motors stopped
+
+        self.resetFirmwareState()
+
+    def resetFirmwareState(self):
+        # Everything the firmware loses when the Arduino resets
+        self.motorPosA = 0
+        self.motorPosB = 0
+        self.targetPosA = 0
+        self.targetPosB = 0
+        self.stopMotors()
+        self.motorsEnabled = False
+        self.magnetUp = False
+        self.optimizeRoute = False
+        self.commandQueue = collections.deque() # (Protocol.Command, sequence)
+        self.rxBuffer = bytearray() # Arduino's serial receive buffer
+        self.frameBuffer = bytearray() # Frame being read out of rxBuffer
+        self.receivedBytes = 0
+        self.lastCommandSequence = 0
+        self.lastStartedSequence = 0
+        self.lastFinishedSequence = 0
+        self.commandRunning = False
+        self.frameErrorCount = 0
+        self.telemetrySequence = 0
+        self.logSequence = 0
+        self.reedSwitchesSent = 0 # reedSwitchBoard as of the last telemetry frame
+        self.keyframeCountdown = 0 # Telemetry frames until the next keyframe (the first one is)
+        self.executionTimer = self.now
+        self.telemetryTimer = self.now
+        self.outgoing += Protocol.encodeHello(Hello(self.queueSize, SERIAL_RX_BUFFER_SIZE, self.reedSwitchesEnabled)) # The firmware homes in setup(), then says hello
+
+    def stopMotors(self):
+        self.speedFixed = START_SPEED << SPEED_FRACTION_BITS
+        (self.cruiseSpeed, self.exitSpeed, self.acceleration) = (START_SPEED, START_SPEED, 0) # Current command's profile
+        self.exitSpeedLimit = None # Exit speed limited for the next command, once it's worked out (see getExitSpeed)
+        self.stepsRemaining = 0 # Steps of the dominant motor left in the current command
+        (self.lineDistanceA, self.lineDistanceB) = (0, 0) # Current command's move, for Bresenham's line
+        (self.majorSteps, self.minorSteps, self.stepError) = (0, 0, 0)
+
+    def start(self):
+        # Open the pty and start the emulator thread. Returns the port path to connect to.
+        self.__openPty()
+        self.running = True
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        self.running = False
+        if (self.thread is not None):
+            self.thread.join()
+            self.thread = None
+        self.__closePty()
+
+    def reset(self):
+        # Like pressing the Arduino's reset button: The queue and counters are cleared, and it homes and says hello again.
+        with self.lock:
+            self.home()
+            self.resetFirmwareState()
+
+    def reopen(self):
+        # Like unplugging the USB cable and plugging it back in: Whoever has the port open gets an error,
+        # and the emulator shows up on a new port (returned). The firmware keeps running.
+        with self.lock:
+            self.__closePty()
+            self.__openPty()
+        return self.port
+
+    def __openPty(self):
+        (self.masterFd, self.slaveFd) = os.openpty()
+        tty.setraw(self.slaveFd) # Binary data, no echo or newline translation
+        os.set_blocking(self.masterFd, False)
+        self.port = os.ttyname(self.slaveFd)
+
+    def __closePty(self):
+        for fd in (self.masterFd, self.slaveFd):
+            if (fd is not None):
+                os.close(fd)
+        (self.masterFd, self.slaveFd) = (None, None)
+
+    def __run(self):
+        startTime = time.time()
+        startNow = self.now
+        while (self.running):
+            with self.lock:
+                ticks = self.__runBatch(startTime, startNow)
+            if (ticks <= 0):
+                time.sleep(IDLE_SLEEP)
+
+    def __runBatch(self, startTime, startNow):
+        # Emulate up to MAX_TICKS_PER_BATCH motor steps. Returns how many were emulated.
+        self.__readPty()
+
+        # Catch the emulated clock up to real time (scaled by speed)
+        target = math.inf if self.speed is None else startNow + (time.time() - startTime) * self.speed * 1000000
+        ticks = 0
+        while (ticks < MAX_TICKS_PER_BATCH and self.motorTimer <= target):
+            self.tick()
+            ticks += 1
+            if (len(self.outgoing) > 0 and self.speed is not None):
+                self.__writePty() # Send telemetry as soon as it's made, so it isn't bunched up
+
+        self.__writePty()
+        return ticks
+
+    def __readPty(self):
+        while (select.select([self.masterFd], [], [], 0)[0]):
+            try:
+                data = os.read(self.masterFd, 4096)
+            except OSError: # Other end closed
+                return
+            if (len(data) == 0):
+                return
+            self.receive(data)
+
+    def __writePty(self):
+        # Like a real serial port, anything nobody is reading is lost instead of holding up the firmware
+        if (len(self.outgoing) > 0):
+            try:
+                written = os.write(self.masterFd, bytes(self.outgoing))
+            except (BlockingIOError, OSError):
+                written = len(self.outgoing)
+            del self.outgoing[:written]
+
+    def receive(self, data):
+        # Bytes arriving over serial. The receive buffer keeps what fits and drops the rest.
+        room = SERIAL_RX_BUFFER_SIZE - len(self.rxBuffer)
+        if (len(data) > room):
+            self.droppedBytes += len(data) - room
+            print("Emulator: Serial receive buffer overflowed, dropped " + str(len(data) - room) + " bytes.")
+        self.rxBuffer += data[:max(0, room)]
+
+    def tick(self):
+        # One motor step of the firmware's main loop (or one motor interval while stopped)
+        self.now = self.motorTimer
+
+        # Step motors
+        if (self.stepsRemaining > 0):
+            self.speedFixed = MotionProfile.nextSpeed(self.speedFixed, self.stepsRemaining, self.cruiseSpeed, self.getExitSpeed(), self.acceleration)
+            self.__stepLine()
+            self.motorTimer += MotionProfile.getStepInterval(self.speedFixed)
+            if (self.stepsRemaining == 0): # Reached the target
+                self.__finishCommand()
+                if (len(self.commandQueue) > 0):
+                    self.__executeNextCommand() # Carry straight on at the exit speed
+                else:
+                    self.speedFixed = START_SPEED << SPEED_FRACTION_BITS
+        else:
+            self.__finishCommand()
+            if (len(self.commandQueue) > 0): # Finished, and there's another command, so execute it now
+                self.executionTimer = self.now
+            elif (not self.motorsEnabled):
+                self.idleMicros += FIRMWARE_MOTOR_INTERVAL_MICROS
+            self.motorTimer += FIRMWARE_MOTOR_INTERVAL_MICROS
+
+        if (self.now >= self.executionTimer):
+            self.__executionCheck()
+            self.executionTimer += EXECUTION_INTERVAL_MICROS
+
+        if (self.now >= self.telemetryTimer):
+            self.__sendTelemetry()
+            self.telemetryTimer += TELEMETRY_INTERVAL_MICROS
+
+        self.__readSerialFrames()
+
+    def __executionCheck(self):
+        if (len(self.commandQueue) > 0):
+            self.motorsEnabled = True
+            if (self.stepsRemaining == 0): # Moving commands start the next one themselves
+                self.__executeNextCommand()
+        elif (self.motorsEnabled and self.stepsRemaining == 0): # Idle
+            self.motorsEnabled = False
+            self.magnetUp = False
+
+    def __executeNextCommand(self):
+        (command, sequence) = self.commandQueue.popleft()
+        self.commandsExecuted += 1
+        self.__finishCommand() # Optimized commands finish when the next one starts
+        self.lastStartedSequence = sequence
+        self.commandRunning = True
+        if (command.home):
+            self.home()
+            self.__finishCommand()
+            return
+        if (not (0 <= command.x <= MAX_X and 0 <= command.y <= MAX_Y)):
+            self.sendLog("ERROR: Command to (" + str(command.x) + ", " + str(command.y) + ") is outside (0, 0) to (" + str(MAX_X) + ", " + str(MAX_Y) + "). Ignored.")
+            self.__finishCommand()
+            return
+        self.magnetUp = command.magnetUp
+        self.optimizeRoute = command.optimizeRoute
+        self.cruiseSpeed = max(command.cruiseSpeed, START_SPEED)
+        self.exitSpeed = max(command.exitSpeed, START_SPEED) if command.optimizeRoute else START_SPEED
+        self.acceleration = command.acceleration
+        self.exitSpeedLimit = None
+        self.targetPosA = -command.x - command.y
+        self.targetPosB = -command.x + command.y
+        self.__startLine(self.targetPosA - self.motorPosA, self.targetPosB - self.motorPosB)
+
+    def __startLine(self, distanceA, distanceB):
+        (self.lineDistanceA, self.lineDistanceB) = (distanceA, distanceB)
+        self.majorSteps = max(abs(distanceA), abs(distanceB))
+        self.minorSteps = min(abs(distanceA), abs(distanceB))
+        self.stepError = 0
+        self.stepsRemaining = self.majorSteps
+
+    def __stepLine(self):
+        # Same as stepLine in the firmware: the dominant motor always steps, the other one when it's half a step behind
+        stepMinor = False
+        self.stepError += self.minorSteps
+        if (2 * self.stepError >= self.majorSteps):
+            stepMinor = True
+            self.stepError -= self.majorSteps
+        majorIsA = abs(self.lineDistanceA) >= abs(self.lineDistanceB)
+        if (majorIsA or stepMinor):
+            self.motorPosA += 1 if self.lineDistanceA > 0 else -1
+        if (not majorIsA or stepMinor):
+            self.motorPosB += 1 if self.lineDistanceB > 0 else -1
+        self.stepsRemaining -= 1
+
+    def getExitSpeed(self):
+        # Same as getExitSpeed and limitExitSpeed in the firmware
+        if (len(self.commandQueue) == 0):
+            return START_SPEED # Nothing next yet, so plan to stop
+        if (self.exitSpeedLimit is None):
+            (nextCommand, _) = self.commandQueue[0]
+            if (nextCommand.home or not (0 <= nextCommand.x <= MAX_X and 0 <= nextCommand.y <= MAX_Y)):
+                self.exitSpeedLimit = START_SPEED
+            else:
+                (nextDistanceA, nextDistanceB) = (-nextCommand.x - nextCommand.y - self.targetPosA, -nextCommand.x + nextCommand.y - self.targetPosB)
+                limit = min(self.exitSpeed, max(nextCommand.cruiseSpeed, START_SPEED))
+                limit = min(limit, MotionProfile.getJunctionSpeed(self.lineDistanceA, self.lineDistanceB, nextDistanceA, nextDistanceB))
+                limit = min(limit, MotionProfile.getStoppingSpeed(MotionProfile.getSteps(nextDistanceA, nextDistanceB), nextCommand.acceleration))
+                self.exitSpeedLimit = max(limit, START_SPEED)
+        return self.exitSpeedLimit
+
+    def __finishCommand(self):
+        if (self.commandRunning):
+            self.lastFinishedSequence = self.lastStartedSequence
+            self.commandRunning = False
+
+    def home(self):
+        # Homing blocks the firmware: One axis at a time back to the limit switches, with no telemetry until it's done.
+        self.magnetUp = False
+        x = -(self.motorPosA + self.motorPosB) / 2
+        y = (self.motorPosB - self.motorPosA) / 2
+        self.now += int((abs(x) + abs(y)) * FIRMWARE_HOME_STEP_MICROS)
+        self.motorTimer = self.now
+        (self.motorPosA, self.motorPosB, self.targetPosA, self.targetPosB) = (0, 0, 0, 0)
+        self.stopMotors()
+
+    def __readSerialFrames(self):
+        # Same as readSerialFrames in the firmware: read bytes while the queue has room, one frame at a time
+        while (len(self.rxBuffer) > 0 and len(self.commandQueue) < self.queueSize):
+            byte = self.rxBuffer.pop(0)
+            self.receivedBytes = (self.receivedBytes + 1) % 65536
+
+            if (len(self.frameBuffer) == 0 and byte != SYNC_BYTE):
+                continue # Not the start of a frame
+            self.frameBuffer.append(byte)
+
+            if (len(self.frameBuffer) == HEADER_SIZE and (self.frameBuffer[1] != PROTOCOL_VERSION or self.frameBuffer[4] > MAX_RX_PAYLOAD_SIZE)):
+                self.frameErrorCount = (self.frameErrorCount + 1) % 256
+                self.frameBuffer.clear()
+            elif (len(self.frameBuffer) >= HEADER_SIZE and len(self.frameBuffer) == HEADER_SIZE + self.frameBuffer[4] + CRC_SIZE):
+                self.__handleFrame(bytes(self.frameBuffer))
+                self.frameBuffer.clear()
+
+    def __handleFrame(self, frame):
+        body = frame[1:-CRC_SIZE]
+        if (Protocol.crc16(body) != frame[-2] | (frame[-1] << 8)):
+            self.frameErrorCount = (self.frameErrorCount + 1) % 256
+            self.sendLog("ERROR: Received frame failed CRC check. Dropped.")
+            return
+        (frameType, sequence, payload) = (body[1], body[2], body[4:])
+        if (frameType == FRAME_COMMAND and len(payload) == COMMAND_STRUCT.size):
+            self.lastCommandSequence = sequence
+            self.commandQueue.append((Protocol.decodeCommand(payload), sequence))
+        else:
+            self.frameErrorCount = (self.frameErrorCount + 1) % 256
+            self.sendLog("ERROR: Received unknown frame type. Dropped.")
+
+    def __sendTelemetry(self):
+        keyframe = self.keyframeCountdown == 0
+        self.keyframeCountdown = KEYFRAME_INTERVAL - 1 if keyframe else self.keyframeCountdown - 1
+        reedSwitchBoard = self.reedSwitchBoard if self.reedSwitchesEnabled else 0
+        reedSwitchMask = ALL_REED_SWITCHES if keyframe else Protocol.getChangedColumns(self.reedSwitchesSent, reedSwitchBoard)
+        self.reedSwitchesSent = reedSwitchBoard
+        telemetry = Telemetry(self.motorsEnabled, len(self.commandQueue), self.queueSize - len(self.commandQueue), self.receivedBytes, len(self.rxBuffer), self.lastCommandSequence, self.frameErrorCount, self.lastStartedSequence, self.lastFinishedSequence, self.reedSwitchesEnabled, keyframe, reedSwitchMask, reedSwitchBoard & reedSwitchMask)
+        self.outgoing += Protocol.encodeTelemetry(telemetry, self.telemetrySequence)
+        self.telemetrySequence = (self.telemetrySequence + 1) % 256
+
+    def sendLog(self, message):
+        self.outgoing += Protocol.encodeLog(message, self.logSequence)
+        self.logSequence = (self.logSequence + 1) % 256
+
+    def getXY(self):
+        # Current magnet position in machine coordinates
+        return (-(self.motorPosA + self.motorPosB) / 2, (self.motorPosB - self.motorPosA) / 2)
+
+if __name__ == '__main__':
+    # Run an emulator until Ctrl+C. Optional argument: speed (see CLOCK above), or 'max' for as fast as possible.
+    speed = 1.0
+    if (len(sys.argv) > 1):
+        speed = None if sys.argv[1] == 'max' else float(sys.argv[1])
+    emulator = FirmwareEmulator(speed=speed)
+    port = emulator.start()
+    print("Emulating Arduino on " + port)
+    try:
+        while (True):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emulator.stop()
@@ -0,0 +1,209 @@
+"""
+MOTION PROFILE
+
+Plans how fast the motors run through each command, so moves can go faster than the speed a stepper can start at
+from rest. Every command becomes a trapezoid: accelerate from the speed it starts at, cruise, then decelerate to
+the speed it hands over to the next command.
+
+    speed
+      ^      _____________
+      |     /             \\           Cruise: cruiseSpeed
+      |    /               \\______    Exit: exitSpeed, the junction speed into the next command
+      |   /                       \\
+      |__/                         \\  START_SPEED: Safe to start or stop at instantly
+      +-----------------------------> steps
+         | command 1      | command 2 ('O', so no stop in between)
+
+All speeds are in steps per second of the dominant motor (the one with more steps to go). Both motors move in a
+straight line, so the other one runs proportionally slower.
+
+
+WHAT THE HOST PLANS (planProfiles)
+    - cruiseSpeed and acceleration: Lower while carrying a piece, so it doesn't slide off the magnet.
+    - exitSpeed: START_SPEED after precise ('P') commands and the last command. Between optimized ('O') commands,
+      as fast as both motors can change speed instantly (the junction speed), and no faster than the next command
+      can still stop from (in case nothing comes after it).
+
+WHAT THE FIRMWARE DOES (chessMotors.ino, mirrored by nextSpeed and FirmwareEmulator)
+Before each step, it picks a target speed and accelerates or decelerates towards it by acceleration / speed:
+    - exitSpeed, once it's close enough to the end that it needs to start slowing down.
+    - cruiseSpeed, otherwise.
+If the next command hasn't arrived yet, it plans to stop (exit at START_SPEED) instead. When the next command is
+there, it checks the junction speed and stopping distance itself too, so a plan made for a different next command
+(the queue changed after this one was sent) can't make the motors skip.
+
+Speeds are sent as multiples of SPEED_UNIT and ACCELERATION_UNIT (see Protocol.py), so they're rounded down
+here first, to plan with exactly what the firmware will use.
+"""
+
+# Imports
+import math
+import collections
+from Protocol import SPEED_UNIT, ACCELERATION_UNIT
+
+# Firmware motion, copied from chessMotors.ino
+START_SPEED = 1000000 // 600 # (in steps/s) startSpeed: Fastest the motors can start from rest (the old fixed motorIntervalMicros)
+SPEED_FRACTION_BITS = 4 # speedFixed: The current speed is kept in 1/16 steps/s, so small speed changes add up
+
+# Configuration (in steps/s and steps/s^2). Raise until the motors skip, then back off.
+MAX_SPEED = 4000 # Cruise speed with the magnet down
+MAX_SPEED_CARRYING = 3000 # Cruise speed with the magnet up (carrying a piece)
+ACCELERATION = 10000 # Acceleration with the magnet down
+ACCELERATION_CARRYING = 5000 # Acceleration with the magnet up, low enough that the piece keeps up with the magnet
+
+# One command's motion. Speeds are steps/s of the dominant motor, acceleration is steps/s^2.
+Profile = collections.namedtuple('Profile', ['cruiseSpeed', 'exitSpeed', 'acceleration'])
+DEFAULT_PROFILE = Profile(START_SPEED, START_SPEED, 0) # What the firmware does without a profile (constant speed)
+
+class MotionProfile:
+    @staticmethod
+    def quantizeSpeed(speed):
+        # The speed the firmware will actually use for one sent as speed (see Protocol.encodeCommand)
+        return max(START_SPEED, min(255, int(speed) // SPEED_UNIT) * SPEED_UNIT)
+
+    @staticmethod
+    def quantizeAcceleration(acceleration):
+        return min(255, int(acceleration) // ACCELERATION_UNIT) * ACCELERATION_UNIT
+
+    @staticmethod
+    def getSteps(deltaA, deltaB):
+        # Steps of the dominant motor
+        return max(abs(deltaA), abs(deltaB))
+
+    @staticmethod
+    def getJunctionSpeed(deltaA, deltaB, nextDeltaA, nextDeltaB):
+        """
+        Fastest speed to go from one straight move into the next without stopping. Each motor's speed is the dominant
+        speed times its share of the move (deltaA / steps), so at the junction it jumps by speed * (change in share).
+        No motor can jump by more than START_SPEED, the same as starting from rest.
+        Uses 1/256 fixed point shares, same as the firmware.
+        """
+        steps = MotionProfile.getSteps(deltaA, deltaB)
+        nextSteps = MotionProfile.getSteps(nextDeltaA, nextDeltaB)
+        if (steps == 0 or nextSteps == 0):
+            return START_SPEED
+        jumpA = abs(MotionProfile.__share(deltaA, steps) - MotionProfile.__share(nextDeltaA, nextSteps))
+        jumpB = abs(MotionProfile.__share(deltaB, steps) - MotionProfile.__share(nextDeltaB, nextSteps))
+        jump = max(jumpA, jumpB)
+        if (jump == 0): # Same direction, no limit
+            return math.inf
+        return START_SPEED * 256 // jump
+
+    @staticmethod
+    def __share(delta, steps):
+        # delta * 256 / steps, rounded towards zero like C integer division
+        share = abs(delta) * 256 // steps
+        return share if delta >= 0 else -share
+
+    @staticmethod
+    def getStoppingSpeed(steps, acceleration):
+        # Fastest speed that can still slow down to START_SPEED within steps (integerSqrt in the firmware)
+        return math.isqrt(START_SPEED * START_SPEED + 2 * acceleration * steps)
+
+    @staticmethod
+    def getLimits(magnetUp):
+        # (cruiseSpeed, acceleration) for a move with the magnet up or down
+        if (magnetUp):
+            return (MotionProfile.quantizeSpeed(MAX_SPEED_CARRYING), MotionProfile.quantizeAcceleration(ACCELERATION_CARRYING))
+        return (MotionProfile.quantizeSpeed(MAX_SPEED), MotionProfile.quantizeAcceleration(ACCELERATION))
+
+    @staticmethod
+    def planProfiles(moves):
+        """
+        Plans a Profile for each move, in order.
+
+        moves: List of (deltaA, deltaB, magnetUp, optimizeRoute) in motor steps, or None for a home command
+               (which stops, and gets DEFAULT_PROFILE).
+        The last move always ends at START_SPEED, since nothing is known about what comes after it.
+        """
+        profiles = []
+        for (index, move) in enumerate(moves):
+            if (move is None):
+                profiles.append(DEFAULT_PROFILE)
+                continue
+            (deltaA, deltaB, magnetUp, optimizeRoute) = move
+            (cruiseSpeed, acceleration) = MotionProfile.getLimits(magnetUp)
+
+            exitSpeed = START_SPEED
+            nextMove = moves[index + 1] if index + 1 < len(moves) else None
+            if (optimizeRoute and nextMove is not None):
+                (nextDeltaA, nextDeltaB, nextMagnetUp, _) = nextMove
+                (nextCruiseSpeed, nextAcceleration) = MotionProfile.getLimits(nextMagnetUp)
+                exitSpeed = min(
+                    cruiseSpeed,
+                    nextCruiseSpeed,
+                    MotionProfile.getJunctionSpeed(deltaA, deltaB, nextDeltaA, nextDeltaB),
+                    MotionProfile.getStoppingSpeed(MotionProfile.getSteps(nextDeltaA, nextDeltaB), nextAcceleration)
+                )
+                exitSpeed = MotionProfile.quantizeSpeed(exitSpeed)
+            profiles.append(Profile(cruiseSpeed, exitSpeed, acceleration))
+        return profiles
+
+    @staticmethod
+    def getSegmentTime(steps, entrySpeed, profile):
+        """
+        Returns (seconds, speed at the end) for one move of steps, starting at entrySpeed. Continuous approximation
+        of what the firmware does (see simulateSegment for the exact version), fast enough for planning.
+        """
+        (cruiseSpeed, exitSpeed, acceleration) = profile
+        if (steps == 0):
+            return (0, min(entrySpeed, exitSpeed))
+        if (acceleration == 0):
+            return (steps / cruiseSpeed, cruiseSpeed)
+
+        # Highest speed reached: cruise, or where accelerating from entry meets decelerating to exit (a triangle)
+        exitSpeed = min(exitSpeed, math.sqrt(entrySpeed * entrySpeed + 2 * acceleration * steps)) # Can't speed up faster than this
+        peakSpeed = math.sqrt((2 * acceleration * steps + entrySpeed * entrySpeed + exitSpeed * exitSpeed) / 2)
+        topSpeed = max(min(cruiseSpeed, peakSpeed), entrySpeed, exitSpeed)
+
+        accelerateSteps = (topSpeed * topSpeed - entrySpeed * entrySpeed) / (2 * acceleration)
+        decelerateSteps = (topSpeed * topSpeed - exitSpeed * exitSpeed) / (2 * acceleration)
+        cruiseSteps = max(0, steps - accelerateSteps - decelerateSteps)
+        seconds = (topSpeed - entrySpeed) / acceleration + (topSpeed - exitSpeed) / acceleration + cruiseSteps / topSpeed
+        return (seconds, exitSpeed)
+
+    @staticmethod
+    def nextSpeed(speedFixed, remainingSteps, cruiseSpeed, exitSpeed, acceleration):
+        """
+        The firmware's speed update before each step (updateSpeed in chessMotors.ino), with the same integer math.
+        speedFixed: Current speed in 1/16 steps/s. Returns the new one.
+        """
+        speed = speedFixed >> SPEED_FRACTION_BITS
+        if (speed * speed - exitSpeed * exitSpeed >= 2 * acceleration * remainingSteps):
+            targetSpeed = exitSpeed # Close enough to the end that we need to slow down
+        else:
+            targetSpeed = cruiseSpeed
+        change = (acceleration << SPEED_FRACTION_BITS) // speed
+        if (speed < targetSpeed):
+            speedFixed = min(speedFixed + change, targetSpeed << SPEED_FRACTION_BITS)
+        elif (speed > targetSpeed):
+            speedFixed = max(speedFixed - change, targetSpeed << SPEED_FRACTION_BITS)
+        return speedFixed
+
+    @staticmethod
+    def getStepInterval(speedFixed):
+        # Microseconds until the next step
+        return 1000000 // (speedFixed >> SPEED_FRACTION_BITS)
+
+    @staticmethod
+    def simulateSegment(steps, entrySpeed, profile):
+        # Step by step, exactly like the firmware. Returns (seconds, speed at the end).
+        (cruiseSpeed, exitSpeed, acceleration) = profile
+        speedFixed = entrySpeed << SPEED_FRACTION_BITS
+        micros = 0
+        for step in range(steps):
+            speedFixed = MotionProfile.nextSpeed(speedFixed, steps - step, cruiseSpeed, exitSpeed, acceleration)
+            micros += MotionProfile.getStepInterval(speedFixed)
+        return (micros / 1000000, speedFixed >> SPEED_FRACTION_BITS)
+
+if __name__ == '__main__':
+    # Compare the planner's estimates against step-by-step simulation, for a few moves
+    moves = [(-1500, 500, False, False), (-800, 0, True, True), (-400, -400, True, True), (-60, 0, True, False), (-3000, 3000, False, False)]
+    profiles = MotionProfile.planProfiles(moves)
+    (estimatedSpeed, simulatedSpeed) = (START_SPEED, START_SPEED)
+    for (move, profile) in zip(moves, profiles):
+        steps = MotionProfile.getSteps(move[0], move[1])
+        (estimated, estimatedSpeed) = MotionProfile.getSegmentTime(steps, estimatedSpeed, profile)
+        (simulated, simulatedSpeed) = MotionProfile.simulateSegment(steps, simulatedSpeed, profile)
+        constant = steps / START_SPEED
+        print(str(steps).rjust(5) + " steps " + str(profile) + ": estimated " + format(estimated, '.3f') + " s, simulated " + format(simulated, '.3f') + " s, constant speed " + format(constant, '.3f') + " s")
@@ -0,0 +1,185 @@
+"""
+MOVE INFERENCE
+
+Works out which legal move a human is making from noisy reed switch changes, and commits to it as soon as it's sure.
+
+MoveRecognizer.py looks the delta (squares changed an odd number of times) up, and only uses the squares touched along
+the way to break ties (Nxc7 and Nxa7 both empty b5 and put a pawn in the bank). One switch error means no move, and it
+always waits MOVE_VALIDITY_THRESHOLD. This scores every legal move on every square touched.
+
+
+LIKELIHOOD
+For each legal move, every square is expected to either:
+    - Change (its delta, from MoveRecognizer): should be changed an odd number of times. Anything else is a switch error.
+    - Be touched: the captured piece's square is emptied and filled again (even number of changes) for a capture.
+    - Maybe be brushed: squares a sliding piece passes over on its way, if it's dragged instead of lifted.
+    - Stay still: any other square. Touching one (hesitating, knocking a neighbour) is noise.
+The move's score is the log probability of the changes seen, with the chances of each below. Only squares that were
+touched, or that the move expects something on, differ from "nothing happened", so each move takes a handful of
+bitboard operations:
+
+    observed:   b5 emptied, c7 emptied and filled, z8 filled
+    b5xc7:      delta {b5, z8} matches, c7 touched (expected)          -> likely
+    b5xa7:      delta {b5, z8} matches, a7 not touched, c7 touched (noise) -> unlikely
+
+ENGINE PRIOR
+If the switches alone can't pick one move, and an engine is given, each move's score also gets its shallow engine
+evaluation (a human is more likely to play a good move). Evaluations are cached per position.
+
+COMMITTING
+decide(quietTime) returns the most likely move once:
+    - Its delta matches what was seen (the pieces are all down), and
+    - It's CONFIDENCE_THRESHOLD likely, and the switches have been quiet for CONFIRM_TIME, and no other move could
+      still be on its way (the rook moved first when castling looks like a rook move for now), and the captured
+      piece has been taken off (moving the capturing piece to the bank first already has the capture's delta), or
+    - The switches have been quiet for validityThreshold (MOVE_VALIDITY_THRESHOLD): the best guess is used.
+"""
+
+# Imports
+import math
+import chess
+import chess.engine
+from Bitboard import Bitboard
+from MoveRecognizer import MoveRecognizer
+
+# Configuration
+CONFIDENCE_THRESHOLD = 0.95 # Commit early once the most likely move is at least this likely
+CONFIRM_TIME = 0.3 # (in seconds) Quiet time before committing early. Shorter than a human pausing with a piece in hand.
+SWITCH_ERROR_CHANCE = 0.001 # Chance a square ends up changed when it shouldn't be, or the other way around
+CAPTURE_TOUCH_CHANCE = 0.95 # Chance the captured piece's square is seen empty for a moment
+SLIDE_TOUCH_CHANCE = 0.3 # Chance each square a sliding piece passes over is brushed
+NOISE_TOUCH_CHANCE = 0.02 # Chance any other square is touched and put back
+ENGINE_PRIOR_DEPTH = 2 # Search depth for the engine prior. Shallow, since it runs while the human waits.
+ENGINE_PRIOR_SCALE = 150 # (in centipawns) Evaluation difference that makes a move e times more likely
+ENGINE_PRIOR_CACHE_SIZE = 64 # Positions to keep engine evaluations for
+
+# Log likelihood of each case, relative to a square nothing was expected on and nothing happened on
+LOG_CHANGED = -math.log(1 - NOISE_TOUCH_CHANCE)
+LOG_SWITCH_ERROR = math.log(SWITCH_ERROR_CHANCE) - math.log(1 - NOISE_TOUCH_CHANCE)
+LOG_CAPTURE_TOUCHED = math.log(CAPTURE_TOUCH_CHANCE) - math.log(1 - NOISE_TOUCH_CHANCE)
+LOG_CAPTURE_UNTOUCHED = math.log(1 - CAPTURE_TOUCH_CHANCE) - math.log(1 - NOISE_TOUCH_CHANCE)
+LOG_SLIDE_TOUCHED = math.log(SLIDE_TOUCH_CHANCE) - math.log(1 - NOISE_TOUCH_CHANCE)
+LOG_SLIDE_UNTOUCHED = math.log(1 - SLIDE_TOUCH_CHANCE) - math.log(1 - NOISE_TOUCH_CHANCE)
+LOG_NOISE_TOUCHED = math.log(NOISE_TOUCH_CHANCE) - math.log(1 - NOISE_TOUCH_CHANCE)
+
+class MoveInference(MoveRecognizer):
+    def __init__(self, getOccupancy, validityThreshold=1, engine=None):
+        # engine: chess.engine.SimpleEngine for the prior, or None to treat every move as equally likely
+        super().__init__(getOccupancy, validityThreshold)
+        self.checkDelays = (CONFIRM_TIME, validityThreshold)
+        self.engine = engine
+        self.engineScores = {} # FEN -> {move: centipawns for the side to move}, oldest position first
+        self.board = None # Copy of the position (for the engine)
+        self.candidates = [] # (move, delta, captureSquare, slideSquares) bitboards for every legal move
+        self.probabilities = None # [(probability, candidate)], most likely first, or None if it needs working out again
+
+    def setPosition(self, board):
+        if (not super().setPosition(board)):
+            return False
+        self.board = board.copy(stack=False)
+        self.candidates = []
+        for (delta, moves) in self.table.items():
+            for move in moves:
+                self.candidates.append((move, delta) + MoveInference.getTouchSquares(board, move))
+        self.probabilities = None
+        return True
+
+    @staticmethod
+    def getTouchSquares(board, move):
+        # (captureSquare, slideSquares): Bitboards of the squares a move touches without changing them (see LIKELIHOOD above)
+        captureSquare = 0
+        if (board.is_capture(move) and not board.is_en_passant(move)):
+            captureSquare = Bitboard.bit(chess.square_name(move.to_square))
+        slideSquares = 0
+        if (board.piece_type_at(move.from_square) != chess.KNIGHT):
+            for square in chess.SquareSet.between(move.from_square, move.to_square):
+                slideSquares |= Bitboard.bit(chess.square_name(square))
+        return (captureSquare, slideSquares)
+
+    def addChange(self, square, state):
+        super().addChange(square, state)
+        self.probabilities = None
+
+    def clear(self):
+        super().clear()
+        self.probabilities = None
+
+    def getLogLikelihood(self, delta, captureSquare, slideSquares):
+        # Log probability of the changes so far if the human is making a move with this delta, relative to nothing happening
+        (changed, touched) = (self.delta, self.touched)
+        touchedBack = touched & ~changed # Changed an even number of times
+        expected = delta | captureSquare | slideSquares
+        return (Bitboard.popcount(delta & changed) * LOG_CHANGED
+            + Bitboard.popcount(delta ^ changed) * LOG_SWITCH_ERROR
+            + Bitboard.popcount(captureSquare & touchedBack) * LOG_CAPTURE_TOUCHED
+            + Bitboard.popcount(captureSquare & ~touched) * LOG_CAPTURE_UNTOUCHED
+            + Bitboard.popcount(slideSquares & touchedBack) * LOG_SLIDE_TOUCHED
+            + Bitboard.popcount(slideSquares & ~touched) * LOG_SLIDE_UNTOUCHED
+            + Bitboard.popcount(touchedBack & ~expected) * LOG_NOISE_TOUCHED)
+
+    def getProbabilities(self):
+        # [(probability, (move, delta, captureSquare, slideSquares))] for every legal move, most likely first
+        if (self.probabilities is not None):
+            return self.probabilities
+        scores = [(self.getLogLikelihood(*candidate[1:]), candidate) for candidate in self.candidates]
+        probabilities = MoveInference.normalize(scores)
+        if (self.engine is not None and len(probabilities) > 1 and probabilities[0][0] < CONFIDENCE_THRESHOLD):
+            # Not sure from the switches alone, ask the engine which moves make sense
+            engineScores = self.getEngineScores()
+            if (engineScores is not None and len(engineScores) > 0):
+                best = max(engineScores.values())
+                lowest = min(engineScores.values())
+                scores = [(score + (engineScores.get(candidate[0], lowest) - best) / ENGINE_PRIOR_SCALE, candidate) for (score, candidate) in scores]
+                probabilities = MoveInference.normalize(scores)
+        self.probabilities = probabilities
+        return probabilities
+
+    @staticmethod
+    def normalize(scores):
+        # [(log score, candidate)] -> [(probability, candidate)], most likely first
+        if (len(scores) == 0):
+            return []
+        highest = max(score for (score, _) in scores)
+        weights = [(math.exp(score - highest), candidate) for (score, candidate) in scores]
+        total = sum(weight for (weight, _) in weights)
+        return sorted(((weight / total, candidate) for (weight, candidate) in weights), key=lambda entry: entry[0], reverse=True)
+
+    def getEngineScores(self):
+        # {move: centipawns} for every legal move in the current position, from a shallow search. None if the engine fails.
+        if (self.positionKey in self.engineScores):
+            return self.engineScores[self.positionKey]
+        try:
+            infos = self.engine.analyse(self.board, chess.engine.Limit(depth=ENGINE_PRIOR_DEPTH), multipv=len(self.candidates))
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError) as e:
+            print("Engine prior failed: " + str(e))
+            return None
+        scores = {info['pv'][0]: info['score'].relative.score(mate_score=100000) for info in infos if 'pv' in info and 'score' in info}
+        if (len(self.engineScores) >= ENGINE_PRIOR_CACHE_SIZE):
+            del self.engineScores[next(iter(self.engineScores))]
+        self.engineScores[self.positionKey] = scores
+        return scores
+
+    def isStillPossible(self, delta, captureSquare):
+        # Whether the changes so far could be part of the way through a move with this delta
+        return (self.delta & ~(delta | captureSquare)) == 0 and (delta & ~self.delta) != 0
+
+    def decide(self, quietTime):
+        # The move in progress, or None if it isn't certain yet. quietTime: Seconds since the last change.
+        if (self.touched == 0 or quietTime < CONFIRM_TIME):
+            return None
+        probabilities = self.getProbabilities()
+        if (len(probabilities) == 0):
+            return None
+        (probability, (move, delta, captureSquare, _)) = probabilities[0]
+        if (delta != self.delta):
+            return None # The pieces aren't all down yet
+        if (quietTime >= self.validityThreshold):
+            if (probability < CONFIDENCE_THRESHOLD):
+                print("Reed switches most likely show " + move.uci() + " (" + format(probability * 100, '.0f') + "% sure).")
+            return move
+        if (probability < CONFIDENCE_THRESHOLD or (captureSquare & ~self.touched) != 0):
+            return None # Not sure, or the captured piece hasn't been taken off yet (its switch might just have missed it)
+        for (otherMove, otherDelta, captureSquare, _) in self.candidates:
+            if (otherMove != move and self.isStillPossible(otherDelta, captureSquare)):
+                return None # Could still turn into another move, wait the whole validityThreshold
+        return move
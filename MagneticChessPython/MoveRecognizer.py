@@ -0,0 +1,112 @@
+"""
+MOVE RECOGNIZER
+
+Works out which legal move a human made from the reed switches, with one dict lookup.
+
+DELTA SIGNATURES
+Every legal move changes the occupancy of a fixed set of squares on the extended board (see ChessInterface.getOccupancyBitboard),
+including the bank. XORing the occupancy before and after the move gives its delta: a bitboard with a bit set for
+every square that changed.
+
+    e2e4:          e2 emptied, e4 filled                       -> {e2, e4}
+    d4xe5:         d4 emptied, the captured pawn goes to the bank -> {d4, z8} (e5 is still filled)
+    e1g1 (castle): king and rook both move                     -> {e1, f1, g1, h1}
+    e7e8=Q:        pawn to the bank, queen from the bank       -> {e7, e8, w8, x8}
+
+The reed switches give the same thing for free: each switch change toggles one bit, so XORing every change in the
+move in progress gives the delta the human made, no matter what order the pieces were moved in or how many times
+a square changed along the way (a captured piece lifted and put back, a piece slid across the board).
+
+setPosition builds a table from delta to move once per position, so recognizing a move is just table[delta].
+
+TIES
+Two captures of the same kind of piece into the same bank square have the same delta (Nxc7 and Nxa7 both empty b5
+and fill z8). The captured piece's square is the one that was emptied and filled again, so of those moves, the one
+whose target square was touched without changing is taken. If that still doesn't pick one, there's no move.
+
+MOVE IN PROGRESS
+ChessInterface (and MoveReplay) feed each debounced switch change in with addChange, and ask decide(quietTime) for the
+move once the switches have been quiet for a while. Here that's a table lookup after validityThreshold.
+MoveInference.py has the same interface, and can decide sooner.
+"""
+
+# Imports
+import chess
+from Bitboard import Bitboard
+
+class MoveRecognizer:
+    def __init__(self, getOccupancy, validityThreshold=1):
+        # getOccupancy(board): Bitboard of every square that should have a piece, including the bank, or None if the
+        # position can't be put in the bank (ChessInterface.getOccupancyBitboard)
+        # validityThreshold: Time (in seconds) the switches must be quiet before decide() looks the move up (ChessInterface.MOVE_VALIDITY_THRESHOLD)
+        self.getOccupancy = getOccupancy
+        self.validityThreshold = validityThreshold
+        self.checkDelays = (validityThreshold,) # Quiet times (in seconds) where decide's answer can change
+        self.positionKey = None # Position the table was built for
+        self.occupancy = None # Occupancy of that position
+        self.table = {} # Delta bitboard -> list of legal moves that make it
+        self.delta = 0 # Squares whose switch changed an odd number of times in the move in progress
+        self.touched = 0 # Squares whose switch changed at all in the move in progress
+
+    def setPosition(self, board):
+        # Builds the table for board's position, if it isn't already built for it. Doesn't change board.
+        # Returns True if it was built.
+        positionKey = board.fen()
+        if (positionKey == self.positionKey):
+            return False
+        self.positionKey = positionKey
+        self.table = MoveRecognizer.buildTable(board, self.getOccupancy)
+        self.occupancy = self.getOccupancy(board)
+        return True
+
+    @staticmethod
+    def buildTable(board, getOccupancy):
+        # {delta: [moves]} for every legal move in board's position that can be made with the pieces in the bank
+        table = {}
+        before = getOccupancy(board)
+        if (before is None):
+            return table
+        board = board.copy(stack=False)
+        for move in board.legal_moves:
+            board.push(move)
+            after = getOccupancy(board)
+            board.pop()
+            if (after is None): # Promotion with no spare piece in the bank
+                continue
+            table.setdefault(before ^ after, []).append(move)
+        return table
+
+    def getMoves(self, delta):
+        # Every legal move that makes delta (usually zero or one)
+        return self.table.get(delta, [])
+
+    def getMove(self, delta):
+        # The legal move that makes delta, or None if there isn't exactly one (after breaking ties, see TIES above)
+        moves = self.table.get(delta)
+        if (moves is None):
+            return None
+        if (len(moves) > 1):
+            touchedBack = self.touched & ~delta # Changed an even number of times
+            capturedMoves = [move for move in moves if touchedBack & Bitboard.bit(chess.square_name(move.to_square))]
+            if (len(capturedMoves) == 1):
+                return capturedMoves[0]
+            print("Reed switches match " + str(len(moves)) + " moves: " + ", ".join(move.uci() for move in moves))
+            return None
+        return moves[0]
+
+    def addChange(self, square, state):
+        # One debounced reed switch change in the move in progress
+        bit = Bitboard.bit(square)
+        self.delta ^= bit
+        self.touched |= bit
+
+    def clear(self):
+        # Forget the move in progress
+        self.delta = 0
+        self.touched = 0
+
+    def decide(self, quietTime):
+        # The move in progress, or None if there isn't one (yet). quietTime: Seconds since the last change.
+        if (quietTime < self.validityThreshold):
+            return None
+        return self.getMove(self.delta)
@@ -0,0 +1,311 @@
+"""
+MOVE REPLAY
+
+Runs reed switch frames through the same steps a human move takes in ChessInterface, without the board or a human:
+
+    frames -> ReedSwitchEvents (debounce) -> MoveInference.addChange -> MoveInference.decide once the switches go quiet
+
+so debouncing and move recognition can be tuned, and checked against whole games, at the desk.
+
+
+REPLAY
+Frames come from a recorded trace (see ReedSwitchTrace.py) or the fuzzer below. Time jumps straight to the next thing
+that can happen (a frame, a switch settling, the switches going quiet for long enough), so a whole game replays in a
+fraction of a second. Pass a speed to play it out in real time (1) or faster instead.
+
+FUZZER
+synthesizeGame turns a PGN game into the frames a slightly clumsy human would make playing it, with the bank filled
+the same way as ChessInterface (getOccupancyBitboard):
+    - Pieces are picked up and put down in a random order (captured piece first or last, rook or king first, ...)
+    - Contact bounce on every switch change
+    - Sliding pieces brush over the squares in between on their way
+    - Sometimes a piece is picked up and put back before the real move
+    - The switches are only seen every FRAME_INTERVAL, like telemetry
+Moves are always followed by a pause longer than MOVE_VALIDITY_THRESHOLD, as if the other side was thinking.
+
+BENCHMARK
+    python MoveReplay.py games.pgn [seed] [recognizer]     Fuzz every game in the file, print accuracy and throughput
+    python MoveReplay.py game.trace [speed] [recognizer]   Replay a recorded trace from the starting position, print the moves
+recognizer is MoveInference (the default, same as ChessInterface) or MoveRecognizer (delta lookup only), to compare them.
+"""
+
+# Imports
+import sys
+import math
+import time
+import random
+import chess
+import chess.pgn
+from Bitboard import Bitboard
+from ReedSwitchEvents import ReedSwitchEvents, DEBOUNCE_TIME
+from ReedSwitchTrace import ReedSwitchTrace
+from MoveRecognizer import MoveRecognizer
+from MoveInference import MoveInference
+from ChessInterface import ChessInterface, MOVE_VALIDITY_THRESHOLD
+
+# Fuzzer configuration (all in seconds)
+FRAME_INTERVAL = 0.004 # Time between telemetry frames (telemetryInterval in chessMotors.ino)
+STEP_TIME = (0.15, 0.6) # Time between picking up or putting down one piece and the next
+MOVE_PAUSE = (MOVE_VALIDITY_THRESHOLD + 0.3, 4) # Time between one move's last piece going down and the next move starting
+BOUNCE_TIME = 0.006 # Contact bounce lasts up to this long after a switch changes
+MAX_BOUNCES = 3 # Most extra on/off pairs from contact bounce, per switch change
+SLIDE_PROBABILITY = 0.5 # Chance a sliding piece is dragged over the squares in between instead of lifted
+SLIDE_SQUARE_TIME = (0.03, 0.15) # How long a dragged piece spends over each square in between
+HESITATION_PROBABILITY = 0.1 # Chance of picking up a piece and putting it back before the real move
+HESITATION_TIME = (0.2, 1.5) # How long the hesitating piece is held
+
+RECOGNIZERS = {recognizerClass.__name__: recognizerClass for recognizerClass in (MoveInference, MoveRecognizer)} # Recognizers the benchmark can run
+
+class MoveReplay:
+    def __init__(self, board, recognizerClass=MoveInference, debounceTime=DEBOUNCE_TIME, validityThreshold=MOVE_VALIDITY_THRESHOLD):
+        # board: Position the frames start from (not changed). recognizerClass(getOccupancy, validityThreshold): MoveInference or MoveRecognizer.
+        self.board = board.copy()
+        self.events = ReedSwitchEvents(debounceTime=debounceTime)
+        self.recognizer = recognizerClass(ChessInterface.getOccupancyBitboard, validityThreshold=validityThreshold)
+        self.recognizer.setPosition(self.board)
+        self.debounceTime = debounceTime
+        self.cursor = 0 # Next event to read
+        self.ignoredBefore = -math.inf # Events from before the last recognized move are part of it
+        self.lastUpdate = None # Timestamp of the last event in the move in progress
+        self.checksDone = len(self.recognizer.checkDelays) # How many of the recognizer's checkDelays were tried since the last event
+        self.moves = [] # (timestamp, chess.Move) for every move recognized, in order
+        self.onMove = None # Called with (timestamp, move) as each move is recognized
+        self.frameCount = 0
+        self.checkCount = 0 # Times the recognizer was asked
+        self.checkSeconds = 0 # Time spent in the recognizer (wall clock)
+
+    def feed(self, switches, timestamp):
+        # One telemetry frame. Frames must be in order.
+        self.advance(timestamp)
+        self.frameCount += 1
+        self.events.update(switches, timestamp)
+        self.__readEvents()
+
+    def advance(self, until):
+        # Does everything that happens before until without a new frame: switches settling, moves becoming valid
+        while (True):
+            settleTime = min(self.events.changeTimes.values()) + self.debounceTime if len(self.events.changeTimes) > 0 else math.inf
+            checkTime = self.lastUpdate + self.recognizer.checkDelays[self.checksDone] if self.checksDone < len(self.recognizer.checkDelays) else math.inf
+            nextTime = min(settleTime, checkTime)
+            if (nextTime == math.inf or nextTime > until):
+                return
+            if (settleTime <= checkTime):
+                self.events.flush(settleTime + 1e-9) # Nudged past rounding, so it really has settled
+                self.__readEvents()
+            else:
+                self.__check(checkTime)
+
+    def finish(self):
+        # No more frames: let everything still pending happen
+        self.advance(math.inf)
+
+    def __readEvents(self):
+        # Same as ChessInterface.updatePhysicalMoveInProgress
+        (events, self.cursor, _) = self.events.read(self.cursor)
+        for event in events:
+            if (event.timestamp < self.ignoredBefore):
+                continue
+            self.recognizer.addChange(event.square, event.state)
+            self.lastUpdate = event.timestamp
+            self.checksDone = 0
+
+    def __check(self, timestamp):
+        # The switches have been quiet for one of the recognizer's checkDelays, same as ChessInterface.update
+        quietTime = self.recognizer.checkDelays[self.checksDone] # Not timestamp - lastUpdate, which can round to just under it
+        self.checksDone += 1
+        self.checkCount += 1
+        start = time.perf_counter()
+        move = self.recognizer.decide(quietTime)
+        self.checkSeconds += time.perf_counter() - start
+        if (move is None):
+            return
+        self.board.push(move)
+        self.recognizer.setPosition(self.board)
+        self.moves.append((timestamp, move))
+        self.recognizer.clear() # ChessInterface.clearReedSwitchChanges
+        self.ignoredBefore = timestamp
+        self.cursor = self.events.getCursor()
+        self.checksDone = len(self.recognizer.checkDelays)
+        if (self.onMove is not None):
+            self.onMove(timestamp, move)
+
+    @staticmethod
+    def replayFrames(frames, board, speed=None, onMove=None, **options):
+        # Runs [(timestamp, switches)] through a new MoveReplay and returns it. speed: None for as fast as possible, 1 for real time.
+        replay = MoveReplay(board, **options)
+        replay.onMove = onMove
+        if (len(frames) == 0):
+            return replay
+        (startTime, startWallTime) = (frames[0][0], time.time())
+        for (timestamp, switches) in frames:
+            if (speed is not None):
+                time.sleep(max(0, startWallTime + (timestamp - startTime) / speed - time.time()))
+            replay.feed(switches, timestamp)
+        replay.finish()
+        return replay
+
+    @staticmethod
+    def synthesizeMove(board, move, startTime, rng):
+        # Switch changes [(timestamp, square)] a human makes playing move on board, and when they're done.
+        # Raises ValueError if the move can't be made with the pieces in the bank.
+        before = ChessInterface.getOccupancyBitboard(board)
+        after = board.copy(stack=False)
+        after.push(move)
+        after = ChessInterface.getOccupancyBitboard(after)
+        if (before is None or after is None):
+            raise ValueError("Can't play " + move.uci() + " with the pieces in the bank.")
+
+        # Everything that gets picked up (off) and put down (on). A piece captured in place is picked up, then the capturing piece put down there.
+        offs = list(Bitboard.squares(before & ~after))
+        ons = list(Bitboard.squares(after & ~before))
+        captureSquare = chess.square_name(move.to_square) if board.is_capture(move) and not board.is_en_passant(move) else None
+        if (captureSquare is not None):
+            offs.append(captureSquare)
+            ons.append(captureSquare)
+
+        # Squares a dragged piece passes over on its way, nearest first
+        slideSquares = []
+        if (board.piece_type_at(move.from_square) != chess.KNIGHT and rng.random() < SLIDE_PROBABILITY):
+            between = [square for square in chess.SquareSet.between(move.from_square, move.to_square) if board.piece_at(square) is None]
+            slideSquares = [chess.square_name(square) for square in sorted(between, key=lambda square: chess.square_distance(square, move.from_square))]
+
+        toggles = []
+        timestamp = startTime
+        def toggle(square):
+            toggles.append((timestamp, square))
+            for _ in range(rng.randint(0, MAX_BOUNCES)): # Contact bounce: back and forth again, ending up changed
+                bounce = timestamp + rng.uniform(0, BOUNCE_TIME)
+                toggles.append((bounce, square))
+                toggles.append((bounce + rng.uniform(0, BOUNCE_TIME), square))
+
+        if (rng.random() < HESITATION_PROBABILITY):
+            square = chess.square_name(rng.choice(list(chess.SquareSet(board.occupied_co[board.turn]))))
+            toggle(square)
+            timestamp += rng.uniform(*HESITATION_TIME)
+            toggle(square)
+            timestamp += rng.uniform(*STEP_TIME)
+
+        # Pick up and put down in a random order, holding at most 2 pieces, never putting down on the capture square before clearing it
+        inHand = 0
+        while (len(offs) + len(ons) > 0):
+            choices = [('off', square) for square in offs if inHand < 2]
+            choices += [('on', square) for square in ons if inHand > 0 and not (square == captureSquare and captureSquare in offs)]
+            (action, square) = rng.choice(choices)
+            if (action == 'off'):
+                offs.remove(square)
+                inHand += 1
+            else:
+                ons.remove(square)
+                inHand -= 1
+                if (square == chess.square_name(move.to_square)):
+                    for slideSquare in slideSquares: # Dragged over the squares in between on the way here
+                        toggle(slideSquare)
+                        timestamp += rng.uniform(*SLIDE_SQUARE_TIME)
+                        toggle(slideSquare)
+                    slideSquares = []
+            toggle(square)
+            timestamp += rng.uniform(*STEP_TIME)
+        return (toggles, timestamp)
+
+    @staticmethod
+    def toggleFrames(startSwitches, toggles, startTime, endTime):
+        # Turns switch changes into the frames telemetry would show: the switches every FRAME_INTERVAL,
+        # keeping only frames where something changed, plus the first and last ones.
+        frames = [(startTime, startSwitches)]
+        switches = startSwitches
+        pending = 0 # Squares toggled since the last frame
+        frameIndex = 0
+        for (timestamp, square) in sorted(toggles):
+            index = math.ceil((timestamp - startTime) / FRAME_INTERVAL)
+            if (index != frameIndex and pending != 0):
+                switches ^= pending
+                frames.append((startTime + frameIndex * FRAME_INTERVAL, switches))
+                pending = 0
+            frameIndex = index
+            pending ^= Bitboard.bit(square)
+        if (pending != 0):
+            switches ^= pending
+            frames.append((startTime + frameIndex * FRAME_INTERVAL, switches))
+        if (endTime > frames[-1][0]):
+            frames.append((endTime, switches))
+        return frames
+
+    @staticmethod
+    def synthesizeGame(moves, rng, board=None, startTime=0.0):
+        # Frames for a human playing moves from board (the starting position by default).
+        # Returns (frames, moves played). Stops early at a move that can't be made with the pieces in the bank.
+        board = board.copy() if board is not None else chess.Board()
+        startSwitches = ChessInterface.getOccupancyBitboard(board)
+        toggles = []
+        played = []
+        timestamp = startTime + rng.uniform(*MOVE_PAUSE)
+        for move in moves:
+            try:
+                (moveToggles, timestamp) = MoveReplay.synthesizeMove(board, move, timestamp, rng)
+            except ValueError:
+                break
+            toggles += moveToggles
+            board.push(move)
+            played.append(move)
+            timestamp += rng.uniform(*MOVE_PAUSE)
+        return (MoveReplay.toggleFrames(startSwitches, toggles, startTime, timestamp), played)
+
+    @staticmethod
+    def benchmark(games, rng, **options):
+        """
+        Fuzzes every game (lists of chess.Move from the starting position) and replays it. Returns a dict of:
+            moves: Moves played. correct: Recognized in order before the first mistake. wrong: Games where a different move was recognized.
+            missed: Moves after the last one recognized that never were. accuracy: correct / moves.
+            frames, framesPerSecond: Replay throughput. microsPerCheck: Average time in the recognizer.
+        """
+        results = {'games': 0, 'moves': 0, 'correct': 0, 'wrong': 0, 'missed': 0, 'frames': 0, 'checks': 0}
+        (seconds, checkSeconds) = (0, 0)
+        for moves in games:
+            (frames, played) = MoveReplay.synthesizeGame(moves, rng)
+            start = time.perf_counter()
+            replay = MoveReplay.replayFrames(frames, chess.Board(), **options)
+            seconds += time.perf_counter() - start
+
+            recognized = [move for (_, move) in replay.moves]
+            correct = 0
+            while (correct < len(played) and correct < len(recognized) and played[correct] == recognized[correct]):
+                correct += 1
+            results['games'] += 1
+            results['moves'] += len(played)
+            results['correct'] += correct
+            results['wrong'] += 1 if correct < len(recognized) else 0
+            results['missed'] += len(played) - correct if correct == len(recognized) else 0
+            results['frames'] += replay.frameCount
+            results['checks'] += replay.checkCount
+            checkSeconds += replay.checkSeconds
+        results['accuracy'] = results['correct'] / max(1, results['moves'])
+        results['framesPerSecond'] = results['frames'] / seconds if seconds > 0 else math.inf
+        results['microsPerCheck'] = checkSeconds / max(1, results['checks']) * 1000000
+        return results
+
+if __name__ == '__main__':
+    if (len(sys.argv) < 2):
+        print("Usage: python MoveReplay.py games.pgn [seed] [recognizer] | game.trace [speed] [recognizer]")
+        sys.exit(1)
+    path = sys.argv[1]
+    recognizerClass = RECOGNIZERS.get(sys.argv[3] if len(sys.argv) > 3 else MoveInference.__name__)
+    if (recognizerClass is None):
+        print("Unknown recognizer, use one of: " + ", ".join(RECOGNIZERS))
+        sys.exit(1)
+    if (path.endswith('.pgn')):
+        games = []
+        with open(path) as file:
+            game = chess.pgn.read_game(file)
+            while (game is not None):
+                games.append(list(game.mainline_moves()))
+                game = chess.pgn.read_game(file)
+        seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+        results = MoveReplay.benchmark(games, random.Random(seed), recognizerClass=recognizerClass)
+        print("Recognizer: " + recognizerClass.__name__ + ", debounce " + str(DEBOUNCE_TIME) + " s, validity threshold " + str(MOVE_VALIDITY_THRESHOLD) + " s, seed " + str(seed))
+        print(str(results['correct']) + "/" + str(results['moves']) + " moves recognized (" + format(results['accuracy'] * 100, '.1f') + "%) in " + str(results['games']) + " games, " + str(results['wrong']) + " wrong, " + str(results['missed']) + " missed")
+        print(format(results['framesPerSecond'], '.0f') + " frames/s, " + format(results['microsPerCheck'], '.1f') + " us per recognizer check")
+    else:
+        speed = float(sys.argv[2]) if len(sys.argv) > 2 else None
+        frames = ReedSwitchTrace.read(path)
+        replay = MoveReplay.replayFrames(frames, chess.Board(), speed=speed, recognizerClass=recognizerClass, onMove=lambda timestamp, move: print(format(timestamp - frames[0][0], '.2f') + " s: " + move.uci()))
+        print(str(len(replay.moves)) + " moves from " + str(len(frames)) + " frames.")
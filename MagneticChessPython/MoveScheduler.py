@@ -0,0 +1,183 @@
+"""
+MOVE SCHEDULER
+
+Picks the order to execute a set of physical moves in, so the magnet spends as little time as possible
+travelling without a piece.
+
+Physical moves are (extendedMove, direct) tuples, like ('e2e4', True) or ('d8y8', False), as used by ChessInterface.
+
+DEPENDENCIES
+Two moves that touch the same square (start, end, or a square a direct move passes through) keep their original order.
+For example, a captured piece must be moved to the bank before the capturing piece lands on its square:
+    ('d5z8', False) must happen before ('e4d5', True)
+Moves that don't share any squares can happen in any order.
+
+ALGORITHM
+    - Small sets (up to EXACT_SCHEDULE_MAX_MOVES): Exact dynamic programming over every valid order (Held-Karp).
+    - Large sets (full board resets): Nearest valid move first, then improved with 2-opt (reversing runs of moves) until
+      no reversal helps.
+"""
+
+# Imports
+from PhysicalBoard import PhysicalBoard
+
+# Configuration
+EXACT_SCHEDULE_MAX_MOVES = 8 # Largest number of moves to schedule exactly. Time grows with 2^n * n^2.
+MAX_TWO_OPT_PASSES = 20 # Stop improving after this many passes over every pair, even if still improving.
+
+class MoveScheduler:
+    @staticmethod
+    def getTouchedSquares(physicalMove):
+        # All squares a physical move depends on: start, end, and everything a direct move passes over.
+        (extendedMove, direct) = physicalMove
+        start = extendedMove[0:2]
+        end = extendedMove[2:4]
+        touched = {start, end}
+        if (direct):
+            startFileRank = PhysicalBoard.getFileRankCoords(start)
+            endFileRank = PhysicalBoard.getFileRankCoords(end)
+            for fileRank in PhysicalBoard.getSquaresCrossed(startFileRank, endFileRank):
+                if (PhysicalBoard.checkInBounds(fileRank)):
+                    touched.add(PhysicalBoard.getSquareFromFileRank(fileRank))
+        return touched
+
+    @staticmethod
+    def getPrerequisites(physicalMoves):
+        # For each move, the set of move indices that must happen before it.
+        touchedSquares = [MoveScheduler.getTouchedSquares(physicalMove) for physicalMove in physicalMoves]
+        prerequisites = []
+        for i in range(len(physicalMoves)):
+            prerequisites.append({j for j in range(i) if not touchedSquares[i].isdisjoint(touchedSquares[j])})
+        return prerequisites
+
+    @staticmethod
+    def travelCost(fromFileRank, toFileRank):
+        # Time (in seconds) for the magnet to move between two points
+        return PhysicalBoard.estimateTravelTime(fromFileRank, toFileRank)
+
+    @staticmethod
+    def getEmptyTravel(physicalMoves, magnetFileRank):
+        # Total time (in seconds) the magnet travels without a piece, executing moves in the given order.
+        total = 0
+        position = magnetFileRank
+        for (extendedMove, _) in physicalMoves:
+            total += MoveScheduler.travelCost(position, PhysicalBoard.getFileRankCoords(extendedMove[0:2]))
+            position = PhysicalBoard.getFileRankCoords(extendedMove[2:4])
+        return total
+
+    @staticmethod
+    def orderMoves(physicalMoves, magnetFileRank):
+        """
+        Returns physicalMoves in the order that minimizes empty magnet travel, starting from magnetFileRank,
+        without breaking any dependencies between them. The original order is assumed to be valid.
+        """
+        if (physicalMoves is None or len(physicalMoves) <= 1):
+            return physicalMoves
+
+        prerequisites = MoveScheduler.getPrerequisites(physicalMoves)
+        starts = [PhysicalBoard.getFileRankCoords(extendedMove[0:2]) for (extendedMove, _) in physicalMoves]
+        ends = [PhysicalBoard.getFileRankCoords(extendedMove[2:4]) for (extendedMove, _) in physicalMoves]
+
+        # Cost from the end of move i (or the magnet, at index n) to the start of move j
+        n = len(physicalMoves)
+        costs = [[MoveScheduler.travelCost(ends[i], starts[j]) for j in range(n)] for i in range(n)]
+        costs.append([MoveScheduler.travelCost(magnetFileRank, starts[j]) for j in range(n)])
+
+        if (n <= EXACT_SCHEDULE_MAX_MOVES):
+            order = MoveScheduler.__orderExact(costs, prerequisites)
+        else:
+            order = MoveScheduler.__orderNearestNeighbor(costs, prerequisites)
+            order = MoveScheduler.__improveTwoOpt(order, costs, prerequisites)
+
+        return [physicalMoves[i] for i in order]
+
+    @staticmethod
+    def __orderCost(order, costs):
+        total = 0
+        previous = len(order) # Magnet
+        for i in order:
+            total += costs[previous][i]
+            previous = i
+        return total
+
+    @staticmethod
+    def __isValidOrder(order, prerequisites):
+        position = {}
+        for (index, move) in enumerate(order):
+            position[move] = index
+        for move in order:
+            for prerequisite in prerequisites[move]:
+                if (position[prerequisite] > position[move]):
+                    return False
+        return True
+
+    @staticmethod
+    def __orderExact(costs, prerequisites):
+        # Held-Karp: best[(doneMask, last)] = (cost, previous last) for every valid set of finished moves.
+        n = len(prerequisites)
+        prerequisiteMasks = [sum(1 << j for j in prerequisites[i]) for i in range(n)]
+        best = {(0, n): (0, None)} # Nothing done yet, magnet is at its start position (index n)
+        layer = [(0, n)]
+        for _ in range(n):
+            nextLayer = {}
+            for (mask, last) in layer:
+                (cost, _) = best[(mask, last)]
+                for move in range(n):
+                    if (mask & (1 << move) or (prerequisiteMasks[move] & ~mask)):
+                        continue # Already done, or waiting on another move
+                    state = (mask | (1 << move), move)
+                    newCost = cost + costs[last][move]
+                    if (state not in best or newCost < best[state][0]):
+                        best[state] = (newCost, last)
+                        nextLayer[state] = True
+            layer = list(nextLayer.keys())
+
+        # Pick the cheapest finished state and walk back through it
+        fullMask = (1 << n) - 1
+        (_, last) = min((best[state][0], state[1]) for state in layer if state[0] == fullMask)
+        order = []
+        mask = fullMask
+        while (last != n):
+            order.append(last)
+            previous = best[(mask, last)][1]
+            mask &= ~(1 << last)
+            last = previous
+        order.reverse()
+        return order
+
+    @staticmethod
+    def __orderNearestNeighbor(costs, prerequisites):
+        # Repeatedly do the closest move whose prerequisites are all finished.
+        n = len(prerequisites)
+        done = set()
+        order = []
+        last = n
+        while (len(order) < n):
+            nearest = None
+            for move in range(n):
+                if (move in done or not prerequisites[move].issubset(done)):
+                    continue
+                if (nearest is None or costs[last][move] < costs[last][nearest]):
+                    nearest = move
+            order.append(nearest)
+            done.add(nearest)
+            last = nearest
+        return order
+
+    @staticmethod
+    def __improveTwoOpt(order, costs, prerequisites):
+        # Reverse runs of moves whenever that shortens the trip and keeps every dependency intact.
+        bestCost = MoveScheduler.__orderCost(order, costs)
+        for _ in range(MAX_TWO_OPT_PASSES):
+            improved = False
+            for i in range(len(order) - 1):
+                for j in range(i + 1, len(order)):
+                    candidate = order[:i] + order[i:j+1][::-1] + order[j+1:]
+                    candidateCost = MoveScheduler.__orderCost(candidate, costs)
+                    if (candidateCost < bestCost and MoveScheduler.__isValidOrder(candidate, prerequisites)):
+                        order = candidate
+                        bestCost = candidateCost
+                        improved = True
+            if (not improved):
+                break
+        return order
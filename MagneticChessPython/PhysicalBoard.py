@@ -35,8 +35,25 @@ WINDOWS = 2 # Windows OS
 import os
 current_os = WINDOWS if (os.name == 'nt') else LINUX # Detect whether we're on Windows or Linux
 import time
+import json
+import heapq
+import functools
+import collections
+import struct
+import threading
+import asyncio
+import concurrent.futures
+from types import MappingProxyType
 import serial
 import serial.tools.list_ports
+from Calibration import Calibration
+from Bitboard import Bitboard
+from RingBuffer import RingBuffer
+from Protocol import Protocol, FrameParser, Command, FRAME_TELEMETRY, FRAME_LOG, FRAME_HELLO, COMMAND_FRAME_SIZE
+from MotionProfile import MotionProfile, Profile, START_SPEED
+from ReedSwitchEvents import ReedSwitchEvents
+from ConsistencyMonitor import ConsistencyMonitor
+from ReedSwitchTrace import ReedSwitchTraceRecorder
 
 # Constants
 RANKS = "12345678"
@@ -47,7 +64,18 @@ FILES_BANKS = FILES_BANK1 + FILES_BANK2
 ALL_FILES = FILES_BANKS + FILES_STANDARD
 ALL_SQUARES = [file + rank for file in ALL_FILES for rank in RANKS]
 
-# Calibration values for advanced pathing
+# Every half-square step of the extended board, from the outer edges of the bank to the outer edges of the main board.
+# Square centers land on whole numbers, and corners/edge midpoints (used for pathing between squares) land on halves.
+HALF_STEP_FILES = [halfFile / 2 for halfFile in range(-11, 16)] # -5.5 to 7.5
+HALF_STEP_RANKS = [halfRank / 2 for halfRank in range(1, 18)] # 0.5 to 8.5
+
+# Lookup tables (filled in at the bottom of this file, once PhysicalBoard is defined)
+SQUARE_FILE_RANKS = {} # 'f2' -> (5, 2)
+FILE_RANK_SQUARES = {} # (5, 2) -> 'f2'
+CALIBRATION_TABLE = {} # (file, rank) -> (x, y), for every half-square step
+CALIBRATION = None # Fitted calibration model (see Calibration.py), loaded from the calibration file if there is one
+
+# Fallback calibration values, used for any region (bank or board) the calibration file doesn't cover
 # BANK ----------------------------------------
 # TOP LEFT CORNER: 157, 45
 BANK_TOP_LEFT_CORNER_X = 1870
@@ -84,6 +112,15 @@ BOARD_BOTTOM_RIGHT_CORNER_Y = 80
 
 SQUARE_SIZE = 227.5
 
+# Advanced pathing (see PhysicalBoard.getPathAdvanced)
+ROUTER_TURN_PENALTY = 0.5 # (in squares) Extra cost for each turn in a route, since every turn is another command.
+ROUTER_DIRECTIONS = [(stepFile, stepRank) for stepFile in (-1, 0, 1) for stepRank in (-1, 0, 1) if (stepFile, stepRank) != (0, 0)] # In half squares
+# Routes stay off the outer edges of the board (same as getPath), in half-square units
+ROUTER_MIN_HALF_FILE = -10 # File -5
+ROUTER_MAX_HALF_FILE = 14 # File 7
+ROUTER_MIN_HALF_RANK = 2 # Rank 1
+ROUTER_MAX_HALF_RANK = 16 # Rank 8
+
 SERIAL_BAUD = 115200
 LINUX_USB_INTERFACES = [
     '/dev/ttyUSB0',
@@ -92,29 +129,82 @@ LINUX_USB_INTERFACES = [
     '/dev/ttyUSB3'
 ]
 
-HOME_COMMAND = 'HPX0000Y0000' # Command to home the motors
+HOME_COMMAND = 'HPX0000Y00000' # Command to home the motors
+SERIAL_RX_BUFFER_SIZE = 64 # Arduino's serial receive buffer (in bytes). Commands waiting to be read by the firmware sit here.
+SERIAL_IN_BUFFER_SIZE = 4096 # (in bytes) Incoming serial data waiting to be parsed. About a second of telemetry.
+SERIAL_POLL_TIMEOUT = 0.002 # (in seconds) Longest the serial thread waits for incoming data before checking for commands to send
+SERIAL_PROBE_TIMEOUT = 4 # (in seconds) How long a port has to send a valid frame to count as the Arduino. Opening the port resets the Arduino, and it homes before it talks.
+SERIAL_RETRY_INTERVAL = 0.5 # (in seconds) Wait this long before searching again when no Arduino was found
+SERIAL_STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serial_state.json') # Remembers the port the Arduino was last found on
+DEBUG_SERIAL = False # Print every batch of commands as it's sent. Off by default, it runs on the serial thread several times per move and buries the warnings.
+PLANNER_LOOKAHEAD = 8 # Queued commands (not sent yet) to look at when planning the motion profiles of the ones being sent
+
+# Firmware constants, copied from chessMotors.ino (used to estimate how long commands take, and to keep them in reach)
+FIRMWARE_MOTOR_INTERVAL_MICROS = 600 # motorIntervalMicros: Time between motor steps at the start speed, and between checks while stopped. Moves speed up from there (see MotionProfile.py).
+FIRMWARE_EXECUTION_INTERVAL_MS = 50 # executionInterval: How often an idle Arduino checks for a new command
+FIRMWARE_HOME_STEP_MICROS = 10 + 600 # stepPulseMicros plus motorIntervalMicros, for each step while homing
+FIRMWARE_MAX_X = 6950 # maxX: Commands go from (0, 0) to (FIRMWARE_MAX_X, FIRMWARE_MAX_Y). The firmware ignores anything outside.
+FIRMWARE_MAX_Y = 11900 # maxY
+
+# Path cache (see PhysicalBoard.getPath and PhysicalBoard.getCommands)
+PATH_CACHE_SIZE = 4096 # Number of paths (and command lists) to remember. Least recently used ones are forgotten first.
+
+# Command optimizer (see PhysicalBoard.optimizeCommands)
+COLLINEAR_TOLERANCE = 3 # (in machine units) How far a waypoint can be off the line between its neighbors and still be merged away.
 
 class PhysicalBoard:
-    def __init__(self):
-        self.commandQueue = []
+    def __init__(self, threaded=True, port=None):
+        # threaded: Read and write serial on a background thread. If False, update() must be called regularly instead.
+        # port: Serial port to connect to (like '/dev/ttyUSB0', or a FirmwareEmulator's port). If None, search for the Arduino.
+        self.port = port
+        self.lock = threading.RLock() # Held while using the command queue, telemetry state, or serial buffers
+        self.threaded = threaded
+        self.serialThread = None
+        self.serialThreadRunning = False
+        self.commandQueue = collections.deque()
+        self.commandCallbacks = collections.deque() # List of onComplete functions for each command in commandQueue
+        self.inFlightCommands = collections.deque() # (sequence, command, callbacks) for each command sent that hasn't finished yet
         self.isArduinoBusy = False
-        self.firstAvailableTime = time.time()
         self.arduinoQueueCount = 0
         self.arduinoQueueAvailableCount = 0
-        self.serialInBuffer = ""
+        self.arduinoQueueCapacity = None # Command queue slots, from FRAME_HELLO (or telemetry, if we connected without a reset). Nothing is sent until we know.
+        self.arduinoReceiveBufferSize = SERIAL_RX_BUFFER_SIZE # Serial receive buffer (in bytes), from FRAME_HELLO
+        self.bytesSentCount = 0 # Bytes written to serial since connecting
+        self.arduinoReceivedBytes = 0 # Bytes the Arduino has read from serial since it started, from telemetry (wraps at 65536)
+        self.nextSequence = 1 # Sequence number of the next command frame (see Protocol.py)
+        self.lastTelemetry = None # Most recent Protocol.Telemetry
+        self.serialInRing = RingBuffer(SERIAL_IN_BUFFER_SIZE) # Raw bytes from serial
+        self.frameParser = FrameParser() # Splits incoming bytes into frames (see Protocol.py)
+        self.frameHandlers = [] # Functions called with every frame from the Arduino (see addFrameHandler)
         self.finalDestinationFileRank = (0, 1) # (file, rank) coordinates
-        self.__prevCheckReedSwitches = {}
-        self.reedSwitches = {}
+        self.lastSentCommand = None
+        self.lastFinishedCommand = None # Last command the Arduino finished (where the magnet is when it's idle)
+        self.awaitingResync = False # Set after a reconnect or reset, until telemetry shows which sent commands the Arduino really has
+        self.arduinoWasReset = False # The Arduino sent FRAME_HELLO after we'd already sent it commands
+        self.commandsSavedByOptimizer = 0
+        self.reedSwitchBoard = 0 # Bitboard (see Bitboard.py) of reed switches that are on, put together from telemetry
+        self.reedSwitchesEnabled = None # The Arduino scans the reed switches (from FRAME_HELLO or telemetry), None until it says. If not, they all read as off.
+        self.reedSwitchesKnown = False # The reed switches are scanned and a keyframe has arrived since connecting, so every column of reedSwitchBoard is filled in
+        self.reedSwitchesStale = False # Telemetry frames were lost since the last keyframe, so some columns might be out of date
+        self.lastTelemetrySequence = None # SEQUENCE of the last telemetry frame (see Protocol.py), to spot lost ones
+        self.__reedSwitchView = (0, MappingProxyType(Bitboard.toDict(0))) # (bitboard, dict view of it) for reedSwitches
+        self.reedSwitchEvents = ReedSwitchEvents() # Debounced, timestamped reed switch changes (see readReedSwitchEvents)
+        self.consistencyMonitor = ConsistencyMonitor() # Checks the reed switches against where the pieces should be (see setExpectedOccupancy)
+        self.traceRecorder = None # Records the reed switches to a file while set (see startTrace)
         self.arcadeButtons = [False, False, False, False, False, False] # 6 arcade switches
-        for fileRank in ALL_SQUARES:
-            self.__prevCheckReedSwitches[fileRank] = False
-            self.reedSwitches[fileRank] = False
 
         self.arduino = self.beginSerial()
+        if (self.threaded):
+            self.startSerialThread()
         self.home() # Home motors after connecting
 
     @staticmethod
     def getFileRankCoords(square):
+        # Fast path: precomputed for every valid square
+        fileRank = SQUARE_FILE_RANKS.get(square) if isinstance(square, str) else None
+        if (fileRank is not None):
+            return fileRank
+
         # Error checking
         if (not isinstance(square, str)):
             print("square '" + str(square) + "' is not a string")
@@ -167,6 +257,11 @@ class PhysicalBoard:
 
     @staticmethod
     def getSquareFromFileRank(fileRank):
+        # Fast path: precomputed for every valid square
+        square = FILE_RANK_SQUARES.get(fileRank)
+        if (square is not None):
+            return square
+
         (file, rank) = fileRank
         if (not PhysicalBoard.checkInBounds((file, rank), printErrors=True)):
             print("Invalid file/rank '" + str(file) + "', '" + str(rank) + "'")
@@ -194,8 +289,50 @@ class PhysicalBoard:
 
     @staticmethod
     def getXY(square): # Takes input like 'f2' or 'w6' and returns xy coordinates
-        (file, rank) = PhysicalBoard.getFileRankCoords(square)
-        return PhysicalBoard.getDistortedXYFromFileRank((file, rank))
+        return PhysicalBoard.getCalibratedXYFromFileRank(PhysicalBoard.getFileRankCoords(square))
+
+    @staticmethod
+    def getCalibratedXYFromFileRank(fileRank):
+        # Returns integer machine coordinates for a (file, rank) point, using the calibration table when possible.
+        xy = CALIBRATION_TABLE.get(fileRank)
+        if (xy is None): # Not on the half-square lattice, calculate it the slow way
+            (x, y) = PhysicalBoard.computeXYFromFileRank(fileRank)
+            xy = (int(x), int(y))
+        return xy
+
+    @staticmethod
+    def computeXYFromFileRank(fileRank):
+        # Machine coordinates from the fitted calibration model, or from the fallback corner values if there isn't one.
+        if (CALIBRATION is not None):
+            xy = CALIBRATION.getXYFromFileRank(fileRank)
+            if (xy is not None):
+                return xy
+        return PhysicalBoard.getDistortedXYFromFileRank(fileRank)
+
+    @staticmethod
+    def buildCalibrationTable():
+        # Precomputes the machine coordinates of every square center, corner, and edge midpoint on the extended board.
+        # Returns a read-only mapping of (file, rank) -> (x, y).
+        table = {}
+        for file in HALF_STEP_FILES:
+            for rank in HALF_STEP_RANKS:
+                (x, y) = PhysicalBoard.computeXYFromFileRank((file, rank))
+                table[(file, rank)] = (int(x), int(y))
+        return MappingProxyType(table)
+
+    @staticmethod
+    def rebuildCalibrationTable():
+        # Call after changing calibration values so getXY() and getCommands() pick them up.
+        global CALIBRATION_TABLE
+        CALIBRATION_TABLE = PhysicalBoard.buildCalibrationTable()
+        PhysicalBoard.clearPathCache() # Cached commands have the old coordinates
+
+    @staticmethod
+    def setCalibration(calibration):
+        # Use a new fitted calibration model (or None for the fallback corner values) from now on.
+        global CALIBRATION
+        CALIBRATION = calibration
+        PhysicalBoard.rebuildCalibrationTable()
 
     @staticmethod
     def getXYFromFileRank(fileRankCoords):
@@ -214,13 +351,16 @@ class PhysicalBoard:
         return (int(x), int(y))
 
     @staticmethod
-    def getPath(start, end, direct=False, includeStart=True):
+    def getPath(start, end, direct=False, includeStart=True, occupiedSquares=None):
         """
         Gets a path from start to end that is garunteed not to cross any other squares (unless direct is True).
 
         start and end are in the form of 'f2' or 'w6'.
         direct: If True, the path will only include the start and end squares.
         includeStart: If True, the start square will be included in the path.
+        occupiedSquares: If given, use getPathAdvanced() to find a faster path around these squares.
+
+        Paths are cached (see PATH_CACHE_SIZE), keyed by the arguments and the set of occupied squares.
 
         Example path:
         + - + - + - + - + - +
@@ -231,6 +371,15 @@ class PhysicalBoard:
         :[S]:   :   :   :   :
         + - + - + - + - + - +
         """
+        occupancyKey = frozenset(occupiedSquares) if (occupiedSquares is not None and not direct) else None
+        return list(PhysicalBoard.__getPathCached(start, end, direct, includeStart, occupancyKey))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=PATH_CACHE_SIZE)
+    def __getPathCached(start, end, direct, includeStart, occupancyKey):
+        if (occupancyKey is not None):
+            return tuple(PhysicalBoard.getPathAdvanced(start, end, occupancyKey, includeStart=includeStart))
+
         path = [] # List of (file, rank) tuples
         (startFile, startRank) = PhysicalBoard.getFileRankCoords(start)
         (endFile, endRank) = PhysicalBoard.getFileRankCoords(end)
@@ -240,7 +389,7 @@ class PhysicalBoard:
         
         # Ensure start != end
         if (startFile == endFile and startRank == endRank):
-            return path
+            return tuple(path)
 
         if (direct):
             path.append((endFile, endRank))
@@ -293,7 +442,7 @@ class PhysicalBoard:
 
             # Add end
             path.append((endFile, endRank))
-        return path
+        return tuple(path)
     
     @staticmethod
     def getWeightedMidpoint(startXY, endXY, ratio=0.5):
@@ -339,66 +488,193 @@ class PhysicalBoard:
         return PhysicalBoard.getDistortedXY(relativeSquareCount, topLeftXY, topRightXY, bottomLeftXY, bottomRightXY, numFiles=numFiles, numRanks=8)
 
     @staticmethod
-    def getPathAdvanced(start, end, direct=False, includeStart=True):
+    def getSquaresCrossed(startFileRank, endFileRank):
+        # Returns the (file, rank) of every square whose interior the straight line from start to end passes through.
+        # Only touching an edge or corner doesn't count. Includes the squares under start and end, if they're inside one.
+        (startFile, startRank) = startFileRank
+        (endFile, endRank) = endFileRank
+        deltaFile = endFile - startFile
+        deltaRank = endRank - startRank
+
+        squares = []
+        for file in range(int(min(startFile, endFile) - 1), int(max(startFile, endFile) + 2)):
+            for rank in range(int(min(startRank, endRank) - 1), int(max(startRank, endRank) + 2)):
+                # Clip the line to the square (slab method), keeping track of where it enters and exits.
+                enter = 0.0
+                exit = 1.0
+                for (origin, delta, center) in ((startFile, deltaFile, file), (startRank, deltaRank, rank)):
+                    if (delta == 0):
+                        if not (center - 0.5 < origin < center + 0.5):
+                            exit = -1.0 # Parallel to this side and outside (or on the edge), never inside
+                    else:
+                        t0 = (center - 0.5 - origin) / delta
+                        t1 = (center + 0.5 - origin) / delta
+                        enter = max(enter, min(t0, t1))
+                        exit = min(exit, max(t0, t1))
+                if (exit - enter > 1e-9):
+                    squares.append((file, rank))
+        return squares
+
+    @staticmethod
+    def isLineClear(startFileRank, endFileRank, occupiedFileRanks):
+        # Whether the straight line from start to end avoids every occupied square (other than start and end).
+        for fileRank in PhysicalBoard.getSquaresCrossed(startFileRank, endFileRank):
+            if (fileRank in occupiedFileRanks and fileRank != startFileRank and fileRank != endFileRank):
+                return False
+        return True
+
+    @staticmethod
+    def getPathAdvanced(start, end, occupiedSquares, direct=False, includeStart=True):
         """
-        Gets a path from start to end that is garunteed not to cross any other squares (unless direct is True).
+        Gets the fastest path from start to end that doesn't carry the piece over any occupied square (unless direct is True).
+        Pieces may travel straight through empty squares, or along the lines between squares.
 
         start and end are in the form of 'f2' or 'w6'.
+        occupiedSquares: Collection of squares ('f2') that currently hold a piece. Start and end are ignored.
         direct: If True, the path will only include the start and end squares.
         includeStart: If True, the start square will be included in the path.
 
-        Example path:
+        The route is searched (A*) on a lattice of every square center, corner, and edge midpoint.
+        From any point, the magnet may step half a square in any of the 8 directions, as long as it doesn't enter an occupied square.
+        The cost of a step is its taxicab length, since CoreXY steps both motors at once (a diagonal takes as long as an L).
+        Every turn costs ROUTER_TURN_PENALTY extra, since each turn is another command to start and stop.
+
+        Example path (X = occupied):
         + - + - + - + - + - +
         :   :   :   :[E]:   :
-        + - + - + - 4 - + - +
-        :   :   :   ^   :   :
-        + - 1-->2-->3 - + - +
-        :[S]:   :   :   :   :
+        + - + - + - + - + - +
+        :   :   : X : ^ :   :
+        + - + - + - + / + - +
+        :[S]----------1 :   :
         + - + - + - + - + - +
         """
         path = []
-        (startFile, startRank) = PhysicalBoard.getFileRankCoords(start)
-        (endFile, endRank) = PhysicalBoard.getFileRankCoords(end)
+        startFileRank = PhysicalBoard.getFileRankCoords(start)
+        endFileRank = PhysicalBoard.getFileRankCoords(end)
 
         if (includeStart):
-            path.append((startFile, startRank))
-        
+            path.append(startFileRank)
+
         # Ensure start != end
-        if (startFile == endFile and startRank == endRank):
+        if (startFileRank == endFileRank):
             return path
 
-        if (direct):
-            path.append((endFile, endRank))
-        else:
-            # Waypoints are defined for every square corner (intersection) we hit.
-            waypoints = []
-            
-        
-    
+        occupiedFileRanks = set()
+        for square in occupiedSquares:
+            occupiedFileRanks.add(PhysicalBoard.getFileRankCoords(square))
+        occupiedFileRanks.discard(startFileRank)
+        occupiedFileRanks.discard(endFileRank)
+
+        # Straight line is always the fastest, if it's clear
+        if (direct or PhysicalBoard.isLineClear(startFileRank, endFileRank, occupiedFileRanks)):
+            path.append(endFileRank)
+            return path
+
+        # Search in half-square units, so every lattice point is an integer pair
+        startNode = (startFileRank[0] * 2, startFileRank[1] * 2)
+        endNode = (endFileRank[0] * 2, endFileRank[1] * 2)
+        def heuristic(node):
+            return (abs(node[0] - endNode[0]) + abs(node[1] - endNode[1])) / 2
+
+        # Open set entries: (estimated total cost, tiebreaker, cost so far, node, direction)
+        tiebreaker = 0
+        openSet = [(heuristic(startNode), tiebreaker, 0, startNode, None)]
+        bestCosts = {(startNode, None): 0}
+        cameFrom = {}
+        finalState = None
+        while (len(openSet) > 0):
+            (_, _, cost, node, direction) = heapq.heappop(openSet)
+            if (node == endNode):
+                finalState = (node, direction)
+                break
+            if (cost > bestCosts[(node, direction)]):
+                continue # Stale entry
+
+            for newDirection in ROUTER_DIRECTIONS:
+                (stepFile, stepRank) = newDirection
+                neighbor = (node[0] + stepFile, node[1] + stepRank)
+                if not (ROUTER_MIN_HALF_FILE <= neighbor[0] <= ROUTER_MAX_HALF_FILE and ROUTER_MIN_HALF_RANK <= neighbor[1] <= ROUTER_MAX_HALF_RANK):
+                    continue
+
+                # Which square does this step pass through? (in quarter-square units, lines between squares are at 4n+2)
+                midFile = node[0] * 2 + stepFile
+                midRank = node[1] * 2 + stepRank
+                if (midFile % 4 != 2 and midRank % 4 != 2): # Not running along a line, so we're inside a square
+                    if (((midFile + 1) // 4, (midRank + 1) // 4) in occupiedFileRanks):
+                        continue
+
+                newCost = cost + (abs(stepFile) + abs(stepRank)) / 2
+                if (direction is not None and newDirection != direction):
+                    newCost += ROUTER_TURN_PENALTY
+                state = (neighbor, newDirection)
+                if (newCost < bestCosts.get(state, float('inf'))):
+                    bestCosts[state] = newCost
+                    cameFrom[state] = (node, direction)
+                    tiebreaker += 1
+                    heapq.heappush(openSet, (newCost + heuristic(neighbor), tiebreaker, newCost, neighbor, newDirection))
+
+        if (finalState is None): # Shouldn't happen, the lines between squares are always open
+            print("No advanced path found from " + start + " to " + end + ", using default path.")
+            return PhysicalBoard.getPath(start, end, direct=False, includeStart=includeStart)
+
+        # Walk backwards, keeping only the points where we turn
+        waypoints = []
+        state = finalState
+        while (state in cameFrom):
+            previousState = cameFrom[state]
+            if (previousState[1] != state[1]): # Direction changed at the previous node
+                waypoints.append(previousState[0])
+            state = previousState
+        waypoints.pop() # Start node (always has a direction change from None)
+        waypoints.reverse()
+
+        for (halfFile, halfRank) in waypoints:
+            path.append((PhysicalBoard.halfUnitsToCoord(halfFile), PhysicalBoard.halfUnitsToCoord(halfRank)))
+        path.append(endFileRank)
+        return path
+
+    @staticmethod
+    def halfUnitsToCoord(halfUnits):
+        # 3 -> 1.5, 4 -> 2
+        return halfUnits // 2 if halfUnits % 2 == 0 else halfUnits / 2
+
+    @staticmethod
+    def clampToReach(x, y):
+        # (x, y), moved to the nearest point the firmware accepts if it's outside (0, 0) to (FIRMWARE_MAX_X, FIRMWARE_MAX_Y).
+        # Like a calibration that extrapolates past the edge. The firmware would ignore it, and it might not fit in a command frame.
+        if (not (0 <= x <= FIRMWARE_MAX_X and 0 <= y <= FIRMWARE_MAX_Y)):
+            print("WARNING: Command to move to X: " + str(x) + ", Y: " + str(y) + " is outside (0, 0) to (" + str(FIRMWARE_MAX_X) + ", " + str(FIRMWARE_MAX_Y) + "). Moving to the nearest point inside instead.")
+            x = min(max(x, 0), FIRMWARE_MAX_X)
+            y = min(max(y, 0), FIRMWARE_MAX_Y)
+        return (x, y)
+
     @staticmethod
     def buildCommand(x, y, magnetUp, optimizeRoute):
-        x = int(x)
-        y = int(y)
-        if x < 0 or x > 9999 or y < 0 or y > 9999:
-            print("Command to move to X: " + str(x) + ", Y: " + str(y) + " out of command size (positive, max 4 digits).")
-            exit()
+        (x, y) = PhysicalBoard.clampToReach(int(x), int(y))
 
         magnetChar = 'U' if magnetUp else 'D' # Up vs Down
         optimizeChar = 'O' if optimizeRoute else 'P' # Optimize vs Precise
-        splitCommand = [magnetChar, optimizeChar, 'X', str(x).zfill(4), 'Y', str(y).zfill(4)]
+        splitCommand = [magnetChar, optimizeChar, 'X', str(x).zfill(4), 'Y', str(y).zfill(5)]
         command = "".join(splitCommand)
 
         return command
 
     @staticmethod
-    def getCommands(start, end, direct=False, includeStart=True, useMagnetWithDirect=True):
-        path = PhysicalBoard.getPath(start, end, direct, includeStart)
+    def getCommands(start, end, direct=False, includeStart=True, useMagnetWithDirect=True, occupiedSquares=None):
+        # Commands to move a piece along getPath(). Cached the same way as paths.
+        occupancyKey = frozenset(occupiedSquares) if (occupiedSquares is not None and not direct) else None
+        return list(PhysicalBoard.__getCommandsCached(start, end, direct, includeStart, useMagnetWithDirect, occupancyKey))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=PATH_CACHE_SIZE)
+    def __getCommandsCached(start, end, direct, includeStart, useMagnetWithDirect, occupancyKey):
+        path = PhysicalBoard.getPath(start, end, direct, includeStart, occupiedSquares=occupancyKey)
         commands = []
 
         for pathIndex in range(len(path)):
             isFirstCommand = (pathIndex == 0)
             isLastCommand = (pathIndex + 1 == len(path))
-            (x, y) = PhysicalBoard.getDistortedXYFromFileRank(path[pathIndex])
+            (x, y) = PhysicalBoard.getCalibratedXYFromFileRank(path[pathIndex])
 
             if (direct):
                 commands.append(PhysicalBoard.buildCommand(x, y, magnetUp=((not isFirstCommand or not includeStart) and useMagnetWithDirect), optimizeRoute=False))
@@ -411,8 +687,181 @@ class PhysicalBoard:
             else:
                 commands.append(PhysicalBoard.buildCommand(x, y, magnetUp=True, optimizeRoute=True))
         
-        return commands
+        return tuple(commands)
+
+    @staticmethod
+    def getPathCacheInfo():
+        # Hits, misses, and size of the path and command caches
+        return {'paths': PhysicalBoard.__getPathCached.cache_info(), 'commands': PhysicalBoard.__getCommandsCached.cache_info()}
+
+    @staticmethod
+    def clearPathCache():
+        # Forget every cached path and command list. Must be called whenever the calibration changes.
+        PhysicalBoard.__getPathCached.cache_clear()
+        PhysicalBoard.__getCommandsCached.cache_clear()
     
+    @staticmethod
+    def parseCommand(command):
+        # Splits a command into [magnet/home character, magnetUp, optimizeRoute, x, y]
+        return [command[0], command[0] == 'U', command[1] == 'O', int(command[3:7]), int(command[8:])]
+
+    @staticmethod
+    def optimizeCommands(commands, previousCommand=None):
+        """
+        Removes commands that don't change what the machine does, before they take up space in the Arduino's queue.
+        Returns (optimizedCommands, number of commands removed). See optimizeCommandsWithCompletion for what's removed.
+        """
+        (optimizedCommands, _) = PhysicalBoard.optimizeCommandsWithCompletion(commands, previousCommand)
+        return (optimizedCommands, len(commands) - len(optimizedCommands))
+
+    @staticmethod
+    def optimizeCommandsWithCompletion(commands, previousCommand=None):
+        """
+        Removes commands that don't change what the machine does, before they take up space in the Arduino's queue.
+        Returns (optimizedCommands, completedBy), where completedBy[i] is the index in optimizedCommands of the command
+        that finishes what commands[i] did, or None if every command was removed (there was nothing to do).
+
+        previousCommand: The last command sent before these (if any), so we know where the magnet starts.
+
+        - Zero-length moves: A command to where the magnet already is does nothing, since the next command sets the
+          magnet when it starts anyway. (Kept if it's the last command and changes the magnet.)
+        - Approach moves: Several magnet-down moves in a row only need the last one, the magnet isn't carrying anything.
+        - Collinear waypoints: A waypoint in the middle of a straight line, with the same magnet state on both sides.
+        """
+        optimized = [] # Parsed commands
+        sources = [] # Index in commands of each optimized command
+        previous = PhysicalBoard.parseCommand(previousCommand) if previousCommand is not None else None
+        if (previous is not None and previous[0] == 'H'):
+            previous = ['H', False, False, 0, 0] # Homing ends at (0, 0)
+
+        for (index, command) in enumerate(commands):
+            current = PhysicalBoard.parseCommand(command)
+            if (current[0] == 'H'):
+                optimized.append(current)
+                sources.append(index)
+                continue
+
+            last = optimized[-1] if len(optimized) > 0 else previous
+            if (last is not None and last[0] != 'H' and last[3:5] == current[3:5]): # Zero-length
+                isLastCommand = (index + 1 == len(commands))
+                if (not isLastCommand or last[1] == current[1]):
+                    if (len(optimized) > 0 and not current[2]):
+                        optimized[-1][2] = False # Keep the precise stop
+                    continue
+
+            # Remove waypoints that the new command makes unnecessary
+            while (len(optimized) > 0 and optimized[-1][0] != 'H'):
+                last = optimized[-1]
+                beforeLast = optimized[-2] if len(optimized) > 1 else previous
+                if (not last[1] and not current[1]): # Two magnet-down moves in a row
+                    optimized.pop()
+                    sources.pop()
+                elif (beforeLast is not None and beforeLast[0] != 'H' and last[1] == current[1] and PhysicalBoard.isBetween(beforeLast[3:5], last[3:5], current[3:5])):
+                    optimized.pop()
+                    sources.pop()
+                else:
+                    break
+
+            optimized.append(current)
+            sources.append(index)
+
+        optimizedCommands = []
+        for (kind, magnetUp, optimizeRoute, x, y) in optimized:
+            if (kind == 'H'):
+                optimizedCommands.append(HOME_COMMAND)
+            else:
+                optimizedCommands.append(PhysicalBoard.buildCommand(x, y, magnetUp, optimizeRoute))
+
+        # A removed command is finished by the next command that was kept (it was merged into it, or made unnecessary by it).
+        # Removed commands at the very end were zero-length, so they're finished by the last command kept before them.
+        completedBy = []
+        outputIndex = 0
+        for index in range(len(commands)):
+            while (outputIndex < len(sources) - 1 and sources[outputIndex] < index):
+                outputIndex += 1
+            completedBy.append(outputIndex if len(sources) > 0 else None)
+        return (optimizedCommands, completedBy)
+
+    @staticmethod
+    def isBetween(startXY, middleXY, endXY, tolerance=COLLINEAR_TOLERANCE):
+        # Whether middle is on the straight line from start to end (within tolerance), and not past either end.
+        (startX, startY) = startXY
+        (deltaX, deltaY) = (endXY[0] - startX, endXY[1] - startY)
+        (middleX, middleY) = (middleXY[0] - startX, middleXY[1] - startY)
+        lengthSquared = deltaX * deltaX + deltaY * deltaY
+        if (lengthSquared == 0):
+            return False
+        cross = deltaX * middleY - deltaY * middleX
+        if (cross * cross > tolerance * tolerance * lengthSquared): # Too far from the line
+            return False
+        dot = deltaX * middleX + deltaY * middleY
+        return 0 <= dot <= lengthSquared
+
+    @staticmethod
+    def getCommandXY(command):
+        # Where the magnet ends up after a command
+        (kind, _, _, x, y) = PhysicalBoard.parseCommand(command)
+        return (0, 0) if kind == 'H' else (x, y)
+
+    @staticmethod
+    def getCommandMoves(commands, startXY=(0, 0)):
+        # Each command as (deltaA, deltaB, magnetUp, optimizeRoute) in motor steps, or None for home (see MotionProfile.planProfiles)
+        (motorA, motorB) = (-startXY[0] - startXY[1], -startXY[0] + startXY[1])
+        moves = []
+        for command in commands:
+            (kind, magnetUp, optimizeRoute, x, y) = PhysicalBoard.parseCommand(command)
+            if (kind == 'H'):
+                moves.append(None)
+                (motorA, motorB) = (0, 0)
+                continue
+            (targetA, targetB) = (-x - y, -x + y)
+            moves.append((targetA - motorA, targetB - motorB, magnetUp, optimizeRoute))
+            (motorA, motorB) = (targetA, targetB)
+        return moves
+
+    @staticmethod
+    def estimateCommandsTime(commands, startXY=(0, 0), startIdle=True):
+        """
+        Predicts how long (in seconds) the Arduino will take to execute a list of commands, using the firmware's timing.
+
+        startXY: Where the magnet is before the first command.
+        startIdle: If True, the Arduino isn't running anything yet, so the first command waits for its execution timer.
+
+        CoreXY kinematics: motor A moves to -x-y and motor B to -x+y, in a straight line.
+        So a move takes max(|dA|, |dB|) = |dx| + |dy| steps of the dominant motor, at the speeds planned by MotionProfile.
+        """
+        seconds = FIRMWARE_EXECUTION_INTERVAL_MS / 2000 if startIdle and len(commands) > 0 else 0 # Average wait for the first check
+        moves = PhysicalBoard.getCommandMoves(commands, startXY=startXY)
+        (x, y) = startXY
+        speed = START_SPEED
+        for (command, move, profile) in zip(commands, moves, MotionProfile.planProfiles(moves)):
+            if (move is None):
+                # Homing steps straight back to each limit switch, one axis at a time
+                seconds += (abs(x) + abs(y)) * FIRMWARE_HOME_STEP_MICROS / 1000000
+                speed = START_SPEED
+            else:
+                (moveSeconds, speed) = MotionProfile.getSegmentTime(MotionProfile.getSteps(move[0], move[1]), speed, profile)
+                seconds += moveSeconds
+            (x, y) = PhysicalBoard.getCommandXY(command)
+        return seconds
+
+    @staticmethod
+    def estimateTravelTime(startFileRank, endFileRank):
+        # Time (in seconds) for the magnet to move in a straight line between two (file, rank) points.
+        (startX, startY) = PhysicalBoard.getCalibratedXYFromFileRank(startFileRank)
+        (endX, endY) = PhysicalBoard.getCalibratedXYFromFileRank(endFileRank)
+        (cruiseSpeed, acceleration) = MotionProfile.getLimits(magnetUp=False)
+        steps = abs(endX - startX) + abs(endY - startY)
+        return MotionProfile.getSegmentTime(steps, START_SPEED, Profile(cruiseSpeed, START_SPEED, acceleration))[0]
+
+    @staticmethod
+    def estimateMoveTime(start, end, direct=False, startFileRank=None, occupiedSquares=None):
+        # Time (in seconds) to move a piece from start to end, including getting the magnet there from startFileRank.
+        includeStart = startFileRank != PhysicalBoard.getFileRankCoords(start)
+        commands = PhysicalBoard.getCommands(start, end, direct=direct, includeStart=includeStart, occupiedSquares=occupiedSquares)
+        startXY = PhysicalBoard.getCalibratedXYFromFileRank(startFileRank) if startFileRank is not None else PhysicalBoard.getXY(start)
+        return PhysicalBoard.estimateCommandsTime(commands, startXY=startXY, startIdle=False)
+
     @staticmethod
     def testBit(num, offset):
         num = int(num)
@@ -420,136 +869,465 @@ class PhysicalBoard:
         return (num & mask) > 0
     
     def isAllCommandsFinished(self):
-        return len(self.commandQueue) == 0 and self.arduinoQueueCount == 0 and not self.isArduinoBusy
-
-    def enqueueCommand(self, command):
-        self.commandQueue.append(command)
+        with self.lock:
+            return len(self.commandQueue) == 0 and len(self.inFlightCommands) == 0 and self.getBytesInFlight() == 0 and self.arduinoQueueCount == 0 and not self.isArduinoBusy
+
+    def enqueueCommand(self, command, onComplete=None):
+        # onComplete(finished) is called (on the serial thread) once the Arduino finishes this command.
+        # finished is False if the command was thrown away instead (see home).
+        with self.lock:
+            self.commandQueue.append(command)
+            self.commandCallbacks.append([onComplete] if onComplete is not None else [])
     
-    def enqueueCommands(self, commands):
-        for command in commands:
-            self.enqueueCommand(command)
+    def enqueueCommands(self, commands, optimize=True, onComplete=None):
+        # Returns how many commands the optimizer removed.
+        # onComplete(finished) is called once the Arduino finishes every one of these commands (see enqueueCommand).
+        if (not optimize or len(commands) == 0):
+            with self.lock:
+                for command in commands:
+                    self.enqueueCommand(command)
+                self.addCompletionCallback(onComplete)
+            return 0
+
+        # Optimize along with everything that hasn't been sent yet, so waypoints can be merged across moves
+        with self.lock:
+            pending = list(self.commandQueue) + list(commands)
+            pendingCallbacks = list(self.commandCallbacks) + [[] for _ in commands]
+            (optimized, completedBy) = PhysicalBoard.optimizeCommandsWithCompletion(pending, previousCommand=self.lastSentCommand)
+            callbacks = [[] for _ in optimized]
+            for (index, outputIndex) in enumerate(completedBy):
+                if (outputIndex is not None):
+                    callbacks[outputIndex] += pendingCallbacks[index]
+                elif (len(pendingCallbacks[index]) > 0): # Nothing left to do for it, it's done when everything before it is
+                    self.__attachToLastInFlight(pendingCallbacks[index])
+
+            saved = len(pending) - len(optimized)
+            self.commandQueue = collections.deque(optimized)
+            self.commandCallbacks = collections.deque(callbacks)
+            self.commandsSavedByOptimizer += saved
+            self.addCompletionCallback(onComplete)
+        return saved
+
+    def addCompletionCallback(self, onComplete):
+        # Calls onComplete(finished) once every command enqueued so far is finished (right away if they already are).
+        if (onComplete is None):
+            return
+        with self.lock:
+            if (len(self.commandCallbacks) > 0):
+                self.commandCallbacks[-1].append(onComplete)
+            else:
+                self.__attachToLastInFlight([onComplete])
+
+    def __attachToLastInFlight(self, callbacks):
+        if (len(self.inFlightCommands) > 0):
+            self.inFlightCommands[-1][2].extend(callbacks)
+        else:
+            PhysicalBoard.__callCallbacks(callbacks, True)
+
+    @staticmethod
+    def __callCallbacks(callbacks, finished):
+        for callback in callbacks:
+            try:
+                callback(finished)
+            except Exception as error:
+                print("Error in command callback: " + repr(error))
 
     def dequeueCommand(self):
-        if (len(self.commandQueue) > 0):
-            return self.commandQueue.pop(0)
+        with self.lock:
+            if (len(self.commandQueue) > 0):
+                self.__attachToLastInFlight(self.commandCallbacks.popleft()) # Never sent, so it's done once the commands before it are
+                return self.commandQueue.popleft()
     
-    def beginSerial(self):
-        # Open serial connection to Arduino
-        connected = False
-        trying_interface = 0
+    def beginSerial(self, keepTrying=None):
+        # Open serial connection to Arduino. Searches until it's found, or until keepTrying() returns False (then returns None).
+        while (True):
+            ports = self.getCandidatePorts()
+            found = PhysicalBoard.findArduino(ports)
+            if (found is not None):
+                break
+            print("No Arduino found" + (" on " + ", ".join(ports) if len(ports) > 0 else "") + ". Retrying...")
+            time.sleep(SERIAL_RETRY_INTERVAL)
+            if (keepTrying is not None and not keepTrying()):
+                return None
+
+        (arduino, received) = found
+        print("Connected to Arduino on " + arduino.port)
+        if (self.port is None):
+            PhysicalBoard.saveLastPort(arduino.port)
+
+        # Handle what the Arduino sent while we were probing (like FRAME_HELLO) before anything else is sent
+        with self.lock:
+            self.serialInRing.write(received)
+            self.__receiveTelemetry()
+        return arduino
+
+    def getCandidatePorts(self):
+        # Ports the Arduino might be on. The port it was last found on goes first.
+        if (self.port is not None):
+            return [self.port]
         if (current_os == LINUX):
-            while (not connected):
-                try:
-                    print("Looking for Arduino on USB" + str(trying_interface) + "...")
-                    arduino = serial.Serial(LINUX_USB_INTERFACES[trying_interface], SERIAL_BAUD, timeout=1)
-                    arduino.flush()
-                    connected = True
-                except serial.SerialException as e:
-                    print("Error connecting to Arduino. Retrying...")
-                    time.sleep(0.2)
-
-                    trying_interface += 1
-                    if trying_interface >= len(LINUX_USB_INTERFACES):
-                        trying_interface = 0
-
-            print("Connected to Arduino on " + LINUX_USB_INTERFACES[trying_interface])
-            arduino.flush()
+            ports = [port for port in LINUX_USB_INTERFACES if os.path.exists(port)]
         else: # OS is Windows
-            while (not connected):
-                try:
-                    ports = serial.tools.list_ports.comports()
-                    device = None
-                    for port in ports:
-                        if 'CH340' in port.description: # Arduino chip
-                            device = port
-                            break
-                    if device:
-                        print("Looking for Arduino on " + device.name)
-                        arduino = serial.Serial(device.name, SERIAL_BAUD, timeout=1)
-                        arduino.flush()
-                        connected = True
-                    else:
-                        raise serial.SerialException()
-                except serial.SerialException as e:
-                    print("Error connecting to Arduino. Retrying...")
-                    time.sleep(0.2)
+            ports = [port.device for port in serial.tools.list_ports.comports() if 'CH340' in port.description] # Arduino chip
 
-            print("Connected to Arduino on " + device.name)
-            arduino.flush()
+        lastPort = PhysicalBoard.loadLastPort()
+        if (lastPort in ports):
+            ports.remove(lastPort)
+            ports.insert(0, lastPort)
+        elif (lastPort is not None and current_os == LINUX and os.path.exists(lastPort)):
+            ports.insert(0, lastPort)
+        return ports
 
-        return arduino
+    @staticmethod
+    def findArduino(ports):
+        # Probes every port at once, and returns (serial connection, bytes received) for the first one that sends a valid
+        # frame, or None. Each probe can take a few seconds (the Arduino resets when its port is opened), so one at a time is slow.
+        if (len(ports) == 0):
+            return None
+        stop = threading.Event()
+        found = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(ports)) as executor:
+            probes = [executor.submit(PhysicalBoard.probePort, port, stop) for port in ports]
+            for probe in concurrent.futures.as_completed(probes):
+                result = probe.result()
+                if (result is None):
+                    continue
+                if (found is None):
+                    found = result
+                    stop.set() # Tell the other probes to give up
+                else:
+                    result[0].close()
+        return found
+
+    @staticmethod
+    def probePort(port, stop=None, timeout=SERIAL_PROBE_TIMEOUT):
+        # Opens port and waits for a valid frame, so we don't mistake some other serial device for the Arduino.
+        # Returns (serial connection, bytes received) or None. Gives up early once stop is set.
+        try:
+            connection = serial.Serial(port, SERIAL_BAUD, timeout=SERIAL_POLL_TIMEOUT)
+        except (serial.SerialException, OSError):
+            return None
+
+        parser = FrameParser()
+        received = bytearray()
+        deadline = time.time() + timeout
+        try:
+            while (time.time() < deadline and not (stop is not None and stop.is_set())):
+                incoming = connection.read(max(1, connection.in_waiting))
+                received += incoming
+                if (len(parser.feed(incoming)) > 0):
+                    return (connection, bytes(received))
+        except (serial.SerialException, OSError):
+            pass
+        connection.close()
+        return None
+
+    @staticmethod
+    def loadLastPort():
+        try:
+            with open(SERIAL_STATE_FILE) as file:
+                return json.load(file).get('port')
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    @staticmethod
+    def saveLastPort(port):
+        if (PhysicalBoard.loadLastPort() == port):
+            return
+        try:
+            with open(SERIAL_STATE_FILE, 'w') as file:
+                json.dump({'port': port}, file)
+        except OSError as e:
+            print("Couldn't save serial port to " + SERIAL_STATE_FILE + ": " + str(e))
+
+    def reconnect(self):
+        # Reopen the serial connection after it stopped working (like a USB hiccup), without losing any commands.
+        # Commands that never made it are sent again once telemetry shows what the Arduino has (see __resync).
+        print("Lost connection to Arduino. Reconnecting...")
+        try:
+            self.arduino.close()
+        except (serial.SerialException, OSError):
+            pass
+        with self.lock:
+            self.awaitingResync = True
+            self.serialInRing.clear()
+            self.frameParser.clear()
+            self.lastTelemetry = None # So resyncing waits for two frames from after the reconnect
+            self.lastTelemetrySequence = None # Frames sent while disconnected aren't lost, they're just gone
+            self.reedSwitchesKnown = False
+        keepTrying = (lambda: self.serialThreadRunning) if self.threaded else None
+        arduino = self.beginSerial(keepTrying=keepTrying)
+        if (arduino is None):
+            return False
+        if (self.threaded):
+            arduino.timeout = SERIAL_POLL_TIMEOUT
+        self.arduino = arduino
+        return True
+
+    def startSerialThread(self):
+        # Start the background thread that owns the serial port
+        if (self.serialThread is not None and self.serialThread.is_alive()):
+            return
+        self.arduino.timeout = SERIAL_POLL_TIMEOUT
+        self.serialThreadRunning = True
+        self.serialThread = threading.Thread(target=self.__serialLoop)
+        self.serialThread.daemon = True
+        self.serialThread.start()
+
+    def stopSerialThread(self):
+        self.serialThreadRunning = False
+        if (self.serialThread is not None and self.serialThread is not threading.current_thread()):
+            self.serialThread.join()
+        self.serialThread = None
+
+    def __serialLoop(self):
+        # Serial thread: Read whatever arrives, handle telemetry, and keep the Arduino's queue full.
+        # The main thread only ever touches the command queue and telemetry state, so it never waits on the port.
+        while (self.serialThreadRunning):
+            try:
+                incoming = self.arduino.read(max(1, self.arduino.in_waiting)) # Waits up to SERIAL_POLL_TIMEOUT for data
+                with self.lock:
+                    self.serialInRing.write(incoming)
+                    self.receiveTelemetry()
+                    self.sendNextCommandIfAvailable()
+            except (serial.SerialException, OSError) as e:
+                print("Serial error: " + str(e))
+                if (not self.reconnect()):
+                    break
+
+    def readSerial(self):
+        # Move everything waiting on the serial port into serialInRing. Only used without the serial thread.
+        if (self.arduino.in_waiting > 0):
+            incoming = self.arduino.read(self.arduino.in_waiting)
+            with self.lock:
+                self.serialInRing.write(incoming)
 
     def receiveTelemetry(self):
-        # Process incoming telemetry messages from Arduino, and processes the most recent message.
+        # Process every complete message received from the Arduino so far, in order.
         # Updates self.arduinoQueueAvailableCount and other things from Arduino serial telemetry
-        if (self.arduino.in_waiting > 0):
-            # Each telemetry message ends in a newline.
-            incoming_serial = self.arduino.read(self.arduino.in_waiting)
+        with self.lock:
+            self.__receiveTelemetry()
+
+    def __receiveTelemetry(self):
+        if (len(self.serialInRing) == 0):
+            return
+        timestamp = time.time()
+        crcErrors = self.frameParser.crcErrors
+        frames = self.frameParser.feed(self.serialInRing.read())
+        if (self.frameParser.crcErrors != crcErrors):
+            print("WARNING: Dropped " + str(self.frameParser.crcErrors - crcErrors) + " corrupted frame(s) from the Arduino.")
+        for frame in frames:
+            self.handleFrame(frame, timestamp)
+
+    def addFrameHandler(self, handler):
+        # handler(frame, timestamp) is called (on the serial thread, while holding self.lock) with every Protocol.Frame from the Arduino
+        self.frameHandlers.append(handler)
+
+    def handleFrame(self, frame, timestamp):
+        # Handle one frame from the Arduino. timestamp: time.time() when it was received.
+        for handler in self.frameHandlers:
+            handler(frame, timestamp)
+
+        if (frame.type == FRAME_TELEMETRY):
             try:
-                additional = incoming_serial.decode()
-                self.serialInBuffer += additional
-            except UnicodeDecodeError:
-                print("WARNING: Recieved corrupted telemetry data. Ignored and cleared buffer. This will likely cause more errors.")
-                self.serialInBuffer = ""
-        
-        message = ""
-
-        # Loop through until we hit a newline or end of buffer
-        continueReading = True
-        charCounter = 0
-        while (continueReading):
-            if (charCounter >= len(self.serialInBuffer)):
-                # End of buffer
-                continueReading = False
-
-            elif (self.serialInBuffer[charCounter] == '\n'):
-                # Process message
-                message = self.serialInBuffer[:charCounter].lstrip('\r\n').rstrip('\r\n')
-                self.serialInBuffer = self.serialInBuffer[charCounter+1:]
-                charCounter = 0
-            
-            charCounter += 1
-        
-        if (message != ""):
-            if len(message) >= 5 and "ERROR" in message:
+                telemetry = Protocol.decodeTelemetry(frame.payload)
+            except struct.error:
+                print("Invalid telemetry frame: " + frame.payload.hex())
+                return
+            self.handleTelemetry(telemetry, timestamp, frame.sequence)
+        elif (frame.type == FRAME_HELLO):
+            try:
+                hello = Protocol.decodeHello(frame.payload)
+            except struct.error:
+                print("Invalid hello frame: " + frame.payload.hex())
+                return
+            self.handleHello(hello)
+        elif (frame.type == FRAME_LOG):
+            message = Protocol.decodeLog(frame.payload)
+            if ("ERROR" in message):
                 print("Arduino error: " + message)
             else:
-                # Message format is:
-                # <Finished/Executing (F/E),<queueCount>,<queueAvailableCount>,<Arcade Switch count since last message (hex)>\n
-                # Example: "F,3,5,3f\n",
-
-                splitMessage = message.rstrip('\n\r').split(',')
-
-                if(len(splitMessage) != 3):
-                    print("Invalid telemetry message: " + message)
-                    return
-                
-                busy = splitMessage[0] == 'E'
-                if (not busy and self.isArduinoBusy and len(self.commandQueue) == 0 and self.arduinoQueueCount == 0):
-                    self.firstAvailableTime = time.time()
-                self.isArduinoBusy = busy
-                self.arduinoQueueCount = int(splitMessage[1])
-                self.arduinoQueueAvailableCount = int(splitMessage[2])
-                #self.setReedSwitchesFromHex(splitMessage[3])
-                #self.setArcadeSwitchesFromHex(splitMessage[3])
-            
-            # print("Received telemetry: " + message) # Debugging
-
-    def setReedSwitchesFromHex(self, hexString):
-        # Reed switches are stored in a hex string, with each bit representing a switch.
-        # It's in big-endian format, so the last switch is the most significant bit of the first byte.
-
-        # Grab first two characters of hex string, then second, then third, etc.
-        # At the same time, count columns backwards from 11 to 0, inclusive.
-        columnIndex = 11 # Index of the column we're on, in ALL_FILES
-        for i in range(0, len(hexString), 2):
-            hexByte = hexString[i:i+2] # Grab two characters
-            byte = int(hexByte, 16) # Convert to integer
-            for rowIndex in range(7): # Loop form 0 to 7, inclusive
-                squareName = ALL_FILES[columnIndex] + str(rowIndex + 1)
-                isOn = PhysicalBoard.testBit(byte, rowIndex) # Get whether the switch is on
-                self.reedSwitches[squareName] = isOn
-            columnIndex -= 1
+                print("Arduino: " + message)
+        else:
+            print("Unknown frame type from Arduino: " + str(frame.type))
+
+    def handleTelemetry(self, telemetry, timestamp, sequence=None):
+        # sequence: The frame's SEQUENCE, to spot lost frames (None if unknown)
+        previous = self.lastTelemetry
+        if (previous is not None and telemetry.frameErrorCount != previous.frameErrorCount):
+            print("WARNING: Arduino dropped " + str((telemetry.frameErrorCount - previous.frameErrorCount) % 256) + " corrupted command frame(s).")
+
+        self.isArduinoBusy = telemetry.executing
+        self.arduinoQueueCount = telemetry.queueCount
+        self.arduinoQueueAvailableCount = telemetry.queueAvailableCount
+        self.arduinoReceivedBytes = telemetry.receivedBytes
+
+        # Reed switches: only the columns that changed are sent, with a keyframe of all of them now and then (see REED SWITCH COLUMNS in Protocol.py)
+        if (sequence is not None and self.lastTelemetrySequence is not None and sequence != (self.lastTelemetrySequence + 1) % 256):
+            print("WARNING: Lost " + str((sequence - self.lastTelemetrySequence - 1) % 256) + " telemetry frame(s). Reed switches might be out of date until the next keyframe.")
+            self.reedSwitchesStale = True
+        self.lastTelemetrySequence = sequence
+        self.setReedSwitchesEnabled(telemetry.reedSwitchesEnabled)
+        if (telemetry.keyframe and self.reedSwitchesEnabled):
+            self.reedSwitchesKnown = True
+            self.reedSwitchesStale = False
+        self.reedSwitchBoard = (self.reedSwitchBoard & ~telemetry.reedSwitchMask) | telemetry.reedSwitches
+        if (self.reedSwitchesKnown): # Before the first keyframe, columns that haven't changed are missing
+            self.reedSwitchEvents.update(self.reedSwitchBoard, timestamp)
+            if (self.traceRecorder is not None):
+                self.traceRecorder.record(self.reedSwitchBoard, timestamp)
+        if (self.arduinoQueueCapacity is None): # Connected without a reset, so there was no hello
+            self.arduinoQueueCapacity = telemetry.queueCount + telemetry.queueAvailableCount
+        self.lastTelemetry = telemetry
+
+        if (self.awaitingResync):
+            # Commands sent just before we saw the hello can still be in the Arduino's receive buffer, or on the wire.
+            # Only once two frames in a row show an empty buffer and nothing more read is everything it got counted.
+            if (previous is None or telemetry.receiveBufferCount != 0 or previous.receiveBufferCount != 0 or telemetry.receivedBytes != previous.receivedBytes):
+                return
+            self.__resync(telemetry)
+            previous = None
+
+        # Finish every in-flight command up to the last one the Arduino finished
+        if (telemetry.lastFinishedSequence != 0 and (previous is None or telemetry.lastFinishedSequence != previous.lastFinishedSequence)):
+            if (any(sequence == telemetry.lastFinishedSequence for (sequence, _, _) in self.inFlightCommands)):
+                while (len(self.inFlightCommands) > 0):
+                    (sequence, command, callbacks) = self.inFlightCommands.popleft()
+                    self.lastFinishedCommand = command
+                    PhysicalBoard.__callCallbacks(callbacks, True)
+                    if (sequence == telemetry.lastFinishedSequence):
+                        break
+
+        # Idle with nothing left to read means any commands still in flight never arrived (corrupted frames)
+        if (not telemetry.executing and telemetry.queueCount == 0 and self.getBytesInFlight() == 0 and len(self.inFlightCommands) > 0):
+            print("WARNING: " + str(len(self.inFlightCommands)) + " command(s) never reached the Arduino. Sending them again.")
+            self.__requeueInFlight(list(self.inFlightCommands))
+
+        # After finishing commands, so the frame where the last move finishes is already checked.
+        # Out of date columns could look like drift, so nothing new is reported until the next keyframe.
+        if (self.reedSwitchesKnown):
+            self.consistencyMonitor.update(self.reedSwitchBoard, timestamp, self.isAllCommandsFinished() and not self.reedSwitchesStale)
+
+    def handleHello(self, hello):
+        # The Arduino just started (see FRAME_HELLO in Protocol.py). If that's not because we just connected,
+        # it was reset: it homed, and everything it had queued is gone.
+        if (hello.queueCapacity != self.arduinoQueueCapacity):
+            print("Arduino has room for " + str(hello.queueCapacity) + " commands.")
+        self.arduinoQueueCapacity = hello.queueCapacity
+        self.arduinoReceiveBufferSize = hello.receiveBufferSize
+        self.setReedSwitchesEnabled(hello.reedSwitchesEnabled)
+        self.isArduinoBusy = False
+        self.arduinoQueueCount = 0
+        self.arduinoReceivedBytes = 0
+        self.lastTelemetry = None
+        self.lastTelemetrySequence = None # Starts again from 0, and the first frame is a keyframe
+        if (self.lastSentCommand is None): # Nothing sent yet
+            self.bytesSentCount = 0
+            return
+        print("WARNING: Arduino was reset. It homed itself, resending unfinished commands.")
+        self.awaitingResync = True
+        self.arduinoWasReset = True
+
+    def setReedSwitchesEnabled(self, enabled):
+        # Whether the Arduino scans the reed switches. Without them, it reports every switch as off, which isn't an empty board:
+        # reedSwitchesKnown stays False, so nothing reads them (events, traces, the consistency monitor).
+        if (enabled != self.reedSwitchesEnabled and not enabled):
+            print("WARNING: Arduino isn't scanning the reed switches (REED_SWITCHES_ENABLED is 0 in chessMotors.ino). Human moves can't be seen.")
+        self.reedSwitchesEnabled = enabled
+        if (not enabled):
+            self.reedSwitchesKnown = False
+            self.consistencyMonitor.setExpected(None) # Stop checking until setExpectedOccupancy is called with them back
+
+    def __resync(self, telemetry):
+        # Telemetry after a reconnect or reset, once the Arduino's receive buffer has settled (empty), so we know exactly what it has:
+        # In-flight commands it received stay in flight, and the rest are put back at the front of the queue.
+        sequences = [sequence for (sequence, _, _) in self.inFlightCommands]
+        received = sequences.index(telemetry.lastCommandSequence) + 1 if telemetry.lastCommandSequence in sequences else 0
+        firstReceived = 0
+        resumeFrom = None
+        if (self.arduinoWasReset): # Only commands sent after it started made it, the ones before were lost in the reset
+            firstReceived = max(0, received - telemetry.receivedBytes // COMMAND_FRAME_SIZE)
+            resumeFrom = self.lastFinishedCommand # Where the magnet was before the reset
+            self.lastFinishedCommand = HOME_COMMAND # Where it is now
+
+        inFlight = list(self.inFlightCommands)
+        lost = inFlight[:firstReceived] + inFlight[received:]
+        if (len(lost) > 0):
+            print("Resending " + str(len(lost)) + " command(s) the Arduino didn't get.")
+        self.__requeueInFlight(lost)
+
+        # The queued commands start where the magnet was before the reset, not at home. If the first one carries a piece,
+        # go back to its start first (a piece it was dragging is somewhere on that line, so it gets picked up again).
+        if (resumeFrom is not None and len(self.inFlightCommands) == 0 and len(self.commandQueue) > 0):
+            (kind, magnetUp, _, _, _) = PhysicalBoard.parseCommand(self.commandQueue[0])
+            (resumeKind, _, _, x, y) = PhysicalBoard.parseCommand(resumeFrom)
+            if (kind != 'H' and magnetUp and resumeKind != 'H'):
+                self.commandQueue.appendleft(PhysicalBoard.buildCommand(x, y, False, False))
+                self.commandCallbacks.appendleft([])
+
+        self.bytesSentCount = telemetry.receivedBytes # Nothing else is on its way
+        self.awaitingResync = False
+        self.arduinoWasReset = False
+
+    def __requeueInFlight(self, entries):
+        # Moves these in-flight (sequence, command, callbacks) entries back to the front of the queue, in order
+        for entry in entries:
+            self.inFlightCommands.remove(entry)
+        for (_, command, callbacks) in reversed(entries):
+            self.commandQueue.appendleft(command)
+            self.commandCallbacks.appendleft(callbacks)
+        self.lastSentCommand = self.inFlightCommands[-1][1] if len(self.inFlightCommands) > 0 else self.lastFinishedCommand
+
+    @property
+    def reedSwitches(self):
+        # Read-only {'w1': False, ..., 'h8': True} view of the reed switches, only rebuilt when they change.
+        # Prefer reedSwitchBoard in anything that runs every tick.
+        (board, view) = self.__reedSwitchView
+        if (board != self.reedSwitchBoard):
+            board = self.reedSwitchBoard
+            view = MappingProxyType(Bitboard.toDict(board))
+            self.__reedSwitchView = (board, view)
+        return view
+
+    def setExpectedOccupancy(self, expected):
+        # Bitboard of every square that should have a piece, bank included (None to stop checking).
+        # From then on, it's updated as each movePiece finishes, and checked against the reed switches (see ConsistencyMonitor.py).
+        # Does nothing unless the Arduino scans the reed switches, since every square would look empty.
+        with self.lock:
+            if (not self.reedSwitchesEnabled):
+                return
+            self.consistencyMonitor.setExpected(expected)
+
+    def takeRepairPlan(self, ignore=0):
+        # List of (start, end) piece moves that fix the latest drift from the expected occupancy, or None if there's no new drift.
+        # ignore: Bitboard of squares to leave out, like a human move in progress.
+        with self.lock:
+            if (not self.reedSwitchesEnabled):
+                return None
+            return self.consistencyMonitor.takeRepairPlan(ignore)
+
+    def startTrace(self, path):
+        # Record every reed switch change from now on to a trace file, to replay later (see ReedSwitchTrace.py and MoveReplay.py)
+        with self.lock:
+            self.stopTrace()
+            self.traceRecorder = ReedSwitchTraceRecorder(path)
+
+    def stopTrace(self):
+        with self.lock:
+            if (self.traceRecorder is not None):
+                self.traceRecorder.close()
+                self.traceRecorder = None
+
+    def getReedSwitchEventCursor(self):
+        # Cursor for readReedSwitchEvents that skips every reed switch change so far
+        with self.lock:
+            return self.reedSwitchEvents.getCursor()
+
+    def readReedSwitchEvents(self, cursor):
+        # Debounced reed switch changes since cursor (see ReedSwitchEvents.py).
+        # Returns (list of ReedSwitchEvent, oldest first, the cursor to read from next time, how many events were lost).
+        with self.lock:
+            return self.reedSwitchEvents.read(cursor)
     
     def setArcadeSwitchesFromHex(self, hexString):
         # Sets the 6 arcade switch values from 2 hex characters
@@ -561,46 +1339,209 @@ class PhysicalBoard:
         for i in range(6):
             self.arcadeButtons[i] = PhysicalBoard.testBit(byte, i)
     
-    def sendNextCommandIfAvailable(self):
-        # Sends next command to the Arduino if it's ready
-        self.receiveTelemetry()
+    def getBytesInFlight(self):
+        # Bytes sent that the Arduino hasn't read yet (as of the last telemetry frame).
+        # These are sitting in the Arduino's serial receive buffer, or still on the wire.
+        bytesInFlight = (self.bytesSentCount - self.arduinoReceivedBytes) % 65536
+        if (bytesInFlight > 32768):
+            # The Arduino has read more than we counted (bytes from before a reset or reconnect). Catch up instead of wrapping
+            # around, which would look like a full receive buffer and stop anything from being sent again.
+            self.bytesSentCount += 65536 - bytesInFlight
+            return 0
+        return bytesInFlight
+
+    def getUnstartedCount(self):
+        # Commands sent that the Arduino hasn't started yet (as of the last telemetry frame).
+        # These are in its queue, or on their way there.
+        sequences = [sequence for (sequence, _, _) in self.inFlightCommands]
+        if (self.lastTelemetry is not None and self.lastTelemetry.lastStartedSequence in sequences):
+            return len(sequences) - sequences.index(self.lastTelemetry.lastStartedSequence) - 1
+        return len(sequences)
+
+    def getSendCredits(self):
+        # How many more commands we can send. Each one needs a slot in the Arduino's queue (so the queue never overflows),
+        # and room in its serial receive buffer until the firmware reads it (it only reads while it's not busy stepping).
+        # Telemetry is never newer than what we've sent, so this can only underestimate.
+        if (self.arduinoQueueCapacity is None):
+            return 0 # Wait for the hello (or telemetry) to say how big the queue is
+        queueCredits = self.arduinoQueueCapacity - self.getUnstartedCount()
+        bufferCredits = (self.arduinoReceiveBufferSize - self.getBytesInFlight()) // COMMAND_FRAME_SIZE
+        return max(0, min(queueCredits, bufferCredits))
 
-        if (len(self.commandQueue) > 0 and self.arduinoQueueAvailableCount > 3):
-            command = self.dequeueCommand()
-            command = '#' + command # start character
-            print("Sending command: " + command)
-            self.arduino.write(command.encode())
+    @staticmethod
+    def commandToProtocol(command, profile=None):
+        # 'UPX0200Y00500' -> Protocol.Command, moving with profile (a MotionProfile.Profile, or the firmware's default if None)
+        (kind, magnetUp, optimizeRoute, x, y) = PhysicalBoard.parseCommand(command)
+        if (kind == 'H'):
+            return Command(0, 0, False, False, True)
+        (x, y) = PhysicalBoard.clampToReach(x, y) # Commands enqueued as strings never went through buildCommand
+        if (profile is None):
+            return Command(x, y, magnetUp, optimizeRoute, False)
+        return Command(x, y, magnetUp, optimizeRoute, False, profile.cruiseSpeed, profile.exitSpeed, profile.acceleration)
 
-            self.arduinoQueueCount += 1
-            self.arduinoQueueAvailableCount -= 1
+    def sendNextCommandIfAvailable(self):
+        # Sends as many queued commands as the Arduino has room for, in one write.
+        # With the serial thread running, only the serial thread calls this.
+        with self.lock:
+            if (self.awaitingResync):
+                return # Wait to find out which commands need to be sent again (see __resync)
+            count = min(len(self.commandQueue), self.getSendCredits())
+            if (count > 0):
+                commands = [self.commandQueue.popleft() for _ in range(count)]
+
+                # Plan with the next few queued commands too, so the last one sent doesn't have to stop if more are coming
+                lookahead = [self.commandQueue[i] for i in range(min(PLANNER_LOOKAHEAD, len(self.commandQueue)))]
+                startXY = PhysicalBoard.getCommandXY(self.lastSentCommand) if self.lastSentCommand is not None else (0, 0)
+                profiles = MotionProfile.planProfiles(PhysicalBoard.getCommandMoves(commands + lookahead, startXY=startXY))
+
+                self.lastSentCommand = commands[-1]
+                frames = []
+                for (command, profile) in zip(commands, profiles):
+                    frames.append(Protocol.encodeCommand(PhysicalBoard.commandToProtocol(command, profile), self.nextSequence))
+                    self.inFlightCommands.append((self.nextSequence, command, self.commandCallbacks.popleft()))
+                    self.nextSequence = Protocol.nextCommandSequence(self.nextSequence)
+                message = b"".join(frames)
+                if (DEBUG_SERIAL):
+                    print("Sending commands: " + " ".join(commands))
+                self.arduino.write(message)
+
+                self.bytesSentCount += len(message)
+                self.arduinoQueueCount += count
+                self.arduinoQueueAvailableCount = max(0, self.arduinoQueueAvailableCount - count)
 
     def update(self):
-        # Updates telemetry and sends next command if available
-        self.receiveTelemetry()
-        self.sendNextCommandIfAvailable()
+        # Updates telemetry and sends next command if available.
+        # Nothing to do when the serial thread is running, it does this on its own.
+        if (self.threaded):
+            return
+        try:
+            self.readSerial()
+            self.receiveTelemetry()
+            self.sendNextCommandIfAvailable()
+        except (serial.SerialException, OSError) as e:
+            print("Serial error: " + str(e))
+            self.reconnect()
+
+    def estimateQueueTime(self):
+        # Time (in seconds) to run every command that hasn't been sent to the Arduino yet, after the last one that was.
+        with self.lock:
+            (lastSentCommand, commands, startIdle) = (self.lastSentCommand, list(self.commandQueue), self.isAllCommandsFinished())
+        startXY = PhysicalBoard.getCommandXY(lastSentCommand) if lastSentCommand is not None else (0, 0)
+        return PhysicalBoard.estimateCommandsTime(commands, startXY=startXY, startIdle=startIdle)
 
     def totalQueueCount(self):
         # How many commands must be executed until we are done (does not include current command in progress)
         return len(self.commandQueue) + self.arduinoQueueCount == 0
 
-    def __movePiece(self, start, end, direct=False, useMagnetWithDirect=True):
-        notAtStart = PhysicalBoard.getFileRankCoords(start) != self.finalDestinationFileRank
+    def __movePiece(self, start, end, direct=False, useMagnetWithDirect=True, occupiedSquares=None, onComplete=None):
+        future = concurrent.futures.Future()
+        def onFinished(finished):
+            if (finished and useMagnetWithDirect):
+                with self.lock:
+                    self.consistencyMonitor.movePiece(start, end)
+            if (onComplete is not None):
+                onComplete(finished)
+            PhysicalBoard.resolveFuture(future, finished)
+
+        with self.lock:
+            previousDestination = self.finalDestinationFileRank
+            notAtStart = PhysicalBoard.getFileRankCoords(start) != previousDestination
+
+            commands = PhysicalBoard.getCommands(start, end, direct=direct, includeStart=notAtStart, useMagnetWithDirect=useMagnetWithDirect, occupiedSquares=occupiedSquares)
+            self.finalDestinationFileRank = PhysicalBoard.getFileRankCoords(end)
+            self.enqueueCommands(commands, onComplete=onFinished)
+        future.add_done_callback(lambda done: self.__cancelMove(onFinished, previousDestination) if done.cancelled() else None)
+        return future
+
+    def movePiece(self, start, end, direct=False, occupiedSquares=None, onComplete=None):
+        # Returns a concurrent.futures.Future, resolved (on the serial thread) once the piece is at end.
+        # Its result is True, or False if the move was thrown away instead (see home).
+        # Cancelling it throws away whatever hasn't been sent to the Arduino yet, of this move and every move after it.
+        # occupiedSquares: Squares with pieces on them, to route around (see getPathAdvanced). If None, use the default path.
+        # onComplete(finished): Called once the piece is at end (see enqueueCommand).
+        return self.__movePiece(start, end, direct=direct, useMagnetWithDirect=True, occupiedSquares=occupiedSquares, onComplete=onComplete)
+    
+    def moveWithoutMagnet(self, start, end, onComplete=None):
+        # Returns a Future, same as movePiece
+        return self.__movePiece(start, end, direct=True, useMagnetWithDirect=False, onComplete=onComplete)
+
+    async def movePieceAsync(self, start, end, direct=False, occupiedSquares=None):
+        # movePiece for asyncio: await it to wait for the piece to get there. Cancelling the task cancels the move.
+        return await asyncio.wrap_future(self.movePiece(start, end, direct=direct, occupiedSquares=occupiedSquares))
+
+    def waitFor(self, future, timeout=None):
+        # Blocks until a move's future is resolved, and returns its result.
+        # Without the serial thread, nothing else would resolve it, so this keeps calling update() while it waits.
+        if (self.threaded):
+            return future.result(timeout)
+        deadline = time.time() + timeout if timeout is not None else None
+        while (not future.done()):
+            if (deadline is not None and time.time() > deadline):
+                raise concurrent.futures.TimeoutError()
+            self.update()
+            time.sleep(SERIAL_POLL_TIMEOUT) # Nothing happens faster than telemetry arrives
+        return future.result()
+
+    def __cancelMove(self, onFinished, previousDestination):
+        # Throw away the unsent commands of the move that calls onFinished when it's done, and of every move after it
+        # (they were planned for a board where this move happened).
+        with self.lock:
+            callbacks = list(self.commandCallbacks)
+            last = next((index for (index, commandCallbacks) in enumerate(callbacks) if onFinished in commandCallbacks), None)
+            if (last is None):
+                return # Already sent, so it can't be stopped
+            first = last # The move starts right after the last command that finishes an earlier move
+            while (first > 0 and len(callbacks[first - 1]) == 0):
+                first -= 1
+            partlySent = (first == 0 and len(self.inFlightCommands) > 0 and len(self.inFlightCommands[-1][2]) == 0)
+
+            for _ in range(len(callbacks) - first):
+                self.commandQueue.pop()
+                PhysicalBoard.__callCallbacks(self.commandCallbacks.pop(), False)
+            print("Cancelled move, threw away " + str(len(callbacks) - first) + " command(s).")
+
+            # Put the magnet back where the next move will expect it
+            self.finalDestinationFileRank = previousDestination
+            if (partlySent):
+                (x, y) = PhysicalBoard.getCalibratedXYFromFileRank(previousDestination)
+                self.enqueueCommand(PhysicalBoard.buildCommand(x, y, False, False))
 
-        commands = PhysicalBoard.getCommands(start, end, direct=direct, includeStart=notAtStart, useMagnetWithDirect=useMagnetWithDirect)
-        self.finalDestinationFileRank = PhysicalBoard.getFileRankCoords(end)
-        self.enqueueCommands(commands)
+    @staticmethod
+    def resolveFuture(future, result):
+        # Sets the result of a move's future, unless it was cancelled
+        if (future.set_running_or_notify_cancel()):
+            future.set_result(result)
 
-    def movePiece(self, start, end, direct=False):
-        self.__movePiece(start, end, direct=direct, useMagnetWithDirect=True)
-    
-    def moveWithoutMagnet(self, start, end):
-        self.__movePiece(start, end, direct=True, useMagnetWithDirect=False)
+    @staticmethod
+    def completedFuture(result=True):
+        future = concurrent.futures.Future()
+        PhysicalBoard.resolveFuture(future, result)
+        return future
+
+    @staticmethod
+    def combineFutures(futures):
+        # One future for several moves made in order: resolved when the last one is, with True if they all finished.
+        # Cancelling it cancels the first move (which throws away the rest too, see movePiece).
+        if (len(futures) == 0):
+            return PhysicalBoard.completedFuture(True)
+        combined = concurrent.futures.Future()
+        def onLastDone(_):
+            results = [future.result() if not future.cancelled() else False for future in futures if future.done()]
+            PhysicalBoard.resolveFuture(combined, len(results) == len(futures) and all(results))
+        futures[-1].add_done_callback(onLastDone)
+        combined.add_done_callback(lambda done: futures[0].cancel() if done.cancelled() else None)
+        return combined
 
     def home(self):
         # Homes the motors by sending a command beginning with 'H'
-        self.commandQueue = [] # Clear any existing commands
-        self.enqueueCommand(HOME_COMMAND) # Send home command
-        self.sendNextCommandIfAvailable()
+        with self.lock:
+            self.commandQueue.clear() # Clear any existing commands
+            for callbacks in self.commandCallbacks:
+                PhysicalBoard.__callCallbacks(callbacks, False)
+            self.commandCallbacks.clear()
+            self.enqueueCommand(HOME_COMMAND) # Send home command
+        if (not self.threaded):
+            self.sendNextCommandIfAvailable()
 
     def motorTestRun(self):
         self.moveWithoutMagnet('h1', 'h1') # Starting square
@@ -655,11 +1596,8 @@ class PhysicalBoard:
         self.movePiece('g8', 'h1')
 
 
-    def getModifiedReedSwitches(self):
-        # Compare current state to state from last check to see what the user changed.
-        modifiedReedSwitches = {}
-        for square in ALL_SQUARES:
-            if (self.__prevCheckReedSwitches[square] != self.reedSwitches[square]):
-                modifiedReedSwitches[square] = self.reedSwitches[square]
-
-        return modifiedReedSwitches
+# Calibration and lookup tables, built once at import
+CALIBRATION = Calibration.load()
+SQUARE_FILE_RANKS = MappingProxyType({square: PhysicalBoard.getFileRankCoords(square) for square in ALL_SQUARES})
+FILE_RANK_SQUARES = MappingProxyType({fileRank: square for (square, fileRank) in SQUARE_FILE_RANKS.items()})
+CALIBRATION_TABLE = PhysicalBoard.buildCalibrationTable()
@@ -0,0 +1,257 @@
+"""
+PROTOCOL
+
+Binary frames sent between the host and the Arduino (chessMotors.ino), in both directions.
+
+
+FRAME
+    Byte  0      1        2     3         4        5 ... 5+length-1   5+length   6+length
+        | SYNC | VERSION | TYPE | SEQUENCE | LENGTH | PAYLOAD ...     | CRC (low) | CRC (high) |
+
+    SYNC: Always SYNC_BYTE (0xA5). Never appears in ASCII text, so a reader can find the start of the next frame.
+    VERSION: PROTOCOL_VERSION. Frames from another version are dropped.
+    TYPE: One of the FRAME_ types below.
+    SEQUENCE: Counts up by one for each frame of that type sent (wraps at 256).
+              Command sequences skip 0 (1, 2, ..., 255, 1, ...), so 0 can mean "no command yet" in telemetry.
+    LENGTH: Number of payload bytes.
+    CRC: CRC-16/CCITT-FALSE (polynomial 0x1021, starting at 0xFFFF) of every byte from VERSION to the end of the payload.
+
+All multi-byte numbers are little-endian, same as the AVR.
+
+
+PAYLOADS
+    FRAME_COMMAND (host -> Arduino), 8 bytes:
+        int16 x, int16 y, uint8 flags (COMMAND_FLAG_),
+        uint8 cruiseSpeed (in SPEED_UNIT steps/s), uint8 exitSpeed (in SPEED_UNIT steps/s), uint8 acceleration (in ACCELERATION_UNIT steps/s^2)
+        The motion profile for the command (see MotionProfile.py). Speeds below the firmware's start speed are raised to it,
+        and an acceleration of 0 runs the whole command at the start speed, so all zeros moves like the old firmware.
+    FRAME_TELEMETRY (Arduino -> host), 12 to 24 bytes:
+        uint8 flags (TELEMETRY_FLAG_), uint8 queueCount, uint8 queueAvailableCount,
+        uint16 receivedBytes (bytes read from serial since startup, wraps at 65536),
+        uint8 receiveBufferCount (bytes waiting in the serial receive buffer, not read yet),
+        uint8 lastCommandSequence (last command received), uint8 frameErrorCount (corrupted frames dropped since startup, wraps at 256),
+        uint8 lastStartedSequence, uint8 lastFinishedSequence (last command to start/reach its target, 0 if none yet),
+        uint16 reedSwitchColumnMask (bit n set if column n follows), then uint8 reedSwitchColumns[] (one byte per column in the mask, in order)
+        See REED SWITCH COLUMNS below.
+    FRAME_LOG (Arduino -> host), up to MAX_PAYLOAD_SIZE bytes:
+        ASCII text, like "ERROR: ..." or "WARNING: ..."
+    FRAME_HELLO (Arduino -> host), 3 bytes:
+        uint8 queueCapacity (command queue slots), uint8 receiveBufferSize (serial receive buffer, in bytes), uint8 flags (HELLO_FLAG_)
+        Sent once after the firmware starts (and has homed), so the host knows the Arduino was reset:
+        its queue, sequence numbers and receivedBytes are back to 0, and the magnet is at (0, 0).
+        Opening the serial port resets the Arduino, so this is also the handshake when the host connects:
+        the host never has more commands on their way than the queue and receive buffer can hold.
+
+
+REED SWITCH COLUMNS
+The reed switches are 12 columns of 8 (bit n of a column is rank n + 1). All 12 bytes read as one little-endian number
+are a bitboard (see Bitboard.py). Sending all of them every 4 ms would be a third of the serial bandwidth, and they
+hardly ever change, so telemetry only carries the columns that changed since the last frame:
+
+    Columns:   w  x  y  z  a  b  c  d  e  f  g  h
+    Changed:   .  .  .  .  .  .  .  .  #  .  .  .     e2e4 shows up in one column
+    Sent:      mask 0x0100, then column e (1 byte)    -> 3 bytes of reed switches instead of 12
+
+Every KEYFRAME_INTERVAL frames (and the first one after startup) is a keyframe (TELEMETRY_FLAG_KEYFRAME), with every
+column. Each column sent is its whole current value, so applying a frame can't go wrong on its own. A lost frame only
+leaves the columns that changed in it out of date, until they change again or the next keyframe. The host spots lost
+frames from gaps in the telemetry SEQUENCE (see PhysicalBoard.handleTelemetry).
+
+Firmware built without reed switch scanning (REED_SWITCHES_ENABLED 0) reads every switch as off, which looks just like
+an empty board. It leaves TELEMETRY_FLAG_REED_SWITCHES and HELLO_FLAG_REED_SWITCHES clear, so the host ignores them.
+
+Inside the host, commands are still strings like 'UPX0200Y00500' (see PhysicalBoard.buildCommand).
+They're only turned into frames when they're sent.
+"""
+
+# Imports
+import struct
+import collections
+
+# Framing
+SYNC_BYTE = 0xA5
+PROTOCOL_VERSION = 6
+HEADER_SIZE = 5 # SYNC, VERSION, TYPE, SEQUENCE, LENGTH
+CRC_SIZE = 2
+MAX_PAYLOAD_SIZE = 96 # Longer frames are treated as corrupted
+
+# Frame types
+FRAME_COMMAND = 0x01
+FRAME_TELEMETRY = 0x81
+FRAME_LOG = 0x82
+FRAME_HELLO = 0x83
+
+# Payloads
+COMMAND_STRUCT = struct.Struct('<hhBBBB')
+TELEMETRY_STRUCT = struct.Struct('<BBBHBBBBBH') # Followed by the reed switch columns in the mask
+REED_SWITCH_BYTES = 12 # One per column
+ALL_REED_SWITCH_COLUMNS = (1 << REED_SWITCH_BYTES) - 1 # Column mask of a keyframe
+ALL_REED_SWITCHES = (1 << (REED_SWITCH_BYTES * 8)) - 1 # reedSwitchMask of a keyframe
+KEYFRAME_INTERVAL = 64 # Telemetry frames from one keyframe to the next (256 ms). Also how long a lost frame can leave a column out of date.
+HELLO_STRUCT = struct.Struct('<BBB')
+COMMAND_FRAME_SIZE = HEADER_SIZE + COMMAND_STRUCT.size + CRC_SIZE
+TELEMETRY_FRAME_SIZE = HEADER_SIZE + TELEMETRY_STRUCT.size + CRC_SIZE # With no reed switch columns
+
+COMMAND_FLAG_MAGNET_UP = 0x01
+COMMAND_FLAG_OPTIMIZE = 0x02 # Go straight into the next command at exitSpeed, instead of stopping at the target
+COMMAND_FLAG_HOME = 0x04 # Home the motors, x and y are ignored
+SPEED_UNIT = 32 # (in steps/s) Command speeds are sent as multiples of this, up to 255 * SPEED_UNIT
+ACCELERATION_UNIT = 128 # (in steps/s^2) Command accelerations are sent as multiples of this, up to 255 * ACCELERATION_UNIT
+
+TELEMETRY_FLAG_EXECUTING = 0x01 # Motors are enabled
+TELEMETRY_FLAG_KEYFRAME = 0x02 # Every reed switch column is included
+TELEMETRY_FLAG_REED_SWITCHES = 0x04 # The reed switches are scanned. If not, they all read as off.
+
+HELLO_FLAG_REED_SWITCHES = 0x01 # Same as TELEMETRY_FLAG_REED_SWITCHES, so it's known before the first telemetry frame
+
+Frame = collections.namedtuple('Frame', ['type', 'sequence', 'payload'])
+Telemetry = collections.namedtuple('Telemetry', ['executing', 'queueCount', 'queueAvailableCount', 'receivedBytes', 'receiveBufferCount', 'lastCommandSequence', 'frameErrorCount', 'lastStartedSequence', 'lastFinishedSequence', 'reedSwitchesEnabled', 'keyframe', 'reedSwitchMask', 'reedSwitches'])
+# reedSwitchMask: Bitboard with every bit of each column sent set. reedSwitches: Those columns' switches (the rest are 0).
+# The whole board is (previous & ~reedSwitchMask) | reedSwitches.
+Hello = collections.namedtuple('Hello', ['queueCapacity', 'receiveBufferSize', 'reedSwitchesEnabled'])
+Command = collections.namedtuple('Command', ['x', 'y', 'magnetUp', 'optimizeRoute', 'home', 'cruiseSpeed', 'exitSpeed', 'acceleration'], defaults=[0, 0, 0])
+
+# CRC lookup table, one entry per byte value
+CRC_TABLE = []
+for byte in range(256):
+    crc = byte << 8
+    for _ in range(8):
+        crc = ((crc << 1) ^ 0x1021) if (crc & 0x8000) else (crc << 1)
+    CRC_TABLE.append(crc & 0xFFFF)
+
+class Protocol:
+    @staticmethod
+    def crc16(data, crc=0xFFFF):
+        for byte in data:
+            crc = ((crc << 8) & 0xFFFF) ^ CRC_TABLE[(crc >> 8) ^ byte]
+        return crc
+
+    @staticmethod
+    def encodeFrame(frameType, sequence, payload):
+        if (len(payload) > MAX_PAYLOAD_SIZE):
+            raise ValueError("Frame payload is " + str(len(payload)) + " bytes, max is " + str(MAX_PAYLOAD_SIZE) + ".")
+        body = bytes([PROTOCOL_VERSION, frameType, sequence & 0xFF, len(payload)]) + bytes(payload)
+        return bytes([SYNC_BYTE]) + body + struct.pack('<H', Protocol.crc16(body))
+
+    @staticmethod
+    def encodeCommand(command, sequence):
+        flags = (COMMAND_FLAG_MAGNET_UP if command.magnetUp else 0) | (COMMAND_FLAG_OPTIMIZE if command.optimizeRoute else 0) | (COMMAND_FLAG_HOME if command.home else 0)
+        cruiseSpeed = min(255, command.cruiseSpeed // SPEED_UNIT)
+        exitSpeed = min(255, command.exitSpeed // SPEED_UNIT)
+        acceleration = min(255, command.acceleration // ACCELERATION_UNIT)
+        return Protocol.encodeFrame(FRAME_COMMAND, sequence, COMMAND_STRUCT.pack(command.x, command.y, flags, cruiseSpeed, exitSpeed, acceleration))
+
+    @staticmethod
+    def decodeCommand(payload):
+        (x, y, flags, cruiseSpeed, exitSpeed, acceleration) = COMMAND_STRUCT.unpack(payload)
+        return Command(x, y, bool(flags & COMMAND_FLAG_MAGNET_UP), bool(flags & COMMAND_FLAG_OPTIMIZE), bool(flags & COMMAND_FLAG_HOME), cruiseSpeed * SPEED_UNIT, exitSpeed * SPEED_UNIT, acceleration * ACCELERATION_UNIT)
+
+    @staticmethod
+    def encodeTelemetry(telemetry, sequence):
+        flags = (TELEMETRY_FLAG_EXECUTING if telemetry.executing else 0) | (TELEMETRY_FLAG_KEYFRAME if telemetry.keyframe else 0) | (TELEMETRY_FLAG_REED_SWITCHES if telemetry.reedSwitchesEnabled else 0)
+        columnMask = Protocol.getColumnMask(telemetry.reedSwitchMask)
+        columns = telemetry.reedSwitches.to_bytes(REED_SWITCH_BYTES, 'little')
+        payload = TELEMETRY_STRUCT.pack(flags, telemetry.queueCount, telemetry.queueAvailableCount, telemetry.receivedBytes & 0xFFFF, min(255, telemetry.receiveBufferCount), telemetry.lastCommandSequence & 0xFF, telemetry.frameErrorCount & 0xFF, telemetry.lastStartedSequence, telemetry.lastFinishedSequence, columnMask)
+        payload += bytes(columns[column] for column in range(REED_SWITCH_BYTES) if columnMask & (1 << column))
+        return Protocol.encodeFrame(FRAME_TELEMETRY, sequence, payload)
+
+    @staticmethod
+    def decodeTelemetry(payload):
+        # Raises struct.error if the payload doesn't match its column mask
+        (flags, queueCount, queueAvailableCount, receivedBytes, receiveBufferCount, lastCommandSequence, frameErrorCount, lastStartedSequence, lastFinishedSequence, columnMask) = TELEMETRY_STRUCT.unpack_from(payload)
+        columns = payload[TELEMETRY_STRUCT.size:]
+        if (columnMask > ALL_REED_SWITCH_COLUMNS or len(columns) != bin(columnMask).count('1')):
+            raise struct.error("Telemetry has " + str(len(columns)) + " reed switch columns, its mask says " + str(bin(columnMask).count('1')) + ".")
+        (reedSwitchMask, reedSwitches, index) = (0, 0, 0)
+        for column in range(REED_SWITCH_BYTES):
+            if (columnMask & (1 << column)):
+                reedSwitchMask |= 0xFF << (column * 8)
+                reedSwitches |= columns[index] << (column * 8)
+                index += 1
+        return Telemetry(bool(flags & TELEMETRY_FLAG_EXECUTING), queueCount, queueAvailableCount, receivedBytes, receiveBufferCount, lastCommandSequence, frameErrorCount, lastStartedSequence, lastFinishedSequence, bool(flags & TELEMETRY_FLAG_REED_SWITCHES), bool(flags & TELEMETRY_FLAG_KEYFRAME), reedSwitchMask, reedSwitches)
+
+    @staticmethod
+    def getColumnMask(bitboard):
+        # Column mask (bit n for column n) of every column with a bit set in bitboard
+        return sum(1 << column for column in range(REED_SWITCH_BYTES) if (bitboard >> (column * 8)) & 0xFF)
+
+    @staticmethod
+    def getChangedColumns(previous, current):
+        # reedSwitchMask for telemetry going from previous to current (bitboards): every bit of each column that changed
+        changed = previous ^ current
+        return sum(0xFF << (column * 8) for column in range(REED_SWITCH_BYTES) if (changed >> (column * 8)) & 0xFF)
+
+    @staticmethod
+    def encodeHello(hello):
+        return Protocol.encodeFrame(FRAME_HELLO, 0, HELLO_STRUCT.pack(hello.queueCapacity, hello.receiveBufferSize, HELLO_FLAG_REED_SWITCHES if hello.reedSwitchesEnabled else 0))
+
+    @staticmethod
+    def decodeHello(payload):
+        (queueCapacity, receiveBufferSize, flags) = HELLO_STRUCT.unpack(payload)
+        return Hello(queueCapacity, receiveBufferSize, bool(flags & HELLO_FLAG_REED_SWITCHES))
+
+    @staticmethod
+    def encodeLog(text, sequence):
+        return Protocol.encodeFrame(FRAME_LOG, sequence, text.encode('ascii', 'replace')[:MAX_PAYLOAD_SIZE])
+
+    @staticmethod
+    def decodeLog(payload):
+        return payload.decode('ascii', 'replace')
+
+    @staticmethod
+    def nextCommandSequence(sequence):
+        # 1, 2, ..., 255, 1, ... (0 is reserved for "none")
+        return sequence % 255 + 1
+
+class FrameParser:
+    """
+    Splits a stream of bytes into frames, keeping any partial frame for the next call to feed().
+    Bytes that aren't part of a valid frame (noise, or a frame that fails its CRC) are skipped.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.skippedBytes = 0 # Bytes that weren't part of a valid frame
+        self.crcErrors = 0 # Frames dropped because their CRC didn't match
+
+    def feed(self, data):
+        # Returns a list of every complete frame in data (plus anything left over from before), in order.
+        self.buffer += data
+        frames = []
+        position = 0
+        while (True):
+            start = self.buffer.find(SYNC_BYTE, position)
+            if (start == -1):
+                self.skippedBytes += len(self.buffer) - position
+                position = len(self.buffer)
+                break
+            self.skippedBytes += start - position
+            position = start
+
+            if (len(self.buffer) - start < HEADER_SIZE):
+                break # Wait for the rest of the header
+            length = self.buffer[start + 4]
+            if (self.buffer[start + 1] != PROTOCOL_VERSION or length > MAX_PAYLOAD_SIZE):
+                self.skippedBytes += 1
+                position = start + 1 # Not a real frame, look for the next SYNC
+                continue
+
+            end = start + HEADER_SIZE + length + CRC_SIZE
+            if (len(self.buffer) < end):
+                break # Wait for the rest of the frame
+
+            body = self.buffer[start + 1:end - CRC_SIZE]
+            (crc,) = struct.unpack_from('<H', self.buffer, end - CRC_SIZE)
+            if (crc != Protocol.crc16(body)):
+                self.crcErrors += 1
+                self.skippedBytes += 1
+                position = start + 1 # The SYNC might have been noise inside another frame, so keep looking from just after it
+                continue
+
+            frames.append(Frame(body[1], body[2], bytes(body[4:])))
+            position = end
+
+        del self.buffer[:position]
+        return frames
+
+    def clear(self):
+        self.buffer.clear()
@@ -0,0 +1,96 @@
+"""
+REED SWITCH EVENTS
+
+Turns the reed switch bitboards from telemetry (see Bitboard.py) into a stream of debounced events:
+(timestamp, square, state) every time a square's switch turns on or off and stays that way.
+
+DEBOUNCING
+A switch has to hold its new state for DEBOUNCE_TIME before it counts, so contact bounce and a piece sliding
+across a square don't make events. The event's timestamp is when the switch first changed, not when it settled.
+The first update is just the starting state: pieces already on the board don't make events.
+
+    raw       ___|‾|_|‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾
+    debounced ___________|‾‾‾‾‾‾‾‾‾‾‾‾  <- one event, timestamped at the last edge of the raw signal
+                 |<--->| DEBOUNCE_TIME
+
+EVENT BUFFER
+Events go into a fixed size ring buffer, so a long session never uses more memory. Every event gets a cursor
+(how many events came before it). Readers keep their own cursor and ask for everything after it:
+
+    cursor = events.getCursor()
+    ...
+    (newEvents, cursor, lostCount) = events.read(cursor)
+
+If a reader falls more than capacity events behind, the oldest ones are gone, and lostCount says how many.
+
+Each update only looks at squares that changed or are still settling, so it takes time proportional to the
+number of changes, not the size of the board.
+
+Not thread safe by itself. PhysicalBoard only touches it while holding its lock.
+"""
+
+# Imports
+import collections
+from Bitboard import Bitboard
+
+# Configuration
+DEBOUNCE_TIME = 0.03 # (in seconds) How long a switch must stay in its new state to count. About 5 full scans of the board.
+EVENT_BUFFER_SIZE = 512 # Events kept for readers. A whole game is a few hundred.
+
+ReedSwitchEvent = collections.namedtuple('ReedSwitchEvent', ['timestamp', 'square', 'state'])
+
+class ReedSwitchEvents:
+    def __init__(self, capacity=EVENT_BUFFER_SIZE, debounceTime=DEBOUNCE_TIME):
+        self.capacity = capacity
+        self.debounceTime = debounceTime
+        self.events = [None] * capacity
+        self.cursor = 0 # Total events ever added. The next one is stored at events[cursor % capacity].
+        self.rawBoard = 0 # Bitboard from the last update, not debounced
+        self.board = 0 # Debounced bitboard: the state as of the last event for each square
+        self.changeTimes = {} # Bit index -> when its raw state last changed, for squares where rawBoard and board differ
+        self.started = False # Whether there's been an update yet
+
+    def update(self, rawBoard, timestamp):
+        # Adds the switch states read at timestamp. Returns how many events this made.
+        if (not self.started): # The pieces already on the board when we connect aren't changes
+            self.started = True
+            (self.rawBoard, self.board) = (rawBoard, rawBoard)
+            return 0
+        changed = rawBoard ^ self.rawBoard
+        self.rawBoard = rawBoard
+        unsettled = rawBoard ^ self.board
+        for index in Bitboard.indices(changed):
+            if (unsettled & (1 << index)):
+                self.changeTimes[index] = timestamp
+            else:
+                del self.changeTimes[index] # Bounced back before it settled, so no event
+        return self.flush(timestamp)
+
+    def flush(self, timestamp):
+        # Turns every change that has settled by timestamp into an event. Returns how many there were.
+        count = 0
+        for index in Bitboard.indices(self.rawBoard ^ self.board):
+            changeTime = self.changeTimes[index]
+            if (timestamp - changeTime >= self.debounceTime):
+                bit = 1 << index
+                self.board ^= bit
+                del self.changeTimes[index]
+                self.__add(ReedSwitchEvent(changeTime, Bitboard.squareAt(index), self.board & bit != 0))
+                count += 1
+        return count
+
+    def __add(self, event):
+        self.events[self.cursor % self.capacity] = event
+        self.cursor += 1
+
+    def getCursor(self):
+        # Cursor for a reader that only wants events from now on
+        return self.cursor
+
+    def read(self, cursor):
+        # Returns (events after cursor, oldest first, the cursor to read from next time, how many events were lost)
+        oldest = max(0, self.cursor - self.capacity)
+        lostCount = max(0, oldest - cursor)
+        cursor = max(cursor, oldest)
+        events = [self.events[position % self.capacity] for position in range(cursor, self.cursor)]
+        return (events, self.cursor, lostCount)
@@ -0,0 +1,118 @@
+"""
+REED SWITCH TRACE
+
+Compact recordings of the reed switches, so everything that turns them into moves (ReedSwitchEvents, MoveRecognizer)
+can be run again later without anyone at the board (see MoveReplay.py).
+
+Record one from a real game with PhysicalBoard.startTrace(path), or make one up with MoveReplay.synthesizeGame.
+
+
+FILE FORMAT (little-endian, same as Protocol.py)
+    Header, 13 bytes:
+        | MAGIC 'RSTR' (4 bytes) | VERSION (uint8) | start time (float64, time.time() of the first frame) |
+    Then one record per frame where a switch changed, 16 bytes each:
+        | time since the previous record (uint32, in microseconds) | reed switches (12 bytes, one per column, see Protocol.py) |
+
+The first record is the starting state, at the start time. The last record is the last frame recorded, even if
+nothing changed, so a replay knows how long the trace went on for. Telemetry arrives every few milliseconds but the
+switches only change when someone moves a piece, so a whole game is tens of kilobytes.
+A gap too long for a uint32 (over an hour without a change) is split up by repeating the same switches.
+"""
+
+# Imports
+import struct
+from Protocol import REED_SWITCH_BYTES
+
+# File format
+TRACE_MAGIC = b'RSTR'
+TRACE_VERSION = 1
+TRACE_HEADER_STRUCT = struct.Struct('<4sBd')
+TRACE_RECORD_STRUCT = struct.Struct('<I' + str(REED_SWITCH_BYTES) + 's')
+TRACE_MAX_GAP_MICROS = 0xFFFFFFFF # Longest time between records
+
+class ReedSwitchTrace:
+    @staticmethod
+    def encode(frames):
+        # [(timestamp, reed switch bitboard)], oldest first, for every frame where a switch changed -> bytes
+        if (len(frames) == 0):
+            return b''
+        (startTime, previousSwitches) = frames[0]
+        data = bytearray(TRACE_HEADER_STRUCT.pack(TRACE_MAGIC, TRACE_VERSION, startTime))
+        previousMicros = 0
+        for (timestamp, switches) in frames:
+            micros = max(previousMicros, round((timestamp - startTime) * 1000000))
+            data += ReedSwitchTrace.encodeRecord(micros - previousMicros, switches, previousSwitches)
+            (previousMicros, previousSwitches) = (micros, switches)
+        return bytes(data)
+
+    @staticmethod
+    def encodeRecord(gapMicros, switches, previousSwitches):
+        # One record, gapMicros after the previous one. A longer gap than fits is split up by repeating previousSwitches.
+        data = b''
+        while (gapMicros > TRACE_MAX_GAP_MICROS):
+            data += TRACE_RECORD_STRUCT.pack(TRACE_MAX_GAP_MICROS, previousSwitches.to_bytes(REED_SWITCH_BYTES, 'little'))
+            gapMicros -= TRACE_MAX_GAP_MICROS
+        return data + TRACE_RECORD_STRUCT.pack(gapMicros, switches.to_bytes(REED_SWITCH_BYTES, 'little'))
+
+    @staticmethod
+    def decode(data):
+        # bytes -> [(timestamp, reed switch bitboard)]. Raises ValueError if it isn't a trace.
+        if (len(data) == 0):
+            return []
+        if (len(data) < TRACE_HEADER_STRUCT.size):
+            raise ValueError("Reed switch trace is too short.")
+        (magic, version, startTime) = TRACE_HEADER_STRUCT.unpack_from(data)
+        if (magic != TRACE_MAGIC or version != TRACE_VERSION):
+            raise ValueError("Not a reed switch trace, or from another version.")
+        frames = []
+        micros = 0
+        for (gap, switches) in TRACE_RECORD_STRUCT.iter_unpack(data[TRACE_HEADER_STRUCT.size:]):
+            micros += gap
+            frames.append((startTime + micros / 1000000, int.from_bytes(switches, 'little')))
+        return frames
+
+    @staticmethod
+    def read(path):
+        with open(path, 'rb') as file:
+            return ReedSwitchTrace.decode(file.read())
+
+    @staticmethod
+    def write(path, frames):
+        with open(path, 'wb') as file:
+            file.write(ReedSwitchTrace.encode(frames))
+
+class ReedSwitchTraceRecorder:
+    """
+    Writes telemetry frames to a trace file as they arrive, only keeping the ones where a switch changed.
+    Not thread safe by itself. PhysicalBoard only touches it while holding its lock.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.startTime = None # timestamp of the first frame
+        self.lastWritten = None # (micros since start, switches) of the last record written
+        self.lastFrame = None # (timestamp, switches) of the last frame, written when the trace is closed
+        self.frameCount = 0 # Frames seen, including ones that weren't written
+
+    def record(self, switches, timestamp):
+        self.frameCount += 1
+        self.lastFrame = (timestamp, switches)
+        if (self.startTime is None):
+            self.startTime = timestamp
+            self.file.write(TRACE_HEADER_STRUCT.pack(TRACE_MAGIC, TRACE_VERSION, timestamp))
+        elif (switches == self.lastWritten[1]):
+            return
+        self.__write(switches, timestamp)
+
+    def __write(self, switches, timestamp):
+        (previousMicros, previousSwitches) = self.lastWritten if self.lastWritten is not None else (0, switches)
+        micros = max(previousMicros, round((timestamp - self.startTime) * 1000000))
+        self.file.write(ReedSwitchTrace.encodeRecord(micros - previousMicros, switches, previousSwitches))
+        self.lastWritten = (micros, switches)
+
+    def close(self):
+        # Writes the last frame (so the trace's length is known) and closes the file
+        if (self.lastFrame is not None and self.frameCount > 1):
+            (timestamp, switches) = self.lastFrame
+            if (round((timestamp - self.startTime) * 1000000) != self.lastWritten[0]):
+                self.__write(switches, timestamp)
+        self.file.close()
@@ -0,0 +1,64 @@
+"""
+RING BUFFER
+
+Fixed size byte buffer for serial data. Bytes are written at the tail and read from the head, wrapping around
+the end of a preallocated bytearray, so reading and writing never reallocate or shift the rest of the buffer.
+
+      head          tail
+       v             v
+    |_|#|#|#|#|#|#|#|_|_|_|   <- # = unread bytes
+    |#|#|_|_|_|_|_|#|#|#|#|   <- wrapped around: unread bytes are at the end, then the start
+         ^         ^
+        tail      head
+
+If a write doesn't fit, the oldest unread bytes are dropped to make room (and counted in droppedCount),
+so a reader that falls behind loses old telemetry instead of blocking the serial port.
+
+Not thread safe by itself. PhysicalBoard only touches it while holding its lock.
+"""
+
+class RingBuffer:
+    def __init__(self, capacity):
+        self.buffer = bytearray(capacity)
+        self.capacity = capacity
+        self.head = 0 # Index of the oldest unread byte
+        self.size = 0 # Number of unread bytes
+        self.droppedCount = 0 # Bytes overwritten before they were read
+
+    def __len__(self):
+        return self.size
+
+    def write(self, data):
+        # Appends data, dropping the oldest unread bytes if there isn't room
+        data = memoryview(data)
+        if (len(data) > self.capacity): # Only the newest bytes can fit
+            self.droppedCount += len(data) - self.capacity
+            data = data[len(data) - self.capacity:]
+
+        overflow = self.size + len(data) - self.capacity
+        if (overflow > 0):
+            self.head = (self.head + overflow) % self.capacity
+            self.size -= overflow
+            self.droppedCount += overflow
+
+        tail = (self.head + self.size) % self.capacity
+        firstPart = min(len(data), self.capacity - tail) # Up to the end of the buffer, then wrap around
+        self.buffer[tail:tail + firstPart] = data[:firstPart]
+        self.buffer[0:len(data) - firstPart] = data[firstPart:]
+        self.size += len(data)
+
+    def read(self, count=None):
+        # Removes and returns up to count bytes (all of them if count is None)
+        count = self.size if count is None else min(count, self.size)
+        end = self.head + count
+        if (end <= self.capacity):
+            data = bytes(self.buffer[self.head:end])
+        else:
+            data = bytes(self.buffer[self.head:]) + bytes(self.buffer[0:end - self.capacity])
+        self.head = end % self.capacity
+        self.size -= count
+        return data
+
+    def clear(self):
+        self.head = 0
+        self.size = 0
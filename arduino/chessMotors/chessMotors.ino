@@ -15,8 +15,11 @@
 #define PIN_DIR_B 11                                  
 #define PIN_STEP_B 10
 
-/*
 // Multiplexed reed switches
+// These share pins with the limit switches, magnet and motor drivers below, so scanning is off until they're rewired.
+// With it off, every switch reads as off, and FRAME_HELLO and telemetry say so (so the host doesn't take that for an empty board).
+#define REED_SWITCHES_ENABLED 0
+#if REED_SWITCHES_ENABLED
 #define PIN_MUX_SIG 7
 #define PIN_MUX_RANK_S0 A1
 #define PIN_MUX_RANK_S1 A2
@@ -25,6 +28,8 @@
 #define PIN_MUX_FILE_S1 A5
 #define PIN_MUX_FILE_S2 12
 #define PIN_MUX_FILE_S3 11
+#endif
+/*
 #define PIN_ARCADE_BUTTON_SIG 13
 */
 
@@ -47,72 +52,128 @@
 
 // Serial
 #define SERIAL_BAUD_RATE 115200
-
-// Incoming command queue
-#define QUEUE_SIZE 5
-#define COMMAND_LEN 13 // Length of command in chars
+#ifndef SERIAL_RX_BUFFER_SIZE
+#define SERIAL_RX_BUFFER_SIZE 64 // Set by HardwareSerial.h on newer cores
+#endif
+
+// Incoming command queue. Each Command is 9 bytes, so this is about 300 of the Nano's 2048 bytes of RAM.
+// Reported to the host in FRAME_HELLO, so it knows how many commands it can send.
+#define QUEUE_SIZE 32
+
+// Binary protocol (see MagneticChessPython/Protocol.py)
+// Frame: SYNC, VERSION, TYPE, SEQUENCE, LENGTH, PAYLOAD..., CRC (low), CRC (high)
+#define SYNC_BYTE 0xA5
+#define PROTOCOL_VERSION 6
+#define FRAME_HEADER_LEN 5
+#define FRAME_CRC_LEN 2
+#define MAX_RX_PAYLOAD_LEN 16 // Longest payload we accept from the host
+#define MAX_LOG_LEN 96 // Longest log message we send (MAX_PAYLOAD_SIZE in Protocol.py)
+#define FRAME_COMMAND 0x01
+#define FRAME_TELEMETRY 0x81
+#define FRAME_LOG 0x82
+#define FRAME_HELLO 0x83 // Sent once at startup, so the host knows we were reset (and how much we can hold)
+#define COMMAND_PAYLOAD_LEN 8 // int16 x, int16 y, uint8 flags, uint8 cruiseSpeed, uint8 exitSpeed, uint8 acceleration
+#define HELLO_PAYLOAD_LEN 3 // uint8 queueCapacity, uint8 receiveBufferSize, uint8 flags
+#define TELEMETRY_FIXED_LEN 12 // uint8 flags, uint8 count, uint8 available, uint16 receivedBytes, uint8 receiveBufferCount, uint8 lastCommandSequence, uint8 frameErrorCount, uint8 lastStartedSequence, uint8 lastFinishedSequence, uint16 reedSwitchColumnMask
+#define TELEMETRY_MAX_PAYLOAD_LEN (TELEMETRY_FIXED_LEN + 12) // Then uint8 reedSwitchColumns[] for each column in the mask
+#define COMMAND_FLAG_MAGNET_UP 0x01
+#define COMMAND_FLAG_OPTIMIZE 0x02
+#define COMMAND_FLAG_HOME 0x04
+#define TELEMETRY_FLAG_EXECUTING 0x01
+#define TELEMETRY_FLAG_KEYFRAME 0x02 // Every reed switch column is included
+#define TELEMETRY_FLAG_REED_SWITCHES 0x04 // The reed switches are scanned (REED_SWITCHES_ENABLED)
+#define HELLO_FLAG_REED_SWITCHES 0x01 // The reed switches are scanned (REED_SWITCHES_ENABLED)
+#define KEYFRAME_INTERVAL 64 // Telemetry frames from one keyframe to the next, so the host catches up after a lost frame
+#define SPEED_UNIT 32 // Command speeds are in units of 32 steps/s
+#define ACCELERATION_UNIT 128 // Command accelerations are in units of 128 steps/s^2
 
 // Configuration
 #define DEBOUNCE_THRESHOLD 10 // In ms, amount we need to wait before detecting an edge of any type
 
-int front = 0;
-int back = 0;
-int count = 0;
-unsigned char commandQueue[QUEUE_SIZE][COMMAND_LEN] = {
-  "DPX0000Y0000",
-  "DPX0000Y0000",
-  "DPX0000Y0000",
-  "DPX0000Y0000",
-  "DPX0000Y0000"
+struct Command {
+  int16_t x;
+  int16_t y;
+  unsigned char flags; // COMMAND_FLAG_
+  unsigned char cruiseSpeed; // Motion profile, in SPEED_UNIT and ACCELERATION_UNIT (see MagneticChessPython/MotionProfile.py)
+  unsigned char exitSpeed;
+  unsigned char acceleration;
+  unsigned char sequence; // From the frame, so the host knows when this command starts and finishes
 };
 
+unsigned char front = 0;
+unsigned char back = 0;
+unsigned char count = 0;
+Command commandQueue[QUEUE_SIZE];
+
+// Incoming frame
+unsigned char frameBuffer[FRAME_HEADER_LEN + MAX_RX_PAYLOAD_LEN + FRAME_CRC_LEN];
+int frameLength = 0; // Bytes of the current frame received so far
+uint16_t receivedBytes = 0; // Bytes read from serial since startup (wraps at 65536). Sent in telemetry so the host knows what's still in the serial buffer.
+unsigned char lastCommandSequence = 0; // Last command received
+unsigned char lastStartedSequence = 0; // Last command started (0 = none yet, the host never uses 0)
+unsigned char lastFinishedSequence = 0; // Last command that reached its target
+bool commandRunning = false; // The last started command hasn't reached its target yet
+unsigned char frameErrorCount = 0; // Corrupted frames dropped since startup
+unsigned char telemetrySequence = 0;
+unsigned char logSequence = 0;
+char logBuffer[MAX_LOG_LEN + 1];
+
 // Timers
 long currentTime = 0;
 long currentTimeMicros = 0;
 long motorTimer = 0;
 long telemetryTimer = 0;
 long executionTimer = 0;
-long switchTimer = 0;
+long switchTimerMicros = 0;
 
 // Timer intervals
-int motorIntervalMicros = 600;
+int motorIntervalMicros = 600; // Time between steps at startSpeed, and between checks while the motors are stopped
+int stepPulseMicros = 10; // How long a step pin stays high. The drivers need a few microseconds.
 int telemetryInterval = 4;
 int executionInterval = 50;
-int switchInterval = 6;
+int switchIntervalMicros = 500; // One column per interval, so the whole board is scanned every 6 ms without holding up the motors for long
 
 // Boundaries (implied bounds at minX=0, minY=0)
 const long maxX = 6950;
 const long maxY = 11900;
 
-const int optimizeDistanceThreshold = 0; // How close we need to be (euclidian distance) to the target position to start executing the next command.
+// Motion profile (see MagneticChessPython/MotionProfile.py). Speeds are in steps/s of the dominant motor, accelerations in steps/s^2.
+#define SPEED_FRACTION_BITS 4 // speedFixed is in 1/16 steps/s, so small speed changes add up
+const long startSpeed = 1000000L / 600; // Fastest the motors can start from rest (or change speed instantly)
+long speedFixed = startSpeed << SPEED_FRACTION_BITS; // Current speed
+long cruiseSpeed = startSpeed; // Current command's profile
+long exitSpeed = startSpeed;
+long acceleration = 0;
+long exitSpeedLimit = startSpeed; // exitSpeed, limited to what's safe for the next command (once it's here)
+bool exitSpeedLimitKnown = false; // exitSpeedLimit has been worked out for the command at the front of the queue
 
 // Initial values
 long motorPosA = 0;
 long motorPosB = 0;
 long targetPosA = 0;
 long targetPosB = 0;
-long targetDistanceA = 0;
-long targetDistanceB = 0;
-long targetDistanceEuclidian = 0;
+long stepsRemaining = 0; // Steps of the dominant motor left in the current command
+long majorSteps = 0; // Bresenham line: the dominant motor steps every time, the other one when stepError says so
+long minorSteps = 0;
+long stepError = 0;
+bool majorIsA = true;
+long lineDistanceA = 0; // Whole move of the current command, in steps of each motor
+long lineDistanceB = 0;
 bool motorDirA = true;
 bool motorDirB = true;
 bool motorsEnabled = false;
 bool magnetUp = false;
 bool optimizeRoute = false;
-bool tempAStep = false;
-bool tempBStep = false;
-bool readyToExecute = false;
 bool hasIdlePosition = false;
 long idleA;
 long idleB;
-int currentTelemetryChunk = 0;
 
 //1h corner #UPX0200Y00500
 //8h corner center x #UPX6950Y00500
 // bank 8 pawn #UPX6950Y11900
 //bank 1 pawn #UPX0250Y11850
 
-/*  REED SWITCH INDEXING - Indexed by reedSwitchValues[column][row]
+/*  REED SWITCH INDEXING - Bit row of reedSwitchColumns[column]
  *      _________ _________________
  *    7 |_|_|_|_| |_|_|_|_|_|_|_|_|
  *    6 |_|_|_|_| |_|_|_|_|_|_|_|_|
@@ -124,108 +185,138 @@ int currentTelemetryChunk = 0;
  *    0 |_|_|_|X| |_|_|_|_|_|_|_|_|
  *       0 1 2 3   4 5 6 7 8 9 1011
  *             ^
- *    Example: Square X's value is stored in reedSwitchValues[3][0]
+ *    Example: Square X's value is stored in bit 0 of reedSwitchColumns[3]
+ *
+ *    The host puts all 12 bytes together as one little-endian number: a bitboard (see MagneticChessPython/Bitboard.py).
+ *    Telemetry only sends the columns that changed since the last frame, and all of them every KEYFRAME_INTERVAL frames
+ *    (see REED SWITCH COLUMNS in MagneticChessPython/Protocol.py).
  */
-bool reedSwitchValues[12][8];
+#define REED_SWITCH_COLUMNS 12
+unsigned char reedSwitchColumns[REED_SWITCH_COLUMNS];
+unsigned char reedSwitchColumnsSent[REED_SWITCH_COLUMNS]; // As of the last telemetry frame
+unsigned char keyframeCountdown = 0; // Telemetry frames until the next keyframe (the first one is)
+unsigned char reedSwitchScanColumn = 0; // Next column to scan
 bool inputButtonValues[] = {false, false, false, false, false, false};
 unsigned long inputButtonLastPressed[] = {0, 0, 0, 0, 0, 0};
 char inputButtonCount[] = {0, 0, 0, 0, 0, 0};
 
-long hypA;
-long hypB;
-long fastHypotenuse(long a, long b) {
-  // Very fast approximation of sqrt(a^2 + b^2) = c
-  // See https://stackoverflow.com/questions/3506404/fast-hypotenuse-algorithm-for-embedded-processor
-
-  // Get 0 <= A <= B;
-  if (abs(a) > abs(b)) {
-    hypA = abs(b);
-    hypB = abs(a);
-  } else {
-    hypA = abs(a);
-    hypB = abs(b);
-  }
-  
-  // return hypB + 0.337 * hypA;                // max error ≈ 5.5 %
-  // return max(B, 0.918 * (hypB + (hypA>>1))); // max error ≈ 2.6 %
-  return hypB + (0.428 * hypA * hypA) / hypB;   // max error ≈ 1.04 %
-}
-
 const char hexDigits[16] = "0123456789abcdef";
 char binToHexCharacter(bool binDigit3, bool binDigit2, bool binDigit1, bool binDigit0) {
   return hexDigits[(binDigit3 << 3) + (binDigit2 << 2) + (binDigit1 << 1) + (binDigit0)];
 }
 
-void printReedSwitchValuesFromColumn(int column) {
-  Serial.print(binToHexCharacter( // bits 4-7 of column in hex
-    reedSwitchValues[column][7],
-    reedSwitchValues[column][6],
-    reedSwitchValues[column][5],
-    reedSwitchValues[column][4]
-  ));
-  Serial.print(binToHexCharacter(
-    reedSwitchValues[column][3],
-    reedSwitchValues[column][2],
-    reedSwitchValues[column][1],
-    reedSwitchValues[column][0]
-  ));
+uint16_t crc16Update(uint16_t crc, uint8_t data) {
+  // CRC-16/CCITT-FALSE, one byte at a time (same as Protocol.crc16)
+  crc ^= ((uint16_t)data) << 8;
+  for (int i = 0; i < 8; i++) {
+    if (crc & 0x8000) {
+      crc = (crc << 1) ^ 0x1021;
+    } else {
+      crc = crc << 1;
+    }
+  }
+  return crc;
 }
 
-static long pow10[10] = {
-  1,
-  10,
-  100,
-  1000,
-  10000,
-  100000,
-  1000000,
-  10000000,
-  100000000,
-  1000000000
-};
-long quick_pow10(long n)
-{
-    return pow10[n]; 
+void sendFrame(unsigned char frameType, unsigned char sequence, const unsigned char* payload, unsigned char length) {
+  unsigned char header[FRAME_HEADER_LEN] = {SYNC_BYTE, PROTOCOL_VERSION, frameType, sequence, length};
+  uint16_t crc = 0xFFFF;
+  for (int i = 1; i < FRAME_HEADER_LEN; i++) { // CRC covers everything after SYNC
+    crc = crc16Update(crc, header[i]);
+  }
+  for (int i = 0; i < length; i++) {
+    crc = crc16Update(crc, payload[i]);
+  }
+  Serial.write(header, FRAME_HEADER_LEN);
+  Serial.write(payload, length);
+  Serial.write((unsigned char)(crc & 0xFF));
+  Serial.write((unsigned char)(crc >> 8));
 }
 
-void enqueueCommandFromSerial() {
-  int newBack = back + 1;
-  if (newBack >= QUEUE_SIZE) {
-    newBack = 0;
+void sendLog(const char* message) {
+  // Send a text message (like an error) to the host
+  int length = strlen(message);
+  if (length > MAX_LOG_LEN) {
+    length = MAX_LOG_LEN;
   }
-  
+  sendFrame(FRAME_LOG, logSequence++, (const unsigned char*)message, length);
+}
+
+void enqueueCommand(int16_t x, int16_t y, unsigned char flags, unsigned char cruise, unsigned char exit, unsigned char accel, unsigned char sequence) {
   // Check if the queue is full
   if (back == front && count > 0) {
-    // Queue is full, ignore and wait for commands to finish, hope serial buffer doesn't overflow before we can read it
-    Serial.println("ERROR: Tried to add command to full queue.");
+    sendLog("ERROR: Tried to add command to full queue.");
     return;
   }
 
-  // Wait for '#'
-  char in = ' ';
-  while (in != '#') {
-    in = Serial.read();
-    if (in != '#') {
-      Serial.print("WARNING: Expected '#' preceeding command, got '");
-      Serial.write(in);
-      Serial.println("'.");
-    }
-    if (Serial.available() >= COMMAND_LEN) { // Enough chars to contain a full command
-      continue;
-    } else { // Not enough chars, wait for more.
-      return;
-    }
+  commandQueue[back].x = x;
+  commandQueue[back].y = y;
+  commandQueue[back].flags = flags;
+  commandQueue[back].cruiseSpeed = cruise;
+  commandQueue[back].exitSpeed = exit;
+  commandQueue[back].acceleration = accel;
+  commandQueue[back].sequence = sequence;
+
+  back++;
+  if (back >= QUEUE_SIZE) {
+    back = 0;
   }
+  count++; // Update count
+}
 
-  // Read in command
-  for (int i = 0; i < COMMAND_LEN; i++) {
-    in = Serial.read();
-    
-    commandQueue[back][i] = in;
+void handleFrame() {
+  // Called with a complete frame in frameBuffer
+  unsigned char length = frameBuffer[4];
+  uint16_t crc = 0xFFFF;
+  for (int i = 1; i < FRAME_HEADER_LEN + length; i++) {
+    crc = crc16Update(crc, frameBuffer[i]);
+  }
+  uint16_t receivedCrc = frameBuffer[FRAME_HEADER_LEN + length] | (((uint16_t)frameBuffer[FRAME_HEADER_LEN + length + 1]) << 8);
+  if (crc != receivedCrc) {
+    frameErrorCount++;
+    sendLog("ERROR: Received frame failed CRC check. Dropped.");
+    return;
+  }
+
+  unsigned char* payload = frameBuffer + FRAME_HEADER_LEN;
+  if (frameBuffer[2] == FRAME_COMMAND && length == COMMAND_PAYLOAD_LEN) {
+    lastCommandSequence = frameBuffer[3];
+    enqueueCommand(
+      (int16_t)((uint16_t)payload[0] | ((uint16_t)payload[1] << 8)),
+      (int16_t)((uint16_t)payload[2] | ((uint16_t)payload[3] << 8)),
+      payload[4],
+      payload[5],
+      payload[6],
+      payload[7],
+      frameBuffer[3]
+    );
+  } else {
+    frameErrorCount++;
+    sendLog("ERROR: Received unknown frame type. Dropped.");
+  }
+}
+
+void readSerialFrames() {
+  // Read incoming bytes into frameBuffer, handling each frame once it's complete.
+  // Stops when the queue is full, so any commands that don't fit wait in the serial buffer.
+  while (Serial.available() > 0 && count < QUEUE_SIZE) {
+    unsigned char in = Serial.read();
+    receivedBytes++;
+
+    if (frameLength == 0 && in != SYNC_BYTE) {
+      continue; // Not the start of a frame, skip until we find one
+    }
+    frameBuffer[frameLength] = in;
+    frameLength++;
+
+    if (frameLength == FRAME_HEADER_LEN && (frameBuffer[1] != PROTOCOL_VERSION || frameBuffer[4] > MAX_RX_PAYLOAD_LEN)) {
+      frameErrorCount++; // Bad header, start looking for the next frame
+      frameLength = 0;
+    } else if (frameLength >= FRAME_HEADER_LEN && frameLength == FRAME_HEADER_LEN + frameBuffer[4] + FRAME_CRC_LEN) {
+      handleFrame();
+      frameLength = 0;
+    }
   }
-  
-  count++; // Update count
-  back = newBack; // Update the back pointer
 }
 
 void dequeueCommand() {
@@ -243,156 +334,259 @@ void dequeueCommand() {
   // Dequeue the item at the front index
   // Here, we are just advancing the front pointer
   front = newFront;
+  exitSpeedLimitKnown = false; // There's a new next command
 }
 
 bool tempButtonValue;
-/*
-void updateSwitchesAndButtons() {
-  currentTime = millis();
-  for (int column = 0; column < 12; column++) {
-    // set the PIN_MUX_FILE_S0 through PIN_MUX_FILE_S3 input pins correctly to select the correct column.
-    digitalWrite(PIN_MUX_FILE_S0, (column & BIT0) == BIT0);
-    digitalWrite(PIN_MUX_FILE_S1, (column & BIT1) == BIT1);
-    digitalWrite(PIN_MUX_FILE_S2, (column & BIT2) == BIT2);
-    digitalWrite(PIN_MUX_FILE_S3, (column & BIT3) == BIT3);
-    for (int row = 0; row < 8; row++) {
-      // set the PIN_MUX_RANK_S0 through PIN_MUX_RANK_S2 input pins correctly to select the correct row.
-      digitalWrite(PIN_MUX_RANK_S0, (row & BIT0) == BIT0);
-      digitalWrite(PIN_MUX_RANK_S1, (row & BIT1) == BIT1);
-      digitalWrite(PIN_MUX_RANK_S2, (row & BIT2) == BIT2);
-      delayMicroseconds(20);
-      reedSwitchValues[column][row] = (digitalRead(PIN_MUX_SIG) == LOW); // Read reed switches
-    } 
+#if REED_SWITCHES_ENABLED
+void scanReedSwitchColumn() {
+  // Read the 8 reed switches in the next column into one byte of reedSwitchColumns
+  int column = reedSwitchScanColumn;
+  // set the PIN_MUX_FILE_S0 through PIN_MUX_FILE_S3 input pins correctly to select the correct column.
+  digitalWrite(PIN_MUX_FILE_S0, (column & BIT0) == BIT0);
+  digitalWrite(PIN_MUX_FILE_S1, (column & BIT1) == BIT1);
+  digitalWrite(PIN_MUX_FILE_S2, (column & BIT2) == BIT2);
+  digitalWrite(PIN_MUX_FILE_S3, (column & BIT3) == BIT3);
+  unsigned char values = 0;
+  for (int row = 0; row < 8; row++) {
+    // set the PIN_MUX_RANK_S0 through PIN_MUX_RANK_S2 input pins correctly to select the correct row.
+    digitalWrite(PIN_MUX_RANK_S0, (row & BIT0) == BIT0);
+    digitalWrite(PIN_MUX_RANK_S1, (row & BIT1) == BIT1);
+    digitalWrite(PIN_MUX_RANK_S2, (row & BIT2) == BIT2);
+    delayMicroseconds(20);
+    if (digitalRead(PIN_MUX_SIG) == LOW) { // Read reed switches
+      values |= (1 << row);
+    }
   }
-}
-*/
+  reedSwitchColumns[column] = values;
 
-void sendTelemetry() {
-  // Sends portions of the telemetry data.
-  // We split it into chunks to avoid sending too much at once, which holds up the rest of our system.
-  if (currentTelemetryChunk > 1) { // Wrap around to beginning of message.
-    currentTelemetryChunk = 0;
+  reedSwitchScanColumn++;
+  if (reedSwitchScanColumn >= REED_SWITCH_COLUMNS) {
+    reedSwitchScanColumn = 0;
   }
-  switch (currentTelemetryChunk) {
-    case 0:
-      if (!motorsEnabled) {
-        Serial.print("F"); // Finished Executing
-      } else {
-        Serial.print("E"); // Executing
-      }
-      Serial.print(',');
-      Serial.print(count); // queued command count (not including currently executing)
-      break;
-    case 1:
-      Serial.print(',');
-      Serial.print(QUEUE_SIZE - count); // Available slots in queue
-      Serial.println();
-      break;
-    /*
-    case 2:
-      // Arcade-style buttons
-      Serial.print(',');
-      Serial.print(binToHexCharacter(
-        0,
-        0,
-        digitalRead(PIN_BUTTON_6) == LOW,
-        digitalRead(PIN_BUTTON_5) == LOW
-      ));
-      Serial.print(binToHexCharacter(
-        digitalRead(PIN_BUTTON_4) == LOW,
-        digitalRead(PIN_BUTTON_3) == LOW,
-        digitalRead(PIN_BUTTON_2) == LOW,
-        digitalRead(PIN_BUTTON_1) == LOW
-      ));
-      Serial.println(); // End of message
-      break;
-    */
-    default:
-      Serial.println("ERROR: Ran out of telemetry chunks without resetting");
-      currentTelemetryChunk = 0;
-      break;
-  }
-  currentTelemetryChunk++;
 }
+#endif
 
-long getDigitsFromNextCommand(int startIndex, int numDigits) {
-  int endIndex = startIndex + (numDigits - 1);
-  if (endIndex >= COMMAND_LEN) {
-    Serial.println("ERROR: Tried to get digits after length of the command (index out of range).");
-    return 0;
-  }
-
-  int index;
-  char c;
-  int digit;
-  long result = 0;
-  for (int digitIndex = 0; digitIndex < numDigits; digitIndex++) { // Start at the end (least significant digit) and work our way down.
-    index = endIndex - digitIndex;
-    c = commandQueue[front][index];
-    digit = c - '0'; // Convert char to int
-    if (digit >= 0 && digit <= 9) { // Numeric character
-      result += quick_pow10(digitIndex) * digit; // Multiply 10's place digit by 10, 100's place digit by 100, etc.
-    } else {
-      Serial.print("ERROR: Tried to read non-numeric character at command index ");
-      Serial.print(index);
-      Serial.println(".");
+void sendTelemetry() {
+  // Sends one telemetry frame (see Protocol.py). It's small enough to fit in the serial transmit buffer, so this doesn't wait.
+  bool keyframe = keyframeCountdown == 0;
+  keyframeCountdown = keyframe ? KEYFRAME_INTERVAL - 1 : keyframeCountdown - 1;
+  unsigned char payload[TELEMETRY_MAX_PAYLOAD_LEN] = {
+    (unsigned char)((motorsEnabled ? TELEMETRY_FLAG_EXECUTING : 0) | (keyframe ? TELEMETRY_FLAG_KEYFRAME : 0) | (REED_SWITCHES_ENABLED ? TELEMETRY_FLAG_REED_SWITCHES : 0)),
+    (unsigned char)count, // queued command count (not including currently executing)
+    (unsigned char)(QUEUE_SIZE - count), // Available slots in queue
+    (unsigned char)(receivedBytes & 0xFF),
+    (unsigned char)(receivedBytes >> 8),
+    (unsigned char)Serial.available(), // Bytes not read yet, so the host knows when nothing it sent is still waiting (see __resync in PhysicalBoard.py)
+    lastCommandSequence,
+    frameErrorCount,
+    lastStartedSequence,
+    lastFinishedSequence
+  };
+  // Only the reed switch columns that changed (each one read once per scan, so a change goes out in the next frame)
+  uint16_t columnMask = 0;
+  unsigned char length = TELEMETRY_FIXED_LEN;
+  for (int column = 0; column < REED_SWITCH_COLUMNS; column++) {
+    if (keyframe || reedSwitchColumns[column] != reedSwitchColumnsSent[column]) {
+      columnMask |= 1 << column;
+      payload[length++] = reedSwitchColumns[column];
+      reedSwitchColumnsSent[column] = reedSwitchColumns[column];
     }
   }
+  payload[TELEMETRY_FIXED_LEN - 2] = (unsigned char)(columnMask & 0xFF);
+  payload[TELEMETRY_FIXED_LEN - 1] = (unsigned char)(columnMask >> 8);
+  sendFrame(FRAME_TELEMETRY, telemetrySequence++, payload, length);
 
-  return result;
+  /*
+  // Arcade-style buttons
+  binToHexCharacter(
+    0,
+    0,
+    digitalRead(PIN_BUTTON_6) == LOW,
+    digitalRead(PIN_BUTTON_5) == LOW
+  );
+  binToHexCharacter(
+    digitalRead(PIN_BUTTON_4) == LOW,
+    digitalRead(PIN_BUTTON_3) == LOW,
+    digitalRead(PIN_BUTTON_2) == LOW,
+    digitalRead(PIN_BUTTON_1) == LOW
+  );
+  */
 }
 
 void executeNextCommand() {
   // Check if there is at least one command in the queue
   if (count <= 0) {
-    Serial.println("WARNING: Tried to execute command from empty queue. Ignored.");
+    sendLog("WARNING: Tried to execute command from empty queue. Ignored.");
     return;
   }
   
-  long newTargetX = getDigitsFromNextCommand(3, 4);
-  long newTargetY = getDigitsFromNextCommand(8, 5);
+  long newTargetX = commandQueue[front].x;
+  long newTargetY = commandQueue[front].y;
+  unsigned char flags = commandQueue[front].flags;
 
-  // Check whether this command is valid
-  if (!isInPlane(newTargetX, newTargetY)) {
-    Serial.print("ERROR: Tried to execute command to move to (");
-    Serial.print(newTargetX);
-    Serial.print(", ");
-    Serial.print(newTargetY);
-    Serial.print("), which is outside maximum bounds of rect between (0, 0) and (");
-    Serial.print(maxX);
-    Serial.print(", ");
-    Serial.print(maxY);
-    Serial.println("). Command ignored.");
-    dequeueCommand(); // Remove the illegal command from the queue.
-    return;
+  // An optimized command starts the next one before reaching its target, so it's finished now
+  if (commandRunning) {
+    lastFinishedSequence = lastStartedSequence;
   }
+  lastStartedSequence = commandQueue[front].sequence;
+  commandRunning = true;
 
   // Route settings
-  if (commandQueue[front][0] == 'H') { // Home, ignore everything else
+  if (flags & COMMAND_FLAG_HOME) { // Home, ignore everything else
     homeMotors();
+    finishCommand();
     dequeueCommand();
     return;
-  } else if (commandQueue[front][0] == 'U') { // Magnet up
+  }
+
+  // Check whether this command is valid
+  if (!isInPlane(newTargetX, newTargetY)) {
+    snprintf(logBuffer, sizeof(logBuffer), "ERROR: Command to (%ld, %ld) is outside (0, 0) to (%ld, %ld). Ignored.", newTargetX, newTargetY, maxX, maxY);
+    sendLog(logBuffer);
+    finishCommand(); // Nothing to do, so it's finished
+    dequeueCommand(); // Remove the illegal command from the queue.
+    return;
+  }
+
+  if (flags & COMMAND_FLAG_MAGNET_UP) { // Magnet up
     magnetUp = true;
     digitalWrite(PIN_MAGNET, HIGH);
-  } else if (commandQueue[front][0] == 'D') { // Magnet down
+  } else { // Magnet down
     magnetUp = false;
     digitalWrite(PIN_MAGNET, LOW);
   }
-  optimizeRoute = (commandQueue[front][1] == 'O'); // Optimize route setting (execute next command early to move faster)
+  optimizeRoute = (flags & COMMAND_FLAG_OPTIMIZE); // Optimize route setting (go straight into the next command without stopping)
+
+  // Motion profile
+  cruiseSpeed = decodeSpeed(commandQueue[front].cruiseSpeed);
+  exitSpeed = optimizeRoute ? decodeSpeed(commandQueue[front].exitSpeed) : startSpeed; // Precise routing stops at the target
+  acceleration = (long)commandQueue[front].acceleration * ACCELERATION_UNIT;
 
   // Target A and B position
   targetPosA = -newTargetX - newTargetY;
   targetPosB = -newTargetX + newTargetY;
+  startLine(targetPosA - motorPosA, targetPosB - motorPosB);
   
   dequeueCommand(); // Remove the command from the queue.
 }
 
+long decodeSpeed(unsigned char speed) {
+  // Command speeds below startSpeed (including 0, the default) are raised to it
+  return max((long)speed * SPEED_UNIT, startSpeed);
+}
+
+long integerSqrt(long value) {
+  // Largest root with root * root <= value. Only runs once per command, so a bit at a time is fast enough.
+  long root = 0;
+  for (long bit = 1L << 15; bit > 0; bit >>= 1) {
+    if ((unsigned long)(root + bit) * (unsigned long)(root + bit) <= (unsigned long)value) {
+      root += bit;
+    }
+  }
+  return root;
+}
+
+long getShare(long distance, long steps) {
+  // How much of each step of the dominant motor this motor moves, in 1/256 steps
+  return distance * 256 / steps;
+}
+
+long limitExitSpeed() {
+  // exitSpeed, limited to what's safe for the next command. The host plans for this already,
+  // but the queue may have changed since, so check against the command that's actually next.
+  Command* next = &commandQueue[front];
+  if ((next->flags & COMMAND_FLAG_HOME) || !isInPlane(next->x, next->y)) {
+    return startSpeed; // Stops first
+  }
+  long nextDistanceA = (-(long)next->x - next->y) - targetPosA;
+  long nextDistanceB = (-(long)next->x + next->y) - targetPosB;
+  long nextSteps = max(abs(nextDistanceA), abs(nextDistanceB));
+  if (nextSteps == 0 || majorSteps == 0) {
+    return startSpeed;
+  }
+
+  long limit = min(exitSpeed, decodeSpeed(next->cruiseSpeed));
+
+  // Each motor's speed jumps by speed * (change in its share) when the direction changes, which can't be more than startSpeed
+  long jumpA = abs(getShare(lineDistanceA, majorSteps) - getShare(nextDistanceA, nextSteps));
+  long jumpB = abs(getShare(lineDistanceB, majorSteps) - getShare(nextDistanceB, nextSteps));
+  long jump = max(jumpA, jumpB);
+  if (jump > 0) {
+    limit = min(limit, startSpeed * 256 / jump);
+  }
+
+  // The next command has to be able to stop, in case nothing comes after it
+  long nextAcceleration = (long)next->acceleration * ACCELERATION_UNIT;
+  limit = min(limit, integerSqrt(startSpeed * startSpeed + 2 * nextAcceleration * nextSteps));
+  return max(limit, startSpeed);
+}
+
+long getExitSpeed() {
+  // Speed to finish the current command at
+  if (count == 0) {
+    return startSpeed; // Nothing next yet, so plan to stop
+  }
+  if (!exitSpeedLimitKnown) {
+    exitSpeedLimit = limitExitSpeed();
+    exitSpeedLimitKnown = true;
+  }
+  return exitSpeedLimit;
+}
+
+void updateSpeed() {
+  // Called before each step. Accelerate towards cruiseSpeed, or decelerate towards the exit speed once we need to,
+  // changing by acceleration / speed each step (about acceleration per second). Same as MotionProfile.nextSpeed.
+  long speed = speedFixed >> SPEED_FRACTION_BITS;
+  long exit = getExitSpeed();
+  long targetSpeed = cruiseSpeed;
+  if (speed * speed - exit * exit >= 2 * acceleration * stepsRemaining) { // Close enough to the end that we need to slow down
+    targetSpeed = exit;
+  }
+  long change = (acceleration << SPEED_FRACTION_BITS) / speed;
+  if (speed < targetSpeed) {
+    speedFixed = min(speedFixed + change, targetSpeed << SPEED_FRACTION_BITS);
+  } else if (speed > targetSpeed) {
+    speedFixed = max(speedFixed - change, targetSpeed << SPEED_FRACTION_BITS);
+  }
+}
+
+void startLine(long distanceA, long distanceB) {
+  // Move both motors in a straight line (Bresenham's algorithm), so they start and finish together
+  lineDistanceA = distanceA;
+  lineDistanceB = distanceB;
+  majorIsA = (abs(distanceA) >= abs(distanceB));
+  majorSteps = majorIsA ? abs(distanceA) : abs(distanceB);
+  minorSteps = majorIsA ? abs(distanceB) : abs(distanceA);
+  stepError = 0;
+  stepsRemaining = majorSteps;
+}
+
+void stepLine() {
+  // One step of the dominant motor, and the other motor if it's fallen behind the line by half a step or more
+  bool stepMinor = false;
+  stepError += minorSteps;
+  if (2 * stepError >= majorSteps) {
+    stepMinor = true;
+    stepError -= majorSteps;
+  }
+  step(majorIsA || stepMinor, !majorIsA || stepMinor, lineDistanceA > 0, lineDistanceB > 0);
+  stepsRemaining--;
+}
+
+void finishCommand() {
+  // The running command reached its target
+  if (commandRunning) {
+    lastFinishedSequence = lastStartedSequence;
+    commandRunning = false;
+  }
+}
+
 bool isInPlane(long x, long y) {
   return (x >= 0) && (x <= maxX) && (y >= 0) && (y <= maxY);
 }
 
-void step(bool motorA, bool motorB, bool dirA, bool dirB, bool updateTargets) {
+void step(bool motorA, bool motorB, bool dirA, bool dirB) {
   // Ensure directions are correct
   if (motorA && (dirA != motorDirA)) {
     motorDirA = dirA;
@@ -406,19 +600,13 @@ void step(bool motorA, bool motorB, bool dirA, bool dirB, bool updateTargets) {
   if (motorA) {
     digitalWrite(PIN_STEP_A, HIGH);
     motorPosA += (dirA ? 1 : -1);
-    if (updateTargets) {
-      targetDistanceA -= (dirA ? 1 : -1);
-    }
   }
   if (motorB) {
     digitalWrite(PIN_STEP_B, HIGH);
     motorPosB += (dirB ? 1 : -1);
-    if (updateTargets) {
-      targetDistanceB -= (dirA ? 1 : -1);
-    }
   }
   
-  delayMicroseconds(400);
+  delayMicroseconds(stepPulseMicros);
   
   digitalWrite(PIN_STEP_A, LOW);
   digitalWrite(PIN_STEP_B, LOW);
@@ -432,7 +620,7 @@ void abortMission() {
   digitalWrite(PIN_MAGNET, LOW);
 
   // Notify user
-  Serial.println("Disabled motors, magnet, and suspended all Arduino processes.");
+  sendLog("ERROR Fatal: Disabled motors, magnet, and suspended all Arduino processes.");
   
   while (true) {} // Get stuck in an infinite loop intentionally
 }
@@ -450,7 +638,7 @@ void homeMotors() {
       break;
     }
     else {
-      step(true, true, true, true, false); // Step in -x direction
+      step(true, true, true, true); // Step in -x direction
       delayMicroseconds(motorIntervalMicros);
     }
     tempCount++;
@@ -458,7 +646,7 @@ void homeMotors() {
 
   // Error handling
   if (tempCount >= maxX) { // Uh oh, we moved the full width of the board and didn't hit the X limit switch
-    Serial.println("ERROR Fatal: Home sequence did not contact X-axis limit switch.");
+    sendLog("ERROR Fatal: Home sequence did not contact X-axis limit switch.");
     abortMission();
   }
 
@@ -469,7 +657,7 @@ void homeMotors() {
       break;
     }
     else {
-      step(true, true, true, false, false); // Step in -y direction
+      step(true, true, true, false); // Step in -y direction
       delayMicroseconds(motorIntervalMicros);
     }
     tempCount++;
@@ -477,7 +665,7 @@ void homeMotors() {
 
   // Error handling
   if (tempCount >= maxY) { // Uh oh, we moved the full width of the board and didn't hit the X limit switch
-    Serial.println("ERROR Fatal: Home sequence did not contact Y-axis limit switch.");
+    sendLog("ERROR Fatal: Home sequence did not contact Y-axis limit switch.");
     abortMission();
   }
 
@@ -486,6 +674,8 @@ void homeMotors() {
   motorPosB = 0;
   targetPosA = 0;
   targetPosB = 0;
+  stepsRemaining = 0;
+  speedFixed = startSpeed << SPEED_FRACTION_BITS;
 }
 
 void setup() {
@@ -506,9 +696,11 @@ void setup() {
   pinMode(PIN_BUTTON_5, INPUT_PULLUP);
   pinMode(PIN_BUTTON_6, INPUT_PULLUP);
 
-  pinMode(PIN_MUX_SIG, INPUT_PULLUP);
   pinMode(PIN_ARCADE_BUTTON_SIG, INPUT_PULLUP);
+  */
 
+#if REED_SWITCHES_ENABLED
+  pinMode(PIN_MUX_SIG, INPUT_PULLUP);
   pinMode(PIN_MUX_RANK_S0, OUTPUT);
   pinMode(PIN_MUX_RANK_S1, OUTPUT);
   pinMode(PIN_MUX_RANK_S2, OUTPUT);
@@ -516,7 +708,7 @@ void setup() {
   pinMode(PIN_MUX_FILE_S1, OUTPUT);
   pinMode(PIN_MUX_FILE_S2, OUTPUT);
   pinMode(PIN_MUX_FILE_S3, OUTPUT);
-  */
+#endif
 
   pinMode(PIN_LIM_X, INPUT_PULLUP);
   pinMode(PIN_LIM_Y, INPUT_PULLUP);
@@ -538,6 +730,13 @@ void setup() {
   motorTimer = currentTimeMicros;
   telemetryTimer = currentTime;
   executionTimer = currentTime;
+  switchTimerMicros = currentTimeMicros;
+
+  while (Serial.available() > 0) { // Anything sent while we were homing was meant for before the reset
+    Serial.read();
+  }
+  unsigned char hello[HELLO_PAYLOAD_LEN] = {QUEUE_SIZE, SERIAL_RX_BUFFER_SIZE, REED_SWITCHES_ENABLED ? HELLO_FLAG_REED_SWITCHES : 0};
+  sendFrame(FRAME_HELLO, 0, hello, HELLO_PAYLOAD_LEN); // Homed and ready for commands
 }
 
 void loop() {
@@ -545,18 +744,26 @@ void loop() {
   currentTimeMicros = micros();
   
   if (currentTimeMicros >= motorTimer) {
-    targetDistanceA = targetPosA - motorPosA;
-    targetDistanceB = targetPosB - motorPosB;
-    tempAStep = (targetDistanceA != 0);
-    tempBStep = (targetDistanceB != 0);
-
-    if (tempAStep or tempBStep) {
-      step(tempAStep, tempBStep, targetDistanceA > 0, targetDistanceB > 0, true);
-    } else if (count > 0) { // We're finished and there's another command, flag for execution immediately
-      executionTimer = millis();
+    if (stepsRemaining > 0) {
+      updateSpeed();
+      stepLine();
+      motorTimer += 1000000L / (speedFixed >> SPEED_FRACTION_BITS);
+
+      if (stepsRemaining == 0) { // Reached the target
+        finishCommand();
+        if (count > 0) {
+          executeNextCommand(); // Carry straight on at the exit speed, the next step is already timed for it
+        } else {
+          speedFixed = startSpeed << SPEED_FRACTION_BITS; // Stopped
+        }
+      }
+    } else {
+      finishCommand();
+      if (count > 0) { // We're finished and there's another command, flag for execution immediately
+        executionTimer = millis();
+      }
+      motorTimer += motorIntervalMicros;
     }
-    
-    motorTimer += motorIntervalMicros;
   }
 
   else if (currentTime >= executionTimer) {
@@ -566,20 +773,13 @@ void loop() {
         digitalWrite(PIN_EN_MOTORS, LOW); // Enable motors
         motorsEnabled = true;
       }
-      
-      // Make decision whether to start executing command.
-      if (optimizeRoute) { // Start next command when we're almost finished with our current one. Useful for changing commands quickly when carrying pieces.
-        targetDistanceEuclidian = fastHypotenuse(targetDistanceA, targetDistanceB);
-        readyToExecute = (targetDistanceEuclidian <= optimizeDistanceThreshold);
-      } else { // Precise routing: Ensure we are in exactly correct position before starting the next command. Useful for placing pieces correctly.
-        readyToExecute = (targetDistanceA == 0 && targetDistanceB == 0);
-      }
-  
-      if (readyToExecute) {
+
+      // Start the next command once we've stopped. While moving, each command starts the next one itself when it reaches its target.
+      if (stepsRemaining == 0) {
         executeNextCommand();
       }
     } else { // No commands, idle state
-      if (motorsEnabled && targetDistanceA == 0 && targetDistanceB == 0) {
+      if (motorsEnabled && stepsRemaining == 0) {
         digitalWrite(PIN_EN_MOTORS, HIGH);
         digitalWrite(PIN_MAGNET, LOW);
         motorsEnabled = false;
@@ -589,12 +789,12 @@ void loop() {
     
     executionTimer += executionInterval;
   }
-  /*
-  else if (currentTime >= switchTimer) {
-    updateSwitchesAndButtons();
-    switchTimer += switchInterval;
+#if REED_SWITCHES_ENABLED
+  else if (currentTimeMicros >= switchTimerMicros) {
+    scanReedSwitchColumn();
+    switchTimerMicros += switchIntervalMicros;
   }
-  */
+#endif
 
   else if (currentTime >= telemetryTimer) {
     sendTelemetry();
@@ -602,8 +802,10 @@ void loop() {
     telemetryTimer += telemetryInterval;
   }
 
-  // Read any new serial messages (commands)
-  else if (Serial.available() >= COMMAND_LEN + 1) { // New command in serial buffer
-    enqueueCommandFromSerial();
+  // Read any new serial frames (commands)
+  // The host sends several commands at once, so read every one we have room for.
+  // Commands that don't fit wait in the serial buffer until a slot frees up.
+  else if (Serial.available() > 0 && count < QUEUE_SIZE) { // New bytes in serial buffer
+    readSerialFrames();
   }
 }
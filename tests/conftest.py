@@ -0,0 +1,5 @@
+# The modules in MagneticChessPython import each other by name (they're run from that folder), so put it on the path
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'MagneticChessPython'))
@@ -0,0 +1,77 @@
+"""
+Tests for PhysicalBoard.optimizeCommandsWithCompletion: commands that don't change what the machine does are dropped,
+and nothing is ever merged across a change of the magnet.
+"""
+
+# Imports
+from PhysicalBoard import PhysicalBoard, HOME_COMMAND, COLLINEAR_TOLERANCE
+
+def up(x, y, optimizeRoute=False):
+    return PhysicalBoard.buildCommand(x, y, True, optimizeRoute)
+
+def down(x, y, optimizeRoute=False):
+    return PhysicalBoard.buildCommand(x, y, False, optimizeRoute)
+
+def optimize(commands, previousCommand=None):
+    return PhysicalBoard.optimizeCommandsWithCompletion(commands, previousCommand)
+
+def testNothingToRemove():
+    commands = [down(100, 100), up(100, 300), up(400, 600), down(900, 900)]
+    assert optimize(commands) == (commands, [0, 1, 2, 3])
+
+def testEmpty():
+    assert optimize([]) == ([], [])
+
+def testZeroLengthMoveIsDropped():
+    # Already at (100, 100), the next command sets the magnet when it starts anyway
+    assert optimize([down(100, 100), up(100, 500)], previousCommand=down(100, 100)) == ([up(100, 500)], [0, 0])
+    # A removed command is finished by the next one kept
+    assert optimize([up(100, 500), up(100, 500), down(300, 500)]) == ([up(100, 500), down(300, 500)], [0, 1, 1])
+
+def testZeroLengthMoveAtTheEnd():
+    # The last command is only kept if it changes the magnet (dropping the piece where it is)
+    assert optimize([up(300, 100)], previousCommand=up(300, 100)) == ([], [None])
+    assert optimize([down(300, 100)], previousCommand=up(300, 100)) == ([down(300, 100)], [0])
+    assert optimize([up(100, 100), up(300, 100), up(300, 100)]) == ([up(100, 100), up(300, 100)], [0, 1, 1])
+
+def testZeroLengthMoveKeepsPreciseStop():
+    assert optimize([up(100, 300, optimizeRoute=True), up(100, 300), down(500, 500)]) == ([up(100, 300), down(500, 500)], [0, 1, 1])
+
+def testRepeatedMagnetDownMovesAreMerged():
+    # Nothing is being carried, so only the last approach move matters
+    commands = [down(100, 100), down(500, 900), down(200, 200), up(200, 600)]
+    assert optimize(commands) == ([down(200, 200), up(200, 600)], [0, 0, 0, 1])
+
+def testCollinearWaypointsAreMerged():
+    commands = [down(100, 100), up(100, 300), up(100, 500), up(100, 700), up(400, 1000)]
+    assert optimize(commands) == ([down(100, 100), up(100, 700), up(400, 1000)], [0, 1, 1, 1, 2])
+
+def testWaypointsOffTheLineAreKept():
+    onLine = [down(100, 100), up(100 + COLLINEAR_TOLERANCE, 400), up(100, 700)]
+    assert optimize(onLine)[0] == [down(100, 100), up(100, 700)]
+    offLine = [down(100, 100), up(100 + COLLINEAR_TOLERANCE + 2, 400), up(100, 700)]
+    assert optimize(offLine)[0] == offLine
+
+def testWaypointsPastTheEndAreKept():
+    # Going out and coming back along the same line isn't a straight move
+    commands = [down(100, 100), up(100, 700), up(100, 400)]
+    assert optimize(commands)[0] == commands
+
+def testNoMergingAcrossMagnetChanges():
+    # Collinear, but the magnet goes down in the middle (the piece is dropped there), or picks one up there
+    dropped = [down(100, 100), up(100, 300), down(100, 500), up(100, 700)]
+    assert optimize(dropped) == (dropped, [0, 1, 2, 3])
+    pickedUp = [down(100, 100), down(100, 300), up(100, 500)]
+    assert optimize(pickedUp) == ([down(100, 300), up(100, 500)], [0, 0, 1])
+    carried = [up(100, 100), down(100, 300), up(100, 500)]
+    assert optimize(carried, previousCommand=up(100, 0)) == (carried, [0, 1, 2])
+
+def testHomeIsKeptAndStartsAtZero():
+    # Homing ends at (0, 0), so a move there afterwards does nothing, and nothing merges across it
+    commands = [down(0, 500), HOME_COMMAND, down(0, 0), up(0, 300), up(0, 600)]
+    assert optimize(commands) == ([down(0, 500), HOME_COMMAND, down(0, 0), up(0, 600)], [0, 1, 2, 3, 3])
+    assert optimize([down(0, 0), up(0, 300)], previousCommand=HOME_COMMAND) == ([down(0, 0), up(0, 300)], [0, 1])
+
+def testOptimizeCommandsCountsRemoved():
+    commands = [down(100, 100), down(500, 900), up(500, 1000), up(500, 1100)]
+    assert PhysicalBoard.optimizeCommands(commands) == ([down(500, 900), up(500, 1100)], 2)
@@ -0,0 +1,122 @@
+"""
+Tests for Protocol.py: every frame type survives encoding and decoding, and FrameParser finds its way back to the
+frames after noise and corrupted frames.
+"""
+
+# Imports
+import struct
+import pytest
+from Protocol import Protocol, FrameParser, Command, Telemetry, Hello, SYNC_BYTE, COMMAND_FRAME_SIZE, FRAME_COMMAND, FRAME_TELEMETRY, FRAME_LOG, FRAME_HELLO, SPEED_UNIT, ACCELERATION_UNIT, ALL_REED_SWITCHES
+
+def parseOne(data):
+    # The only frame in data
+    frames = FrameParser().feed(data)
+    assert len(frames) == 1
+    return frames[0]
+
+@pytest.mark.parametrize('command', [
+    Command(0, 0, False, False, False),
+    Command(6950, 11900, True, True, False, 40 * SPEED_UNIT, 3 * SPEED_UNIT, 25 * ACCELERATION_UNIT),
+    Command(-1, 32767, True, False, False, 255 * SPEED_UNIT, 0, 255 * ACCELERATION_UNIT),
+    Command(0, 0, False, False, True),
+])
+def testCommandRoundTrip(command):
+    frame = parseOne(Protocol.encodeCommand(command, 17))
+    assert (frame.type, frame.sequence) == (FRAME_COMMAND, 17)
+    assert Protocol.decodeCommand(frame.payload) == command
+
+def testCommandProfileIsRoundedDownToUnits():
+    command = Command(100, 200, True, False, False, 2 * SPEED_UNIT + 5, SPEED_UNIT - 1, 300 * ACCELERATION_UNIT)
+    decoded = Protocol.decodeCommand(parseOne(Protocol.encodeCommand(command, 1)).payload)
+    assert (decoded.cruiseSpeed, decoded.exitSpeed, decoded.acceleration) == (2 * SPEED_UNIT, 0, 255 * ACCELERATION_UNIT)
+
+@pytest.mark.parametrize('keyframe, reedSwitchMask, reedSwitches', [
+    (True, ALL_REED_SWITCHES, 0xFFFF << 32), # Start position: every column, ranks 1, 2, 7, 8 of a to h
+    (False, 0, 0), # Nothing changed
+    (False, 0xFF << 64, 0x08 << 64), # One column
+    (False, (0xFF << 8) | (0xFF << 88), 0x81 << 88), # First and last columns, one of them empty now
+])
+def testTelemetryRoundTrip(keyframe, reedSwitchMask, reedSwitches):
+    telemetry = Telemetry(True, 3, 29, 65535, 12, 255, 7, 254, 253, True, keyframe, reedSwitchMask, reedSwitches)
+    frame = parseOne(Protocol.encodeTelemetry(telemetry, 200))
+    assert (frame.type, frame.sequence) == (FRAME_TELEMETRY, 200)
+    assert Protocol.decodeTelemetry(frame.payload) == telemetry
+
+def testTelemetryWithoutReedSwitches():
+    telemetry = Telemetry(False, 0, 32, 0, 0, 0, 0, 0, 0, False, True, ALL_REED_SWITCHES, 0)
+    assert Protocol.decodeTelemetry(parseOne(Protocol.encodeTelemetry(telemetry, 0)).payload).reedSwitchesEnabled is False
+
+def testTelemetryColumnsMustMatchMask():
+    telemetry = Telemetry(False, 0, 32, 0, 0, 0, 0, 0, 0, True, False, 0xFF << 64, 0)
+    payload = parseOne(Protocol.encodeTelemetry(telemetry, 0)).payload
+    with pytest.raises(struct.error):
+        Protocol.decodeTelemetry(payload + b'\x00')
+    with pytest.raises(struct.error):
+        Protocol.decodeTelemetry(payload[:-1])
+
+@pytest.mark.parametrize('hello', [Hello(32, 64, True), Hello(8, 255, False)])
+def testHelloRoundTrip(hello):
+    frame = parseOne(Protocol.encodeHello(hello))
+    assert frame.type == FRAME_HELLO
+    assert Protocol.decodeHello(frame.payload) == hello
+
+def testLogRoundTrip():
+    frame = parseOne(Protocol.encodeLog("WARNING: Limit switch hit", 9))
+    assert (frame.type, frame.sequence) == (FRAME_LOG, 9)
+    assert Protocol.decodeLog(frame.payload) == "WARNING: Limit switch hit"
+
+def testCommandSequenceSkipsZero():
+    assert Protocol.nextCommandSequence(254) == 255
+    assert Protocol.nextCommandSequence(255) == 1
+
+def getFrames():
+    # A few frames of every type, one after the other
+    return [
+        Protocol.encodeHello(Hello(32, 64, True)),
+        Protocol.encodeTelemetry(Telemetry(False, 0, 32, 0, 0, 0, 0, 0, 0, True, True, ALL_REED_SWITCHES, 0xFFFF << 32), 0),
+        Protocol.encodeCommand(Command(1234, 5678, True, True, False), 1),
+        Protocol.encodeLog("ERROR: Queue full", 0),
+        Protocol.encodeTelemetry(Telemetry(True, 1, 31, 14, 0, 1, 0, 1, 0, True, False, 0xFF << 64, 0x10 << 64), 1),
+    ]
+
+def testFramesSplitAnywhere():
+    frames = getFrames()
+    data = b"".join(frames)
+    parser = FrameParser()
+    parsed = []
+    for index in range(len(data)):
+        parsed += parser.feed(data[index:index + 1])
+    assert [frame.payload for frame in parsed] == [parseOne(frame).payload for frame in frames]
+    assert (parser.skippedBytes, parser.crcErrors) == (0, 0)
+
+def testResyncAfterNoise():
+    # Noise between frames, including stray SYNC bytes and a header that claims a huge payload
+    frames = getFrames()
+    noise = b"\x00\xff" + bytes([SYNC_BYTE]) + b"garbage" + bytes([SYNC_BYTE, 0x00, 0x81, 0x00, 0xFF])
+    parser = FrameParser()
+    parsed = parser.feed(frames[0] + noise + frames[1] + noise + frames[2])
+    assert [frame.type for frame in parsed] == [FRAME_HELLO, FRAME_TELEMETRY, FRAME_COMMAND]
+    assert parser.skippedBytes == 2 * len(noise)
+    assert parser.crcErrors == 0
+
+@pytest.mark.parametrize('corruptIndex', range(1, COMMAND_FRAME_SIZE))
+def testResyncAfterBadCrc(corruptIndex):
+    # One flipped bit anywhere after the SYNC of a command frame (VERSION to CRC) loses only that frame.
+    # A wrong VERSION isn't a frame at all, anything else fails the CRC.
+    frames = getFrames()
+    corrupted = bytearray(frames[2])
+    corrupted[corruptIndex] ^= 0x10
+    parser = FrameParser()
+    parsed = parser.feed(b"".join(frames[:2]) + bytes(corrupted) + b"".join(frames[3:]))
+    assert [frame.type for frame in parsed] == [FRAME_HELLO, FRAME_TELEMETRY, FRAME_LOG, FRAME_TELEMETRY]
+    assert parser.crcErrors == (0 if corruptIndex == 1 else 1)
+    assert parser.skippedBytes == len(corrupted)
+
+def testBadCrcIsCounted():
+    frame = bytearray(Protocol.encodeCommand(Command(10, 20, False, False, False), 5))
+    frame[-1] ^= 0xFF
+    parser = FrameParser()
+    good = Protocol.encodeCommand(Command(30, 40, False, False, False), 6)
+    parsed = parser.feed(bytes(frame) + good)
+    assert [Protocol.decodeCommand(frame.payload) for frame in parsed] == [Command(30, 40, False, False, False)]
+    assert parser.crcErrors == 1